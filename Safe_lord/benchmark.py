@@ -0,0 +1,159 @@
+import os
+import io
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from fake_discord import FakeDiscord
+
+
+def percentile(samples, share):
+    """
+    Returns the nearest-rank percentile of a list of numbers, or 0 if it is empty.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+def time_calls(module, name, samples):
+    """
+    Wraps module.name so the duration of every call is appended to `samples`.
+    """
+    function = getattr(module, name)
+    lock = threading.Lock()
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with lock:
+                samples.append(time.perf_counter() - start)
+
+    setattr(module, name, timed)
+
+
+def measure(fake, size, samples, action):
+    """
+    Runs one transfer and summarizes it.
+
+    :param fake: The FakeDiscord server the transfer runs against.
+    :param size: Bytes transferred.
+    :param samples: List the per-request timings of the transfer are collected in.
+    :param action: Function performing the transfer.
+    :return: Dict of the scenario's results.
+    """
+    samples.clear()
+    before = fake.stats.copy()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):  # Keeps progress bars out of the report
+        action()
+    elapsed = time.perf_counter() - start
+    stats = fake.stats.copy()
+    stats.subtract(before)
+    requests_made = stats["requests"] + stats["cdn_requests"]
+    return {
+        "seconds": elapsed,
+        "mb_per_s": size / elapsed / 1000**2,
+        "requests": requests_made,
+        "requests_per_gb": requests_made / (size / 1000**3),
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "rate_limited": stats["rate_limited"] + stats["injected_429"],
+    }
+
+
+def run_benchmarks(size, chunk_size=None, latency=0.0, bandwidth=None, rate_limit=None, fail_rate=0.0, channels=1):
+    """
+    Uploads and downloads a random file through the real transfer paths against a local FakeDiscord.
+
+    Must run before config is imported anywhere in the process, since config reads the
+    API base URL and credentials from the environment when it is imported.
+
+    Parameters:
+    size (int): Bytes in the test file.
+    chunk_size (int): CHUNK_SIZE to use instead of the configured one, or None.
+    latency (float): Seconds the server adds to every request.
+    bandwidth (float): Bytes per second per connection, or None for no limit.
+    rate_limit (tuple): (requests, seconds) per route, or None for no limit.
+    fail_rate (float): Share of API requests answered with an injected 429.
+    channels (int): Channels the chunks are striped across.
+
+    Returns:
+    dict: Results of the "upload" and "download" scenarios.
+    """
+    fake = FakeDiscord(latency, bandwidth, rate_limit, fail_rate)
+    os.environ.update(TOKEN="benchmark", CHANNEL_ID="1", DISCORD_API_BASE=fake.start(),
+                      STRIPES=",".join(str(channel_id) for channel_id in range(2, channels + 1)))
+    workdir = tempfile.mkdtemp(prefix="safe_lord_benchmark_")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Index, caches and downloads are written to the working directory
+    try:
+        import config
+        if chunk_size:
+            config.CHUNK_SIZE = chunk_size  # Before the transfer modules copy it at import
+            config.MESSAGE_SIZE_LIMIT = max(config.MESSAGE_SIZE_LIMIT, chunk_size)
+        import file_operations
+        import download_pipeline
+
+        upload_samples = []
+        download_samples = []
+        time_calls(file_operations, "post_attachments", upload_samples)
+        time_calls(download_pipeline, "fetch_chunk", download_samples)
+
+        with open("benchmark.bin", "wb") as f:
+            for offset in range(0, size, 1000**2):
+                f.write(os.urandom(min(1000**2, size - offset)))
+
+        results = {
+            "upload": measure(fake, size, upload_samples, lambda: file_operations.upload_file(["benchmark.bin"])),
+            "download": measure(fake, size, download_samples, lambda: file_operations.download_file(["1"])),
+        }
+        with open("benchmark.bin", "rb") as original, open("downloads/benchmark.bin", "rb") as downloaded:
+            if original.read() != downloaded.read():
+                raise RuntimeError("Downloaded file does not match the uploaded one")
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        fake.stop()
+
+
+def print_results(results):
+    print(f"{'scenario':<10}{'MB/s':>10}{'requests':>10}{'req/GB':>10}{'p50 ms':>10}{'p99 ms':>10}{'429s':>8}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['mb_per_s']:>10.1f}{result['requests']:>10}{result['requests_per_gb']:>10.0f}"
+              f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['rate_limited']:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures upload and download throughput against a local fake Discord API. "
+                                                 "p50/p99 are per message upload and per chunk download.")
+    parser.add_argument("--size", type=float, default=100, help="test file size in MB")
+    parser.add_argument("--chunk-size", type=float, default=None, help="chunk size in MB instead of CHUNK_SIZE")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the server adds to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="MB/s per connection")
+    parser.add_argument("--rate-limit", type=float, nargs=2, metavar=("REQUESTS", "SECONDS"), default=None)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of API requests answered with 429")
+    parser.add_argument("--channels", type=int, default=1, help="channels to stripe the chunks across")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results = run_benchmarks(int(args.size * 1000**2),
+                             int(args.chunk_size * 1000**2) if args.chunk_size else None,
+                             args.latency,
+                             args.bandwidth * 1000**2 if args.bandwidth else None,
+                             (int(args.rate_limit[0]), args.rate_limit[1]) if args.rate_limit else None,
+                             args.fail_rate,
+                             args.channels)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from config import CHECKPOINT_DIR
+
+
+class Checkpoint:
+    """
+    Records which chunks of a transfer have completed, so an interrupted transfer can resume.
+
+    Each completed chunk is appended as one JSON line to a file in CHECKPOINT_DIR named
+    after the transfer's key. The file is removed once the whole transfer has succeeded.
+    """
+
+    def __init__(self, *key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        self.path = os.path.join(CHECKPOINT_DIR, digest + ".jsonl")
+        self.lock = threading.Lock()
+        self.completed = {}
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short when the previous run was killed
+                    self.completed[record["chunk"]] = record.get("value")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not read checkpoint {self.path}: {e}")
+
+    def __contains__(self, chunk):
+        return chunk in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def get(self, chunk):
+        return self.completed.get(chunk)
+
+    def record(self, chunk, value=None):
+        """
+        Marks a chunk as completed.
+
+        Args:
+            chunk (int): Index of the chunk.
+            value: JSON-serializable result to keep for the chunk, e.g. its (message_id, attachment_id) pair.
+        """
+        with self.lock:
+            self.completed[chunk] = value
+            try:
+                os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"chunk": chunk, "value": value}) + "\n")
+            except OSError as e:
+                logging.warning(f"Could not write checkpoint {self.path}: {e}")
+
+    def discard(self):
+        """
+        Forgets all completed chunks, e.g. after the transfer succeeded.
+        """
+        with self.lock:
+            self.completed = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def get_checkpointed_messages(directory=CHECKPOINT_DIR):
+    """
+    Collects the IDs of the messages that interrupted uploads have posted so far.
+
+    Those chunks are not in the index yet, but the upload reuses them when it resumes.
+
+    Returns:
+        set: The message IDs.
+    """
+    message_ids = set()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return message_ids
+    for name in names:
+        try:
+            with open(os.path.join(directory, name), "r") as f:
+                for line in f:
+                    try:
+                        value = json.loads(line).get("value")
+                    except json.JSONDecodeError:
+                        continue
+                    # Upload checkpoints record [[message_id, attachment_id], fields] per piece; downloads record nothing
+                    for piece in value or []:
+                        message_ids.add(str(piece[0][0]))
+        except OSError as e:
+            logging.warning(f"Could not read checkpoint {name}: {e}")
+    return message_ids
@@ -0,0 +1,146 @@
+from file_utils import decode
+from chunking import hash_chunk
+from config import COMPRESSION, COMPRESSION_LEVEL
+from compression import pack_chunk, new_decompressor
+from encryption import load_key, get_key_id, get_hash_key, encrypt_chunk, decrypt_chunk
+
+CHUNK_FIELDS = ("nonces", "codecs")  # Per-chunk index fields needed to decode a stored payload
+KEYED_HASHING = "hmac-sha256"  # "hashing" of files whose chunk hashes are keyed with the encryption key
+
+
+def get_upload_transform(content_fields=True):
+    """
+    Builds the transform applied to every chunk before it is uploaded.
+
+    With COMPRESSION set, a chunk is compressed (or stored raw if it samples as
+    incompressible) before it is encrypted. Input that compresses to more than one
+    attachment comes back as several pieces, each uploaded as a chunk of its own.
+
+    Args:
+        content_fields (bool): Record the content hash of every chunk in "hashes", and its
+            length in "sizes" when chunks are compressed. Callers that hash and measure chunks
+            themselves (content-defined chunking) turn this off. With ENCRYPTION_KEY set the
+            hashes are keyed, see get_chunk_hash_key.
+
+    Returns:
+        tuple: The transform, or None when chunks are uploaded as they are, and the fields it
+            adds to the file's index entry. The transform takes the chunk's bytes and returns
+            a list of pieces, each the payload to upload and a dict of per-chunk index fields
+            (e.g. {"nonces": ..., "codecs": ...}). Its `copies` attribute tells whether payloads are
+            new buffers held next to the chunk (compressed or encrypted) rather than the chunk itself.
+    """
+    key = load_key()
+    codec = COMPRESSION if COMPRESSION != "none" else None
+    if key is None and codec is None and not content_fields:
+        return None, {}
+    hash_key = get_hash_key(key) if key is not None else None
+
+    def transform(chunk):
+        pieces = pack_chunk(chunk, codec, COMPRESSION_LEVEL) if codec else [(chunk, chunk, None)]
+        results = []
+        for data, payload, piece_codec in pieces:
+            fields = {}
+            if content_fields:
+                fields["hashes"] = hash_chunk(data, hash_key)  # Taken on the worker thread while the chunk is in memory anyway
+                if codec:
+                    fields["sizes"] = len(data)
+            if codec:
+                fields["codecs"] = piece_codec
+            if key is not None:
+                payload, fields["nonces"] = encrypt_chunk(payload, key)
+            results.append((payload, fields))
+        return results
+
+    transform.copies = codec is not None or key is not None
+    return transform, ({"key_id": get_key_id(key), "hashing": KEYED_HASHING} if key else {})
+
+
+class ChunkDecoder:
+    """
+    Turns a stored chunk payload back into file data while it is downloaded.
+
+    Encrypted payloads can only be authenticated as a whole, so they are collected and
+    decrypted in finish(); otherwise compressed data is decompressed as each piece arrives.
+    """
+
+    def __init__(self, codec="raw", nonce=None, key=None):
+        self.nonce = nonce
+        self.key = key
+        self.encrypted = bytearray() if nonce else None
+        self.decompressor = new_decompressor(codec) if codec != "raw" else None
+
+    def update(self, data):
+        """
+        Takes the next piece of the payload and returns the file data decoded so far.
+        """
+        if self.encrypted is not None:
+            self.encrypted += data
+            return b""
+        return self._decompress(data)
+
+    def finish(self):
+        """
+        Returns the rest of the chunk's data once the whole payload was passed to update().
+        """
+        data = b""
+        if self.encrypted is not None:
+            data = self._decompress(decrypt_chunk(bytes(self.encrypted), self.nonce, self.key))
+        if self.decompressor is not None:
+            data += self.decompressor.flush()
+        return data
+
+    def _decompress(self, data):
+        return self.decompressor.decompress(data) if self.decompressor is not None else data
+
+
+def get_download_decoder(file_entry):
+    """
+    Builds the factory of decoders for the chunks of a file.
+
+    Args:
+        file_entry (dict): The file's index entry.
+
+    Returns:
+        function: Takes the index of a chunk and returns a new ChunkDecoder for it, or None
+            when the file's chunks are stored as they are. Raises ValueError if the key the
+            file needs is not configured.
+    """
+    codecs = file_entry.get("codecs")
+    nonces = file_entry.get("nonces")
+    if not codecs and not nonces:
+        return None
+
+    key = load_file_key(file_entry) if nonces else None
+    return lambda i: ChunkDecoder(codecs[i] if codecs else "raw", nonces[i] if nonces else None, key)
+
+
+def get_chunk_hash_key(file_entry):
+    """
+    Returns the key the chunk hashes of a file are computed with, for chunking.hash_chunk.
+
+    Files uploaded with ENCRYPTION_KEY set record HMACs under a key derived from it, so
+    their hashes say nothing about the content to anyone who can only read the channel.
+    Files without a key, and encrypted files uploaded before hashes were keyed, record plain
+    SHA-256 hashes.
+
+    Args:
+        file_entry (dict): The file's index entry, or the file-level fields of an upload.
+
+    Returns:
+        bytes: The HMAC key, or None for plain hashes. Raises ValueError if the key the file
+            needs is not configured.
+    """
+    if file_entry.get("hashing") != KEYED_HASHING:
+        return None
+    return get_hash_key(load_file_key(file_entry))
+
+
+def load_file_key(file_entry):
+    """
+    Loads the encryption key a file was uploaded with, raising ValueError if ENCRYPTION_KEY is not that key.
+    """
+    key = load_key()
+    if key is None or get_key_id(key) != file_entry.get("key_id"):
+        raise ValueError(f"{decode(file_entry.get('filename', ''))} is encrypted with key {file_entry.get('key_id')}; "
+                         f"set ENCRYPTION_KEY to that key to download it")
+    return key
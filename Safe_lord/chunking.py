@@ -0,0 +1,88 @@
+import hmac
+import zlib
+import hashlib
+from math import log2
+from config import CHUNK_SIZE, CDC_MIN_SIZE, CDC_AVG_SIZE
+
+ANCHOR = b"\x9e"  # Byte that marks a candidate boundary
+WINDOW = 48  # Bytes before a candidate that decide whether it becomes a boundary
+
+
+def find_boundary(data, min_size, max_size, mask):
+    """
+    Finds where the next content-defined chunk ends.
+
+    Candidates are occurrences of ANCHOR, found with bytes.find so the scan runs at C speed.
+    A candidate becomes a boundary when the CRC32 of the WINDOW bytes ending at it has all
+    `mask` bits clear. The decision depends only on nearby content, so inserting or removing
+    bytes in a file moves the boundaries after the edit along with the data.
+
+    Parameters:
+    data (bytes): Buffered file data starting at the beginning of the chunk.
+    min_size (int): Smallest allowed chunk.
+    max_size (int): Largest allowed chunk.
+    mask (int): Bit mask tested against the window hash.
+
+    Returns:
+    int: Length of the chunk.
+    """
+    end = min(len(data), max_size)
+    position = data.find(ANCHOR, max(min_size, WINDOW) - 1, end)
+    while position != -1:
+        if zlib.crc32(data[position - WINDOW + 1:position + 1]) & mask == 0:
+            return position + 1
+        position = data.find(ANCHOR, position + 1, end)
+    return end
+
+
+def content_defined_chunks(file_handle, min_size=CDC_MIN_SIZE, avg_size=CDC_AVG_SIZE, max_size=CHUNK_SIZE):
+    """
+    Splits a file into chunks at content-defined boundaries.
+
+    Parameters:
+    file_handle: File opened in binary mode.
+    min_size (int): Smallest chunk, except for the last one.
+    avg_size (int): Expected average chunk size.
+    max_size (int): Largest chunk; never more than the attachment limit.
+
+    Yields:
+    bytes: The chunks, in file order.
+    """
+    # Anchors occur about every 256 bytes in random data, and each passes the mask test with probability 1/(mask+1)
+    mask = (1 << max(0, round(log2(max(1, avg_size - min_size) / 256)))) - 1
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = file_handle.read(max_size - len(buffer))
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+
+        cut = find_boundary(buffer, min_size, max_size, mask)
+        if eof and cut == len(buffer):
+            yield bytes(buffer)
+            return
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def hash_chunk(chunk, key=None):
+    """
+    Returns the content hash used to recognise chunks that are already stored and to verify downloads.
+
+    With a key (see encryption.get_hash_key) the hash is an HMAC-SHA256, so the hashes of
+    encrypted files do not reveal to anyone without the key which content is stored.
+    """
+    if key is not None:
+        return hmac.new(key, chunk, hashlib.sha256).hexdigest()
+    return hashlib.sha256(chunk).hexdigest()
+
+
+def new_chunk_hash(key=None):
+    """
+    Returns a hash object for computing hash_chunk() incrementally over streamed data.
+    """
+    return hmac.new(key, digestmod=hashlib.sha256) if key is not None else hashlib.sha256()
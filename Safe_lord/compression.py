@@ -0,0 +1,128 @@
+import zlib
+import lzma
+from config import CHUNK_SIZE, COMPRESSION_MAX_INPUT
+
+SAMPLE_SIZE = 64 * 1024
+COMPRESSIBLE_RATIO = 0.9  # Sampled ratio above which data is stored as it is
+MIN_SAVING = 0.97  # Compressed output must be below this share of the input to be kept
+
+
+def sample_ratio(data):
+    """
+    Estimates how well data compresses from a few fast-compressed samples.
+
+    Parameters:
+    data (bytes): The data to inspect.
+
+    Returns:
+    float: Compressed size divided by original size of the samples (about 1.0 for random data).
+    """
+    if len(data) <= 3 * SAMPLE_SIZE:
+        samples = [data]
+    else:
+        middle = len(data) // 2
+        samples = [data[:SAMPLE_SIZE], data[middle:middle + SAMPLE_SIZE], data[-SAMPLE_SIZE:]]
+    size = sum(len(sample) for sample in samples)
+    if not size:
+        return 1.0
+    return sum(len(zlib.compress(sample, 1)) for sample in samples) / size
+
+
+def compress(data, codec, level):
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+class _LZMAStream:
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if not self.decompressor.eof:
+            raise lzma.LZMAError("Compressed data ended before the end-of-stream marker")
+        return b""
+
+
+def new_decompressor(codec):
+    """
+    Returns a streaming decompressor with decompress(data) and flush() for a chunk codec.
+
+    Parameters:
+    codec (str): "zlib" or "lzma".
+    """
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "lzma":
+        return _LZMAStream()
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def estimate_input_size(data):
+    """
+    Estimates how much input fills one attachment once compressed.
+
+    The sample ratio comes from the fastest zlib level, which the configured codec and level
+    at least match, so the estimate rarely overshoots; pack_chunk splits the input if it does.
+
+    Parameters:
+    data (bytes): The first CHUNK_SIZE bytes of the next chunk.
+
+    Returns:
+    int: Number of input bytes to put in the chunk.
+    """
+    ratio = sample_ratio(data)
+    if ratio >= COMPRESSIBLE_RATIO:
+        return CHUNK_SIZE
+    return max(CHUNK_SIZE, min(COMPRESSION_MAX_INPUT, int(CHUNK_SIZE * 0.9 / ratio)))
+
+
+def pack_chunk(data, codec, level, limit=CHUNK_SIZE):
+    """
+    Compresses data into independently decodable payloads of at most `limit` bytes.
+
+    Data that samples as incompressible, or that does not shrink, is stored raw. Input that
+    still compresses to more than `limit` is split so each payload fits in one attachment;
+    input of at most `limit` bytes always yields a single payload.
+
+    Parameters:
+    data (bytes): The chunk's data, or any bytes-like object.
+    codec (str): "zlib" or "lzma".
+    level (int): Compression level or preset.
+    limit (int): Largest payload.
+
+    Returns:
+    list: (data, payload, codec) for each piece, where codec is "raw" for stored pieces, whose
+    payload is a view of the input rather than a copy.
+    """
+    data = memoryview(data)
+    if not len(data):
+        return [(data, b"", "raw")]
+    pieces = []
+    while len(data):
+        take = len(data)
+        while True:
+            piece = data[:take]
+            payload = None
+            if sample_ratio(piece) < COMPRESSIBLE_RATIO:
+                payload = compress(piece, codec, level)
+                if len(payload) >= len(piece) * MIN_SAVING:
+                    payload = None
+
+            if payload is None and take <= limit:
+                pieces.append((piece, piece, "raw"))
+                break
+            if payload is None:
+                take = limit
+            elif len(payload) <= limit:
+                pieces.append((piece, payload, codec))
+                break
+            else:
+                take = min(take - 1, int(take * limit / len(payload) * 0.95))
+        data = data[take:]
+    return pieces
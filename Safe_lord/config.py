@@ -3,17 +3,60 @@ from dotenv import load_dotenv
 load_dotenv()  # Load environment variables from .env file
 TOKEN = os.getenv('TOKEN')
 CHANNEL_ID = os.getenv('CHANNEL_ID')
+# More channels chunks are striped across along with CHANNEL_ID, as comma-separated "channel_id" or "token:channel_id"
+# entries; channels without a token are accessed with TOKEN
+STRIPES = [(TOKEN, CHANNEL_ID)] + [(entry.rpartition(":")[0] or TOKEN, entry.rpartition(":")[2])
+                                   for entry in os.getenv('STRIPES', '').replace(" ", "").split(",") if entry]
+STRIPE_POLICY = os.getenv('STRIPE_POLICY', 'load')  # Channel each message is posted to: load (fewest bytes in flight) or round-robin
+ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')  # 32-byte key (hex or base64); chunks are encrypted when set
 CDN_BASE_URL = ""  
 headers = {
     "Authorization": f"Bot {TOKEN}",  
     "User-Agent": "DiscordBot (https://discord.com, v1)"  
 }
 
-BASE_URL = "https://discord.com/api/v9/channels/"
-INDEX_FILE = "index.txt"
+BASE_URL = os.getenv('DISCORD_API_BASE', "https://discord.com/api/v9/channels/")  # Point at fake_discord.py for offline runs
+INDEX_FILE = "index.bin"  # Local copy of the index, in the binary format of index_format.py
+INDEX_CACHE_FILE = "index_cache.json"  # Remote index messages the local INDEX_FILE was built from
+JOURNAL_FILE = "index.journal"  # Attachment name of index journal records
+JOURNAL_COMPACT_EVERY = 50  # Journal records kept before they are compacted into a new snapshot
+URL_CACHE_FILE = "url_cache.json"
+SEARCH_INDEX_FILE = "search_index.json"  # Trigram index of the decoded filenames for -find
+CHECKPOINT_DIR = ".checkpoints"  # Progress of interrupted transfers
+SYNC_MANIFEST_DIR = ".sync"  # Size, modification time and hash of the files of every directory synced with -sync
+CHUNK_CACHE_DIR = ".chunk_cache"  # Chunks downloaded by open_remote()
+CHUNK_CACHE_SIZE = int(os.getenv('CHUNK_CACHE_SIZE', 1000 * 1000 * 1000))  # Bytes kept in CHUNK_CACHE_DIR
+READ_AHEAD = 2  # Chunks fetched ahead while a remote file is read sequentially
+URL_EXPIRY_MARGIN = 300  # Seconds before a signed CDN URL expires that it stops being reused
 CHUNK_SIZE = 25 * 1000 * 1000  #Discord 25MB file limit
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4)) * len(STRIPES)  # Chunks uploaded concurrently, UPLOAD_WORKERS per striped channel
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 8))  # Chunks downloaded concurrently, across all files
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', min(4, os.cpu_count() or 1)))  # Downloaded chunks decompressed, decrypted and verified concurrently
+DOWNLOAD_QUEUE_DEPTH = int(os.getenv('DOWNLOAD_QUEUE_DEPTH', 4))  # Chunks buffered between download stages; memory stays under (2 * depth + workers) chunks
+MEMORY_LIMIT = int(os.getenv('MEMORY_LIMIT', 0))  # Bytes of chunk data all transfers may hold in memory at once; 0 for no limit
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', 4))  # Messages too old for bulk delete deleted concurrently, per channel
+BULK_DELETE_MAX_AGE = 14 * 24 * 3600 - 600  # Discord only bulk-deletes messages younger than two weeks; kept clear of the edge
+GC_MIN_AGE = int(os.getenv('GC_MIN_AGE', 3600))  # Seconds before -gc collects an unreferenced chunk, so running uploads keep theirs
+TELEMETRY_FILE = os.getenv('TELEMETRY_FILE')  # File every request and transfer step is written to as JSON lines when a command ends
+TRACE_FILE = os.getenv('TRACE_FILE')  # File the same events are written to as a Chrome trace, for chrome://tracing or Perfetto
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = (10, 300)  # Seconds to connect and between received bytes
+BACKOFF_BASE = 0.5  # Seconds before the first retry of a failed request, doubled on each further retry
+BACKOFF_CAP = 30
+CONTENT_DEFINED_CHUNKING = os.getenv('CONTENT_DEFINED_CHUNKING', '0') == '1'  # Split files by content and skip stored chunks
+CDC_MIN_SIZE = 4 * 1000 * 1000
+CDC_AVG_SIZE = 12 * 1000 * 1000
+STREAM_DIRECTORIES = os.getenv('STREAM_DIRECTORIES', '1') != '0'  # Zip directories straight into uploaded chunks
+COMPRESSION = os.getenv('COMPRESSION', 'none')  # Per-chunk codec: none, zlib or lzma
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))  # zlib level or lzma preset
+COMPRESSION_MAX_INPUT = 4 * CHUNK_SIZE  # Most input packed into one compressed chunk
+ATTACHMENTS_PER_MESSAGE = 10  # Discord's limit on attachments in one message
+MESSAGE_SIZE_LIMIT = int(os.getenv('MESSAGE_SIZE_LIMIT', 25 * 1024 * 1024))  # Discord's limit on the size of one message request
+PACK_FILE_LIMIT = 1000 * 1000  # Largest file packed together with others by -pack
 
 MAX_TERMINAL_WIDTH = 120
+PROGRESS_INTERVAL = 0.2  # Seconds between redraws of the progress bar
+PROGRESS_LOG_INTERVAL = int(os.getenv('PROGRESS_LOG_INTERVAL', 10))  # Seconds between progress lines when the output is not a terminal
 PADDING = 22
 SIZE_COLUMN_WIDTH = 10
 ID_COLUMN_WIDTH = 5
\ No newline at end of file
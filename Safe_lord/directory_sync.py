@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from index_management import load_file_index, get_file_index, update_file_index
+from file_operations import upload_file_chunks, upload_packed_files, delete_entry_messages
+from file_utils import encode, get_size_format
+from config import SYNC_MANIFEST_DIR, PACK_FILE_LIMIT
+
+READ_SIZE = 1024 * 1024  # Bytes read at a time while hashing a file
+
+
+def sync_directory(args):
+    """
+    Uploads the files of a directory that are new or changed since it was last synced.
+
+    A local manifest records the size, modification time and content hash of every synced
+    file. Files whose size and modification time still match it are skipped after a stat
+    alone; the others are hashed, and only those whose content differs are uploaded, each
+    as its own index entry that replaces the previous version. Files deleted since the last
+    sync are removed from the index. The chunks of replaced and deleted versions are deleted
+    once the index no longer refers to them.
+
+    Args:
+        args (list): The directory to sync, and "--dry-run" to only report the changes.
+    """
+    parser = argparse.ArgumentParser(prog="-sync", description="Uploads the new and changed files of a directory.")
+    parser.add_argument("directory", help="directory to sync")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be uploaded and removed")
+    try:
+        options = parser.parse_args(args)
+    except SystemExit:
+        return
+
+    directory = options.directory
+    if not os.path.isdir(directory):
+        print(f"Not a directory: {directory}")
+        return
+
+    index_message_id = load_file_index()
+    file_index = get_file_index()
+    manifest_path = get_manifest_path(directory)
+    manifest = load_manifest(manifest_path)
+    # Files keep their path below the directory's parent, as with -pack, e.g. "configs/app/settings.ini"
+    prefix = os.path.basename(os.path.normpath(os.path.abspath(directory)))
+
+    start = time.perf_counter()
+    current = scan_directory(directory)
+    changed = []  # (relative path, path, size, modification time, content hash) of every file to upload
+    unchanged = hashed = touched = 0
+    for relative, (path, stat) in current.items():
+        # A file missing from the index is uploaded again whatever the manifest says
+        known = manifest.get(relative) if encode(f"{prefix}/{relative}") in file_index else None
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            unchanged += 1
+            continue
+        try:
+            digest = hash_file(path)
+        except OSError as e:
+            print(f"Could not read {path}: {e}")
+            continue
+        hashed += 1
+        if known is not None and known[2] == digest:
+            # Only touched; the new modification time spares hashing it again next time
+            manifest[relative] = [stat.st_size, stat.st_mtime_ns, digest]
+            unchanged += 1
+            touched += 1
+            continue
+        changed.append((relative, path, stat.st_size, stat.st_mtime_ns, digest))
+    deleted = [relative for relative in manifest if relative not in current]
+    elapsed = time.perf_counter() - start
+    if touched and not options.dry_run:
+        save_manifest(manifest_path, directory, manifest)
+
+    added = sum(encode(f"{prefix}/{relative}") not in file_index for relative, *rest in changed)
+    print(f"Checked {len(current)} files in {elapsed:.1f}s ({hashed} hashed): {unchanged} unchanged, "
+          f"{added} new, {len(changed) - added} changed, {len(deleted)} deleted")
+    print(f"To upload: {get_size_format(sum(size for relative, path, size, *rest in changed))}")
+    if options.dry_run:
+        for relative, *rest in changed:
+            print(f"  upload {relative}")
+        for relative in deleted:
+            print(f"  remove {relative}")
+        return
+
+    start = time.perf_counter()
+    retired = []  # Entries of replaced and deleted versions, whose chunks are deleted at the end
+    synced = removed_files = failed = 0
+
+    def record(items):
+        # Files only go into the manifest once the index refers to their new version
+        for relative, path, size, mtime, digest in items:
+            manifest[relative] = [size, mtime, digest]
+        save_manifest(manifest_path, directory, manifest)
+
+    small = [item for item in changed if item[2] <= PACK_FILE_LIMIT]
+    if small:
+        names = [f"{prefix}/{relative}" for relative, *rest in small]
+        previous = [file_index[encode(name)] for name in names if encode(name) in file_index]
+        keys = upload_packed_files([(path, name) for (relative, path, *rest), name in zip(small, names)], file_index)
+        if keys is not None and update_file_index(index_message_id, file_index, keys):
+            retired.extend(previous)
+            record(small)
+            synced += len(small)
+        else:
+            failed += len(small)
+
+    for item in changed:
+        relative, path, size, mtime, digest = item
+        if size <= PACK_FILE_LIMIT:
+            continue
+        key = encode(f"{prefix}/{relative}")
+        previous = file_index.get(key)
+        uploaded = upload_file_chunks(path, f"{prefix}/{relative}", file_index)
+        if uploaded is None:
+            failed += 1
+            continue
+        entry, checkpoint = uploaded
+        file_index[key] = entry
+        if not update_file_index(index_message_id, file_index, [key]):
+            failed += 1
+            continue
+        checkpoint.discard()
+        if previous is not None:
+            retired.append(previous)
+        record([item])
+        synced += 1
+
+    if deleted:
+        removed = [key for key in (encode(f"{prefix}/{relative}") for relative in deleted) if key in file_index]
+        previous = [file_index.pop(key) for key in removed]
+        if not removed or update_file_index(index_message_id, file_index, removed):
+            retired.extend(previous)
+            for relative in deleted:
+                del manifest[relative]
+            save_manifest(manifest_path, directory, manifest)
+            removed_files = len(deleted)
+        else:
+            failed += len(deleted)
+
+    if retired:
+        # Unchanged files packed with an old version, or deduplicated against it, keep those messages
+        shared = {message_id for key in file_index for message_id in file_index.get_message_ids(key)}
+        print("Deleting replaced versions...")
+        gone = delete_entry_messages(retired, shared)
+        left = {message_id for entry in retired for message_id, attachment_id in entry["urls"]} - shared - gone
+        if left:
+            print(f"{len(left)} message(s) of replaced versions could not be deleted; -gc removes them later.")
+
+    elapsed = time.perf_counter() - start
+    print(f"Synced {synced} file(s) and {removed_files} deletion(s) in {elapsed:.1f}s")
+    if failed:
+        print(f"{failed} change(s) could not be synced; run the command again to retry them.")
+
+
+def scan_directory(directory):
+    """
+    Lists the files below a directory with their stat results, without reading them.
+
+    Parameters:
+        directory (str): The directory to scan.
+
+    Returns:
+        dict: Path relative to the directory, with "/" separators -> (path, os.stat_result).
+    """
+    files = {}
+    manifests = os.path.abspath(SYNC_MANIFEST_DIR)
+    for root, directories, names in os.walk(directory):
+        # Syncing the working directory must not pick up the manifests themselves
+        directories[:] = [name for name in directories if os.path.abspath(os.path.join(root, name)) != manifests]
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logging.warning(f"Could not stat {path}: {e}")
+                continue
+            files[os.path.relpath(path, directory).replace(os.sep, "/")] = (path, stat)
+    return files
+
+
+def hash_file(path):
+    """
+    Returns the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_manifest_path(directory):
+    """
+    Returns the path of the manifest of a synced directory, named after its absolute path.
+    """
+    digest = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+    return os.path.join(SYNC_MANIFEST_DIR, digest + ".json")
+
+
+def load_manifest(path):
+    """
+    Loads a directory's manifest.
+
+    Parameters:
+        path (str): Path of the manifest file.
+
+    Returns:
+        dict: Relative path -> [size, modification time in ns, content hash] of every synced file;
+            empty if the directory was never synced or the manifest is unreadable.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)["files"]
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Could not read sync manifest {path}, every file will be hashed: {e}")
+        return {}
+
+
+def save_manifest(path, directory, files):
+    """
+    Writes a directory's manifest, replacing the previous one in a single step.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps({"directory": os.path.abspath(directory), "files": files}))
+    os.replace(path + ".tmp", path)
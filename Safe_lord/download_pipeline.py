@@ -0,0 +1,359 @@
+import queue
+import logging
+import threading
+import urllib3
+import requests
+from chunking import hash_chunk
+from memory_budget import BufferPool
+from telemetry import telemetry
+from utils import resolve_attachment_urls, evict_attachment_url, fetch_message
+from transport import cdn_request
+from config import CHANNEL_ID, DOWNLOAD_WORKERS, DECODE_WORKERS, DOWNLOAD_QUEUE_DEPTH
+
+RESOLVE_BATCH = 100  # Chunks whose URLs are resolved together; adjacent chunks share a page of channel history
+READ_SIZE = 1024 ** 2  # Size of the pieces streamed from the CDN
+POLL_INTERVAL = 0.1  # Seconds a blocked stage waits before checking whether the pipeline was stopped
+_STOPPED = object()
+
+
+class DownloadPipeline:
+    """
+    Downloads chunks through stages that run side by side, joined by bounded queues.
+
+    A resolver thread looks up CDN URLs RESOLVE_BATCH chunks at a time, running ahead of the
+    transfers. Fetch workers download chunk payloads while decode workers decompress, decrypt
+    and verify earlier ones, and the calling thread writes the results to disk. A stage that
+    gets ahead blocks on its full queue, so at most (2 * depth + workers + decode_workers)
+    chunks are held in memory at once. Payloads are read with readinto() into buffers that
+    are reused once their chunk is written, and every chunk reserves the memory it needs in
+    the memory budget before it is fetched. Every stage records its steps as telemetry spans,
+    so a trace shows which one holds the others up. An error in any step fails only its
+    chunk, which still comes out of run() so the download never waits on a stage that died.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, decode_workers=DECODE_WORKERS, depth=DOWNLOAD_QUEUE_DEPTH):
+        """
+        :param workers: Chunks downloaded from the CDN concurrently.
+        :param decode_workers: Chunks decoded and verified concurrently.
+        :param depth: Chunks each queue between the download, decode and write stages holds.
+        """
+        self.workers = workers
+        self.decode_workers = decode_workers
+        self.resolved = queue.Queue(2 * RESOLVE_BATCH)  # Only URLs, so the next batch is resolved while one is fetched
+        self.fetched = queue.Queue(depth)
+        self.decoded = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.threads = []
+        self.pool = BufferPool()
+
+    def run(self, jobs):
+        """
+        Downloads chunks and writes them at their offsets in their files.
+
+        :param jobs: Dicts describing the chunks, in file order: the preallocated output "file", the chunk's
+            "offset" in it, its "message_id", "attachment_id" and "channel_id", and optionally "new_decoder"
+            (function returning a fresh ChunkDecoder) with the chunk's decoded "size", "hash" (content hash the
+            chunk must match) with its "hash_key" (see chunk_codec.get_chunk_hash_key) and "range" ((offset,
+            length) of a packed chunk within its attachment).
+        :return: Iterator of (job, success) pairs, yielded as the chunks are written.
+        """
+        if not jobs:
+            return
+        self._start(self._resolve, jobs)
+        for _ in range(self.workers):
+            self._start(self._fetch)
+        for _ in range(self.decode_workers):
+            self._start(self._decode)
+        try:
+            for _ in range(len(jobs)):
+                job, data, held = self._get(self.decoded)
+                with telemetry.span("download", "write", bytes=len(data) if data is not None else 0):
+                    success = data is not None and write_chunk(job, data)
+                self._free(*held)
+                yield job, success
+        finally:
+            # Workers are idle once every chunk came through, or are cut short if the caller gave up
+            self.stopped.set()
+            for stage, count in ((self.resolved, self.workers), (self.fetched, self.decode_workers)):
+                for _ in range(count):
+                    try:
+                        stage.put_nowait(_STOPPED)  # Wakes a worker waiting for input right away
+                    except queue.Full:
+                        break
+            for thread in self.threads:
+                thread.join()
+            # Chunks left in the queues by an abandoned run give their memory back
+            for stage in (self.fetched, self.decoded):
+                while not stage.empty():
+                    item = stage.get_nowait()
+                    if item is not _STOPPED:
+                        self._free(*item[-1])
+            self.pool.close()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _get(self, stage):
+        while not self.stopped.is_set():
+            try:
+                return stage.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _STOPPED
+
+    def _put(self, stage, item):
+        while not self.stopped.is_set():
+            try:
+                stage.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _resolve(self, jobs):
+        for start in range(0, len(jobs), RESOLVE_BATCH):
+            batch = jobs[start:start + RESOLVE_BATCH]
+            try:
+                with telemetry.span("download", "resolve", chunks=len(batch)):
+                    urls = resolve_attachment_urls([(job["message_id"], job["attachment_id"]) for job in batch],
+                                                   [job["channel_id"] for job in batch])
+            except Exception as e:
+                # The fetch workers look the chunks up one by one instead
+                logging.error(f"Could not resolve attachment URLs: {e}")
+                urls = {}
+            for job in batch:
+                if not self._put(self.resolved, (job, urls.get((str(job["message_id"]), str(job["attachment_id"]))))):
+                    return
+
+    def _free(self, buffer, extra):
+        if buffer is not None:
+            self.pool.give(buffer)
+        self.pool.release(extra)
+
+    def _attempt(self, step, job, function, *args):
+        """
+        Runs one step of a stage for a job, returning None instead of raising if it fails.
+        """
+        with telemetry.span("download", step, chunk=job.get("chunk")):
+            try:
+                return function(*args)
+            except Exception as e:
+                logging.error(f"Chunk at offset {job['offset']} failed to {step}: {e!r}")
+                return None
+
+    def _fetch(self):
+        while True:
+            item = self._get(self.resolved)
+            if item is _STOPPED:
+                return
+            job, download_url = item
+            fetched, fresh = self._attempt("fetch", job, fetch_job, job, download_url, self.pool) or (None, True)
+            payload, held = (fetched[0], fetched[1:]) if fetched is not None else (None, (None, 0))
+            if not self._put(self.fetched, (job, payload, fresh, held)):
+                self._free(*held)
+                return
+
+    def _decode(self):
+        while True:
+            item = self._get(self.fetched)
+            if item is _STOPPED:
+                return
+            job, payload, fresh, held = item
+            data = payload if payload is None else self._attempt("decode", job, decode_chunk, job, payload)
+            if data is None and payload is not None and not fresh:
+                # The cached URL may have served stale or damaged data, so the chunk is fetched once more from a fresh one
+                self._free(*held)
+                evict_attachment_url(job["message_id"], job["attachment_id"])
+                fetched, fresh = self._attempt("fetch", job, fetch_job, job, None, self.pool) or (None, True)
+                payload, held = (fetched[0], fetched[1:]) if fetched is not None else (None, (None, 0))
+                data = payload if payload is None else self._attempt("decode", job, decode_chunk, job, payload)
+            if data is None:
+                self._free(*held)
+                held = (None, 0)
+            elif not isinstance(data, memoryview):
+                # Decompressed or decrypted data is a copy, so the payload's buffer can be reused right away
+                buffer, extra = held
+                if buffer is not None:
+                    self.pool.give(buffer)
+                held = (None, extra)
+            if not self._put(self.decoded, (job, data, held)):
+                self._free(*held)
+                return
+
+
+def fetch_job(job, download_url, pool):
+    """
+    Downloads the payload of a pipeline job, looking its URL up again if the resolved one fails.
+
+    Parameters:
+        job (dict): The chunk, as passed to DownloadPipeline.run.
+        download_url (str): Resolved CDN URL of the chunk, or None to look it up.
+        pool (BufferPool): Pool the payload's buffer is taken from.
+
+    Returns:
+        tuple: The result of fetch_chunk(), and whether it came from a freshly looked up URL. Chunks that
+            are decoded also reserve room for their decoded size along with the payload.
+    """
+    extra = job.get("size", 0) if job.get("new_decoder") is not None else 0
+    if download_url:
+        fetched = fetch_chunk(download_url, job.get("range"), pool, extra)
+        if fetched is not None:
+            return fetched, False
+        # The CDN rejected the cached URL, so fetch the chunk again from a fresh URL
+        evict_attachment_url(job["message_id"], job["attachment_id"])
+
+    download_url = get_attachment_url(job["message_id"], job["attachment_id"], job["channel_id"])
+    if download_url is None:
+        return None, True
+    return fetch_chunk(download_url, job.get("range"), pool, extra), True
+
+
+def fetch_chunk(download_url, byte_range, pool, extra=0):
+    """
+    Downloads a chunk's stored payload from the CDN with readinto() into a preallocated buffer.
+
+    The buffer is sized from the response's Content-Length and taken from the pool once
+    the headers arrive, so the body never passes through intermediate copies.
+
+    Parameters:
+        download_url (str): CDN URL of the chunk's attachment.
+        byte_range (tuple): (offset, length) of the chunk within the attachment for packed files, or None for all of it.
+        pool (BufferPool): Pool the buffer is taken from.
+        extra (int): Further bytes to reserve along with the buffer, e.g. for the decoded chunk.
+
+    Returns:
+        tuple: The payload as a memoryview, its buffer and the extra bytes reserved, both to give back
+            to the pool once the payload is no longer needed; None if it could not be downloaded.
+    """
+    if byte_range is not None and not byte_range[1]:
+        pool.budget.acquire(extra)
+        return memoryview(b""), None, extra  # An empty packed file has nothing to fetch
+    buffer = None
+    try:
+        with cdn_request(download_url, byte_range) as response:
+            response.raise_for_status()
+            # The server may ignore the Range header and send the whole attachment
+            skip = byte_range[0] if byte_range is not None and response.status_code != 206 else 0
+            length = byte_range[1] if byte_range is not None else int(response.headers.get("Content-Length", -1))
+            if length < 0 or response.headers.get("Content-Encoding", "identity") != "identity":
+                # Without a known length the body is collected as it arrives instead
+                pieces = response.iter_content(chunk_size=READ_SIZE)
+                if skip:
+                    pieces = slice_stream(pieces, *byte_range)
+                data = b"".join(pieces)
+                buffer = pool.take(len(data), extra)
+                buffer[:len(data)] = data
+                return memoryview(buffer)[:len(data)], buffer, extra
+
+            buffer = pool.take(length, extra)
+            while skip:
+                skipped = len(response.raw.read(min(skip, READ_SIZE)))
+                if not skipped:
+                    break
+                skip -= skipped
+            view = memoryview(buffer)[:length]
+            filled = 0
+            while not skip and filled < length:
+                count = response.raw.readinto(view[filled:filled + READ_SIZE])
+                if not count:
+                    break
+                filled += count
+            if filled < length:
+                raise requests.exceptions.ChunkedEncodingError(f"Connection closed after {filled} of {length} bytes")
+            return view, buffer, extra
+    except Exception as req_err:
+        if buffer is not None:
+            pool.give(buffer)
+            pool.release(extra)
+        if not isinstance(req_err, (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError)):
+            raise
+        logging.error(f"Request error: {req_err}")
+        return None
+
+
+def decode_chunk(job, payload):
+    """
+    Turns a chunk's stored payload back into file data and verifies it.
+
+    Returns:
+        bytes: The chunk's data, or None if it could not be decoded or does not match its hash.
+    """
+    data = payload
+    if job.get("new_decoder") is not None:
+        decoder = job["new_decoder"]()
+        data = decode_piece(decoder.update, payload, job["offset"])
+        rest = data is not None and decode_piece(decoder.finish, None, job["offset"])
+        if data is None or rest is None:
+            return None
+        if rest:
+            data = data + rest if data else rest
+
+    if job.get("hash") and hash_chunk(data, job.get("hash_key")) != job["hash"]:
+        logging.error(f"Chunk at offset {job['offset']} failed verification")
+        return None
+    return data
+
+
+def write_chunk(job, data):
+    """
+    Writes a chunk's data at its offset in its output file.
+
+    Returns:
+        bool: Whether the data was written.
+    """
+    try:
+        job["file"].seek(job["offset"])
+        job["file"].write(data)
+        return True
+    except OSError as write_error:
+        logging.error(f"Error writing chunk: {write_error}")
+        return False
+
+
+def get_attachment_url(message_id, attachment_id, channel_id=CHANNEL_ID):
+    """
+    Looks up a fresh CDN URL for an attachment by fetching its message.
+
+    Returns:
+        str: The URL, or None if the message or attachment could not be found.
+    """
+    response = fetch_message(message_id, channel_id)
+    if not response:
+        return None
+
+    attachment = next((a for a in response['attachments'] if str(a['id']) == str(attachment_id)), None)
+    if attachment is None:
+        logging.error(f"Attachment {attachment_id} not found in message {message_id}")
+        return None
+    return attachment['url']
+
+
+def slice_stream(pieces, start, length):
+    """
+    Yields the `length` bytes starting at `start` of a stream of byte strings.
+    """
+    for piece in pieces:
+        if start >= len(piece):
+            start -= len(piece)
+            continue
+        piece = piece[start:start + length]
+        start = 0
+        length -= len(piece)
+        yield piece
+        if not length:
+            return
+
+
+def decode_piece(function, data, offset):
+    """
+    Runs a ChunkDecoder step, logging a payload that fails to decrypt or decompress.
+
+    :return: The decoded data, or None if the payload could not be decoded.
+    """
+    try:
+        return function(data) if data is not None else function()
+    except Exception as decode_error:
+        logging.error(f"Chunk at offset {offset} could not be decoded: {decode_error!r}")
+        return None
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import base64
+import hashlib
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+from config import ENCRYPTION_KEY, CHUNK_SIZE, UPLOAD_WORKERS
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # Only needed when ENCRYPTION_KEY is set
+    AESGCM = None
+
+NONCE_SIZE = 12
+
+
+def load_key(value=ENCRYPTION_KEY):
+    """
+    Decodes a 256-bit key given as 64 hex digits or as base64.
+
+    Parameters:
+    value (str): The encoded key, usually ENCRYPTION_KEY.
+
+    Returns:
+    bytes: The key, or None if no key is configured.
+    """
+    if not value:
+        return None
+    try:
+        key = bytes.fromhex(value) if len(value) == 64 else base64.urlsafe_b64decode(value)
+    except (ValueError, binascii.Error):
+        key = b""
+    if len(key) != 32:
+        raise ValueError("ENCRYPTION_KEY must be 32 bytes, given as 64 hex digits or base64")
+    return key
+
+
+def get_key_id(key):
+    """
+    Returns a short identifier of a key that can be stored in the index without revealing it.
+    """
+    return hashlib.sha256(b"key-id" + key).hexdigest()[:16]
+
+
+def get_hash_key(key):
+    """
+    Derives the key of the HMAC that hashes the chunks of encrypted files from the encryption key.
+    """
+    return hashlib.sha256(b"chunk-hash" + key).digest()
+
+
+def get_cipher(key):
+    if AESGCM is None:
+        sys.exit("Encryption needs the 'cryptography' package: pip install cryptography")
+    return AESGCM(key)
+
+
+def encrypt_chunk(chunk, key):
+    """
+    Encrypts one chunk with AES-256-GCM under a fresh random nonce.
+
+    Parameters:
+    chunk (bytes): Plaintext chunk.
+    key (bytes): The encryption key.
+
+    Returns:
+    tuple: The ciphertext (with its 16-byte authentication tag) and the nonce as hex.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    return get_cipher(key).encrypt(nonce, chunk, None), nonce.hex()
+
+
+def decrypt_chunk(data, nonce, key):
+    """
+    Decrypts and authenticates one chunk.
+
+    Parameters:
+    data (bytes): Ciphertext as stored in the attachment.
+    nonce (str): The chunk's nonce as hex, from the index.
+    key (bytes): The encryption key.
+
+    Returns:
+    bytes: The plaintext chunk. Raises cryptography's InvalidTag if the data was altered.
+    """
+    return get_cipher(key).decrypt(bytes.fromhex(nonce), data, None)
+
+
+def benchmark_encryption(total_size=256 * 1000 * 1000, workers=UPLOAD_WORKERS):
+    """
+    Measures chunk encryption and decryption throughput against a plain copy of the same data.
+
+    Chunks are processed on a thread pool like the upload and download workers do; AES-GCM
+    releases the GIL, so throughput scales with cores.
+
+    Parameters:
+    total_size (int): Bytes to process.
+    workers (int): Number of threads.
+
+    Returns:
+    dict: Throughput in MB/s for "plaintext", "encrypt" and "decrypt".
+    """
+    key = os.urandom(32)
+    chunk = os.urandom(CHUNK_SIZE)
+    count = max(1, total_size // CHUNK_SIZE)
+    encrypted = encrypt_chunk(chunk, key)
+
+    def measure(function):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda _: function(), range(count)))
+        return count * CHUNK_SIZE / (time.perf_counter() - start) / 1000**2
+
+    return {
+        "plaintext": measure(lambda: bytes(bytearray(chunk))),
+        "encrypt": measure(lambda: encrypt_chunk(chunk, key)),
+        "decrypt": measure(lambda: decrypt_chunk(*encrypted, key)),
+    }
+
+
+if __name__ == "__main__":
+    for name, rate in benchmark_encryption().items():
+        print(f"{name:<10} {rate:10.1f} MB/s")
@@ -0,0 +1,365 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DISCORD_EPOCH = 1420070400000
+MAX_ATTACHMENTS = 10
+PIECE_SIZE = 64 * 1024  # Bodies are read and written in pieces of this size so bandwidth can be throttled
+
+
+class FakeDiscord:
+    """
+    Local stand-in for the Discord channel message, attachment and CDN endpoints.
+
+    Point the client at it by setting DISCORD_API_BASE to `api_base` before config is
+    imported. Messages live in memory; attachment URLs point back at this server's /cdn/
+    route, which supports Range requests and carries an ex= expiry like Discord's signed URLs.
+
+    Args:
+        latency (float): Seconds added to every request.
+        bandwidth (float): Bytes per second per connection for request and response bodies, or None for no limit.
+        rate_limit (tuple): (requests, seconds) allowed per route and channel before answering 429, or None for no limit.
+        fail_rate (float): Share of API requests answered with an injected 429.
+        max_attachment_size (int): Largest attachment accepted; larger ones are answered with 413.
+        max_request_size (int): Largest message request accepted; larger ones are answered with 413.
+        url_lifetime (int): Seconds until attachment URLs expire.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, rate_limit=None, fail_rate=0.0,
+                 max_attachment_size=25 * 1024 * 1024, max_request_size=25 * 1024 * 1024, url_lifetime=86400):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.fail_rate = fail_rate
+        self.max_attachment_size = max_attachment_size
+        self.max_request_size = max_request_size
+        self.url_lifetime = url_lifetime
+        self.messages = {}  # Channel ID -> {message ID: message}
+        self.attachments = {}  # Attachment ID -> bytes
+        self.buckets = {}  # Route -> (window start, requests in window)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.server = None
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server.server_port}/api/v9/channels/"
+
+    def start(self, port=0):
+        """
+        Starts serving on localhost in a background thread.
+
+        :param port: Port to listen on; a free one by default.
+        :return: The base URL of the channels API, for DISCORD_API_BASE.
+        """
+        fake = self
+
+        class Handler(RequestHandler):
+            server_state = fake
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.api_base
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def new_id(self):
+        """
+        Returns a new snowflake, so IDs sort by creation time like Discord's.
+        """
+        return str(((int(time.time() * 1000) - DISCORD_EPOCH) << 22) + next(self.ids) % (1 << 22))
+
+    def take_request(self, route):
+        """
+        Counts a request against its route's bucket.
+
+        :return: Tuple of the rate-limit headers to send and the seconds to wait if the request
+            is rejected with 429, else None.
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.rate_limit is None:
+                return {"X-RateLimit-Limit": "1000", "X-RateLimit-Remaining": "1000", "X-RateLimit-Reset-After": "0.001",
+                        "X-RateLimit-Bucket": route}, None
+
+            limit, period = self.rate_limit
+            now = time.monotonic()
+            start, count = self.buckets.get(route, (now, 0))
+            if now - start >= period:
+                start, count = now, 0
+            reset_after = max(0.001, period - (now - start))
+            headers = {"X-RateLimit-Limit": str(limit), "X-RateLimit-Bucket": route,
+                       "X-RateLimit-Reset-After": f"{reset_after:.3f}"}
+            if count >= limit:
+                self.stats["rate_limited"] += 1
+                headers["X-RateLimit-Remaining"] = "0"
+                return headers, reset_after
+            self.buckets[route] = (start, count + 1)
+            headers["X-RateLimit-Remaining"] = str(limit - count - 1)
+            return headers, None
+
+    def post_message(self, channel_id, host, content, files):
+        """
+        Stores a message with its attachments.
+
+        :param files: List of (filename, bytes); the filenames are sanitized as Discord does.
+        :return: The message object.
+        """
+        attachments = []
+        for filename, data in files:
+            filename = sanitize_filename(filename)
+            attachment_id = self.new_id()
+            expiry = int(time.time()) + self.url_lifetime
+            attachments.append({
+                "id": attachment_id,
+                "filename": filename,
+                "size": len(data),
+                "url": f"http://{host}/cdn/{channel_id}/{attachment_id}/{filename}?ex={expiry:x}&is={int(time.time()):x}&hm=0",
+            })
+            with self.lock:
+                self.attachments[attachment_id] = data
+
+        message = {"id": self.new_id(), "channel_id": channel_id, "content": content, "attachments": attachments}
+        with self.lock:
+            self.messages.setdefault(channel_id, {})[message["id"]] = message
+        return message
+
+    def list_messages(self, channel_id, limit=50, before=None, after=None):
+        """
+        Lists messages newest first, like GET /channels/{id}/messages.
+        """
+        with self.lock:
+            ids = sorted(self.messages.get(channel_id, {}), key=int, reverse=True)
+            if before is not None:
+                ids = [message_id for message_id in ids if int(message_id) < int(before)]
+            if after is not None:
+                ids = [message_id for message_id in ids if int(message_id) > int(after)][-limit:]
+            return [self.messages[channel_id][message_id] for message_id in ids[:limit]]
+
+    def delete_messages(self, channel_id, message_ids):
+        """
+        :return: Number of messages that existed and were deleted.
+        """
+        deleted = 0
+        with self.lock:
+            channel = self.messages.get(channel_id, {})
+            for message_id in message_ids:
+                message = channel.pop(message_id, None)
+                if message is not None:
+                    deleted += 1
+                    for attachment in message["attachments"]:
+                        self.attachments.pop(attachment["id"], None)
+        return deleted
+
+
+def sanitize_filename(filename):
+    """
+    Turns spaces into underscores and drops the characters Discord strips from attachment filenames.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]", "", filename.replace(" ", "_")) or "unknown"
+
+
+def parse_multipart(body, content_type):
+    """
+    Splits a multipart/form-data body into its parts.
+
+    :return: List of (field name, filename or None, bytes) for every part.
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = []
+    for part in body.split(b"--" + boundary)[1:-1]:
+        head, separator, data = part.partition(b"\r\n\r\n")
+        disposition = next((line for line in head.decode("utf-8", "replace").split("\r\n")
+                            if line.lower().startswith("content-disposition")), "")
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        parts.append((name and name.group(1), filename and filename.group(1), data[:-2]))  # Drop the CRLF before the boundary
+    return parts
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None  # The FakeDiscord the handler serves, set by FakeDiscord.start()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        fake = self.server_state
+        path = urlparse(self.path).path
+        query = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+        body = self.read_body()
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        cdn = re.match(r"^/cdn/(\d+)/(\d+)/", path)
+        if cdn and method == "GET":
+            return self.send_attachment(cdn.group(2), query)
+
+        routes = [
+            ("POST", r"^/api/v9/channels/(\d+)/messages/bulk-delete$", self.bulk_delete),
+            ("POST", r"^/api/v9/channels/(\d+)/messages$", self.create_message),
+            ("GET", r"^/api/v9/channels/(\d+)/messages$", self.get_messages),
+            ("GET", r"^/api/v9/channels/(\d+)/messages/(\d+)$", self.get_message),
+            ("DELETE", r"^/api/v9/channels/(\d+)/messages/(\d+)$", self.delete_message),
+        ]
+        for route_method, pattern, function in routes:
+            match = re.match(pattern, path)
+            if route_method != method or not match:
+                continue
+
+            # Bucketed per channel like Discord's major parameter
+            headers, retry_after = fake.take_request(f"{method} {pattern}:{match.group(1)}")
+            if retry_after is None and fake.fail_rate and random.random() < fake.fail_rate:
+                fake.stats["injected_429"] += 1
+                retry_after = 0.05
+            if retry_after is not None:
+                headers["Retry-After"] = f"{retry_after:.3f}"
+                return self.send_json(429, {"message": "You are being rate limited.", "retry_after": retry_after,
+                                            "global": False}, headers)
+            fake.stats[f"{method} {function.__name__}"] += 1
+            status, response = function(body, query, *match.groups())
+            return self.send_json(status, response, headers)
+
+        self.send_json(404, {"message": "404: Not Found", "code": 0})
+
+    def create_message(self, body, query, channel_id):
+        fake = self.server_state
+        if len(body) > fake.max_request_size:
+            return 413, {"message": "Request entity too large", "code": 40005}
+
+        content = ""
+        files = []
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            for name, filename, data in parse_multipart(body, content_type):
+                if filename is not None:
+                    files.append((filename, data))
+                elif name == "payload_json":
+                    content = json.loads(data).get("content", "")
+                elif name == "content":
+                    content = data.decode()
+        elif body:
+            content = json.loads(body).get("content", "")
+
+        if len(files) > MAX_ATTACHMENTS:
+            return 400, {"message": "Invalid Form Body", "code": 50035}
+        if any(len(data) > fake.max_attachment_size for filename, data in files):
+            return 413, {"message": "Request entity too large", "code": 40005}
+        fake.stats["bytes_uploaded"] += sum(len(data) for filename, data in files)
+        return 200, fake.post_message(channel_id, self.headers.get("Host"), content, files)
+
+    def get_messages(self, body, query, channel_id):
+        limit = min(100, int(query.get("limit", 50)))
+        return 200, self.server_state.list_messages(channel_id, limit, query.get("before"), query.get("after"))
+
+    def get_message(self, body, query, channel_id, message_id):
+        message = self.server_state.messages.get(channel_id, {}).get(message_id)
+        if message is None:
+            return 404, {"message": "Unknown Message", "code": 10008}
+        return 200, message
+
+    def delete_message(self, body, query, channel_id, message_id):
+        if not self.server_state.delete_messages(channel_id, [message_id]):
+            return 404, {"message": "Unknown Message", "code": 10008}
+        return 204, None
+
+    def bulk_delete(self, body, query, channel_id):
+        message_ids = json.loads(body).get("messages", [])
+        if not 2 <= len(message_ids) <= 100:
+            return 400, {"message": "Invalid Form Body", "code": 50035}
+        self.server_state.delete_messages(channel_id, message_ids)
+        return 204, None
+
+    def send_attachment(self, attachment_id, query):
+        fake = self.server_state
+        fake.stats["cdn_requests"] += 1
+        data = fake.attachments.get(attachment_id)
+        if data is None or int(query.get("ex", "0"), 16) < time.time():
+            return self.send_bytes(404 if data is None else 403, b"")
+
+        byte_range = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if byte_range:
+            start = int(byte_range.group(1))
+            end = min(int(byte_range.group(2)) if byte_range.group(2) else len(data) - 1, len(data) - 1)
+            fake.stats["bytes_downloaded"] += end + 1 - start
+            return self.send_bytes(206, data[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+        fake.stats["bytes_downloaded"] += len(data)
+        self.send_bytes(200, data)
+
+    def read_body(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        pieces = []
+        while remaining:
+            piece = self.rfile.read(min(PIECE_SIZE, remaining))
+            if not piece:
+                break
+            pieces.append(piece)
+            remaining -= len(piece)
+            self.throttle(len(piece))
+        return b"".join(pieces)
+
+    def send_json(self, status, response, headers=None):
+        self.send_bytes(status, b"" if response is None else json.dumps(response).encode(),
+                        {"Content-Type": "application/json", **(headers or {})})
+
+    def send_bytes(self, status, data, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        for start in range(0, len(data), PIECE_SIZE):
+            self.wfile.write(data[start:start + PIECE_SIZE])
+            self.throttle(min(PIECE_SIZE, len(data) - start))
+
+    def throttle(self, size):
+        if self.server_state.bandwidth:
+            time.sleep(size / self.server_state.bandwidth)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the Discord API. "
+                                                 "Set DISCORD_API_BASE to the printed URL to use it.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per connection")
+    parser.add_argument("--rate-limit", type=int, nargs=2, metavar=("REQUESTS", "SECONDS"), default=None)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 429")
+    args = parser.parse_args()
+
+    fake = FakeDiscord(args.latency, args.bandwidth, args.rate_limit, args.fail_rate)
+    print(f"DISCORD_API_BASE={fake.start(args.port)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
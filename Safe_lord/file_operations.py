@@ -1,15 +1,34 @@
 import os
+import re
 import sys
-import io
 import logging
 import requests
 import zipfile
 import time
-from time import sleep
+import threading
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from index_management import load_file_index, get_file_index, update_file_index
-from utils import show_progress_bar, print_table_header, print_table_row, print_summary_line, get_total_chunks, fetch_message
-from file_utils import encode, decode, get_size_format
-from config import MAX_TERMINAL_WIDTH, CHANNEL_ID, BASE_URL, headers, CHUNK_SIZE
+from utils import show_progress_bar, print_table_header, print_table_row, print_summary_line, get_total_chunks
+from utils import evict_attachment_url, get_chunk_offsets, get_chunk_channels, delete_messages
+from chunking import content_defined_chunks, hash_chunk, new_chunk_hash
+from checkpoints import Checkpoint
+from download_pipeline import DownloadPipeline, get_attachment_url, slice_stream, decode_piece
+from search_index import load_search_index
+from chunk_codec import get_upload_transform, get_download_decoder, get_chunk_hash_key, CHUNK_FIELDS
+from compression import estimate_input_size
+from file_utils import encode, decode, get_size_format, parse_size, parse_date
+from transport import api_request, cdn_request, MultipartBody
+from memory_budget import memory_budget, BufferPool
+from telemetry import telemetry
+from stripes import stripes
+from config import MAX_TERMINAL_WIDTH, CHANNEL_ID, BASE_URL, CHUNK_SIZE, UPLOAD_WORKERS, MAX_RETRIES
+from config import STREAM_DIRECTORIES, CONTENT_DEFINED_CHUNKING, COMPRESSION, COMPRESSION_LEVEL
+from config import ATTACHMENTS_PER_MESSAGE, MESSAGE_SIZE_LIMIT, PACK_FILE_LIMIT
+
+# Value of a per-chunk index field for chunks stored before the field was recorded
+CHUNK_FIELD_DEFAULTS = {"codecs": "raw", "channels": CHANNEL_ID}
 
 
 def list_files(args):
@@ -29,14 +48,15 @@ def list_files(args):
     formatting, maxwidth = print_table_header()
     total_size = 0
 
-    for i, values in enumerate(file_index.values()):
+    # Keys are the encoded filenames, so the entries themselves are never decoded
+    for i, key in enumerate(file_index):
         try:
-            filename = decode(values["filename"])
+            filename = decode(key)
         except Exception as e:
             print(f"Error decoding filename: {e}")
             continue
 
-        size = values.get("size", 0)
+        size = file_index.get_size(key)
         total_size += size
         print_table_row(i + 1, filename, size, formatting, maxwidth)
 
@@ -45,24 +65,42 @@ def list_files(args):
 
 def find_file(args):
     """
-    Searches for files in the file index that match the given search terms.
+    Searches for files in the file index that match the given search terms and filters.
+
+    Plain terms are matched as a case-insensitive substring of the filename. The search
+    runs on the local trigram index of search_index.py, which is only updated when the
+    file index changed.
 
     Args:
-        args (list): The search terms as a list of strings.
+        args (list): The search terms, optionally with --glob PATTERN, --regex PATTERN,
+            --min-size/--max-size SIZE (e.g. 10MB) and --after/--before DATE (e.g. 2024-05-01).
     """
+    parser = argparse.ArgumentParser(prog="-f", description="Finds files by name, size and upload date.")
+    parser.add_argument("terms", nargs="*", help="text the filename contains")
+    parser.add_argument("--glob", help="pattern the whole filename matches, e.g. *.zip")
+    parser.add_argument("--regex", help="regular expression found in the filename")
+    parser.add_argument("--min-size", type=parse_size)
+    parser.add_argument("--max-size", type=parse_size)
+    parser.add_argument("--after", type=parse_date, help="uploaded on or after this date")
+    parser.add_argument("--before", type=parse_date, help="uploaded before this date")
+    try:
+        options = parser.parse_args(args)
+    except SystemExit:
+        return  # argparse already printed the problem
+
     try:
         load_file_index()
-        file_index = get_file_index()
+        search_index = load_search_index()
     except Exception as e:
         print(f"Error accessing file index: {e}")
         return
 
-    search_term = " ".join(args).lower()
-    results = [
-        (i + 1, decode(values["filename"]).lower(), values["size"])
-        for i, values in enumerate(file_index.values())
-        if search_term in decode(values["filename"]).lower()
-    ]
+    try:
+        results = search_index.search(" ".join(options.terms), options.glob, options.regex,
+                                       options.min_size, options.max_size, options.after, options.before)
+    except re.error as e:
+        print(f"Invalid regular expression: {e}")
+        return
 
     if results:
         formatting, maxwidth = print_table_header()
@@ -77,42 +115,236 @@ def upload_file(args):
     file_index = get_file_index()
 
     def upload_single_file(file_path, message_id, file_index):
-        size = os.path.getsize(file_path)
         filename = os.path.basename(file_path)
-        total_chunks = get_total_chunks(size)
+
+        if encode(filename) in file_index:
+            logging.info("File already uploaded.")
+            return
+
+        uploaded = upload_file_chunks(file_path, filename, file_index)
+        if uploaded is None:
+            return
+        entry, checkpoint = uploaded
+        file_index[encode(filename)] = entry
+        update_file_index(message_id, file_index, [encode(filename)])
+        checkpoint.discard()
+
+    def upload_directory_stream(directory_path, message_id, file_index):
+        filename = os.path.basename(os.path.normpath(directory_path)) + ".zip"
 
         if encode(filename) in file_index:
             logging.info("File already uploaded.")
             return
 
         logging.info(f"File Name: {filename}")
-        logging.info(f"File Size: {get_size_format(size)}")
-        logging.info(f"Chunks to be created: {total_chunks}")
-        logging.info("Uploading...")
 
-        # Assume upload_chunks is a function that handles the upload
-        urls = upload_chunks(f, filename, total_chunks)
+        transform, file_fields = get_upload_transform()
 
+        # The archive is rebuilt byte for byte as long as no file in the directory changed
+        checkpoint = Checkpoint("upload", os.path.abspath(directory_path), get_directory_fingerprint(directory_path), CHUNK_SIZE,
+                                COMPRESSION, COMPRESSION_LEVEL, file_fields)
+        if checkpoint:
+            logging.info(f"Resuming upload, {len(checkpoint)} chunks already uploaded")
+        logging.info("Compressing and uploading...")
+
+        # Chunks are uploaded while later members are still being compressed, without an archive on disk
+        try:
+            with ChunkUploader(filename, checkpoint=checkpoint, transform=transform) as uploader:
+                writer = ChunkWriter(uploader)
+                write_directory_zip(directory_path, writer)
+                writer.close()
+                urls = uploader.finish()
+                chunk_fields = uploader.get_chunk_fields()
+        except requests.RequestException as e:
+            logging.error(f"Upload failed: {e}. Run the same command again to resume.")
+            return
+
+        logging.info(f"File Size: {get_size_format(writer.size)}")
         logging.info("File uploaded")
 
         file_index[encode(filename)] = {
             "filename": encode(filename),
-            "size": size,
+            "size": writer.size,
             "urls": urls,
+            **file_fields,
+            **chunk_fields,
         }
-        update_file_index(message_id, file_index)
+        update_file_index(message_id, file_index, [encode(filename)])
+        checkpoint.discard()
 
     if os.path.isfile(path):
-        with open(path, "rb") as f:
-            upload_single_file(path, message_id, file_index)
+        upload_single_file(path, message_id, file_index)
+    elif os.path.isdir(path) and STREAM_DIRECTORIES:
+        upload_directory_stream(path, message_id, file_index)
     elif os.path.isdir(path):
         compressed_file_path = compress_directory(path)
-        with open(compressed_file_path, "rb") as f:
-            upload_single_file(compressed_file_path, message_id, file_index)
+        upload_single_file(compressed_file_path, message_id, file_index)
     else:
         logging.error("Invalid path. Please provide a valid file or directory path.")
         sys.exit()
 
+def upload_file_chunks(file_path, filename, file_index):
+    """
+    Uploads the chunks of one file, resuming an interrupted upload of it.
+
+    Args:
+        file_path (str): Path of the file to upload.
+        filename (str): Name the file is stored under.
+        file_index (dict): The current file index, whose chunks are reused with content-defined chunking.
+
+    Returns:
+        tuple: The file's index entry and its upload checkpoint, to discard once the entry is in the
+            index, or None if the upload failed.
+    """
+    size = os.path.getsize(file_path)
+    total_chunks = get_total_chunks(size)
+
+    logging.info(f"File Name: {filename}")
+    logging.info(f"File Size: {get_size_format(size)}")
+
+    transform, file_fields = get_upload_transform(content_fields=not CONTENT_DEFINED_CHUNKING)
+
+    # Chunks posted by an interrupted run of the same upload are reused instead of sent again
+    stat = os.stat(file_path)
+    checkpoint = Checkpoint("upload", os.path.abspath(file_path), size, stat.st_mtime_ns, CONTENT_DEFINED_CHUNKING, CHUNK_SIZE,
+                            COMPRESSION, COMPRESSION_LEVEL, file_fields)
+    if checkpoint:
+        logging.info(f"Resuming upload, {len(checkpoint)} chunks already uploaded")
+    logging.info("Uploading...")
+
+    try:
+        with open(file_path, "rb") as f:
+            if CONTENT_DEFINED_CHUNKING:
+                entry = upload_chunks_deduplicated(f, filename, file_index, checkpoint=checkpoint,
+                                                   transform=transform, file_fields=file_fields)
+            elif COMPRESSION != "none":
+                # Compressible input is packed into fewer chunks, so the count is only known at the end
+                logging.info(f"Chunks to be created: at most {total_chunks}")
+                entry = upload_chunks(f, filename, None, checkpoint=checkpoint, transform=transform, grow_chunks=True)
+            else:
+                logging.info(f"Chunks to be created: {total_chunks}")
+                # Assume upload_chunks is a function that handles the upload
+                entry = upload_chunks(f, filename, total_chunks, checkpoint=checkpoint, transform=transform)
+    except requests.RequestException as e:
+        logging.error(f"Upload failed: {e}. Run the same command again to resume.")
+        return None
+
+    logging.info("File uploaded")
+
+    return {
+        "filename": encode(filename),
+        "size": size,
+        **file_fields,
+        **entry,
+    }, checkpoint
+
+def pack_files(args):
+    """
+    Uploads many small files packed together into shared chunks.
+
+    Every file is transformed (compressed, encrypted) on its own and appended to a pack of
+    up to CHUNK_SIZE bytes. Its index entry points at its byte range in the pack, so it is
+    downloaded with an HTTP Range request instead of fetching the whole pack, and all packed
+    files are added to the index in a single update. Files larger than PACK_FILE_LIMIT are
+    uploaded on their own.
+
+    Args:
+        args (list): Paths of the files or directories to upload.
+    """
+    message_id = load_file_index()
+    file_index = get_file_index()
+
+    small_files = []
+    large_files = []
+    for path in args:
+        if os.path.isfile(path):
+            candidates = [(path, os.path.basename(path))]
+        elif os.path.isdir(path):
+            # Files in a directory keep their path below the directory's parent, e.g. "configs/app/settings.ini"
+            parent = os.path.dirname(os.path.abspath(path))
+            candidates = [(os.path.join(root, name), os.path.relpath(os.path.abspath(os.path.join(root, name)), parent))
+                          for root, directories, files in os.walk(path) for name in files]
+        else:
+            logging.error(f"Invalid path: {path}")
+            continue
+
+        for file_path, filename in candidates:
+            filename = filename.replace(os.sep, "/")
+            if encode(filename) in file_index:
+                logging.info(f"{filename} already uploaded.")
+            elif os.path.getsize(file_path) > PACK_FILE_LIMIT:
+                large_files.append((file_path, filename))
+            else:
+                small_files.append((file_path, filename))
+
+    if small_files:
+        keys = upload_packed_files(small_files, file_index)
+        if keys is None:
+            return
+        update_file_index(message_id, file_index, keys)
+
+    # Stored under the same relative name as the packed files, so a second run recognises them too
+    for file_path, filename in large_files:
+        uploaded = upload_file_chunks(file_path, filename, file_index)
+        if uploaded is None:
+            continue
+        entry, checkpoint = uploaded
+        file_index[encode(filename)] = entry
+        if update_file_index(message_id, file_index, [encode(filename)]):
+            checkpoint.discard()
+
+def upload_packed_files(small_files, file_index):
+    """
+    Uploads small files packed together into shared chunks and adds their entries to the file index.
+
+    Args:
+        small_files (list): (path, name to store it under) of every file, none larger than PACK_FILE_LIMIT.
+        file_index (dict): The file index the entries are added to, replacing entries of the same name.
+
+    Returns:
+        list: Keys of the added entries, or None if the upload failed and nothing was added.
+    """
+    logging.info(f"Packing {len(small_files)} files...")
+    transform, file_fields = get_upload_transform()
+    packed = []  # (filename, size, pack number, offset, length, per-chunk fields) of every file
+    packs = 0
+    try:
+        with ChunkUploader("pack") as uploader:
+            pack = bytearray()
+            for n, (file_path, filename) in enumerate(small_files, 1):
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                # Files are smaller than an attachment, so each one comes back as a single piece
+                payload, fields = transform(data)[0] if transform is not None else (data, {})
+                if pack and len(pack) + len(payload) > CHUNK_SIZE:
+                    uploader.submit(pack)
+                    packs += 1
+                    pack = bytearray()
+                packed.append((filename, len(data), packs, len(pack), len(payload), fields))
+                pack += payload
+                show_progress_bar(n, len(small_files))
+            if pack:
+                uploader.submit(pack)
+                packs += 1
+            uploader.finish()
+            pack_pieces = [uploader.get_pieces(number)[0] for number in range(packs)]
+    except requests.RequestException as e:
+        logging.error(f"Upload failed: {e}")
+        return None
+
+    for filename, size, number, offset, length, fields in packed:
+        pair, pack_fields = pack_pieces[number]
+        file_index[encode(filename)] = {
+            "filename": encode(filename),
+            "size": size,
+            "urls": [pair],
+            "ranges": [[offset, length]],
+            **file_fields,
+            **{name: [value] for name, value in {**fields, **pack_fields}.items()},
+        }
+    logging.info(f"Uploaded {len(packed)} files in {packs} pack(s)")
+    return [encode(filename) for filename, *rest in packed]
+
 def compress_directory(directory_path):
     try:
         if not os.path.isdir(directory_path):
@@ -122,22 +354,7 @@ def compress_directory(directory_path):
         output_filename = os.path.basename(directory_path) + '.zip'
         archive_path = os.path.join(os.getcwd(), output_filename)
 
-        # Get a list of all files to be compressed
-        file_paths = []
-        for root, directories, files in os.walk(directory_path):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                file_paths.append(filepath)
-
-        total_files = len(file_paths)
-        logging.info(f"Starting compression of directory: {directory_path}")
-
-        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for i, file in enumerate(file_paths, 1):
-                # Add file to zip
-                zipf.write(file, os.path.relpath(file, directory_path))
-                # Update progress bar
-                show_progress_bar(i, total_files)
+        write_directory_zip(directory_path, archive_path)
 
         logging.info(f"Directory compressed successfully: {archive_path}")
         return archive_path
@@ -145,98 +362,621 @@ def compress_directory(directory_path):
         logging.error(f"Error compressing directory: {e}")
         return None
 
-def upload_chunks(file_handle, filename, total_chunks):
+def write_directory_zip(directory_path, target):
+    """
+    Writes a deflate-compressed zip of a directory.
+
+    :param directory_path: Directory to compress.
+    :param target: Path of the archive, or a writable file object (it does not need to be seekable).
+    """
+    # Get a list of all files to be compressed
+    file_paths = []
+    for root, directories, files in os.walk(directory_path):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            file_paths.append(filepath)
+
+    total_files = len(file_paths)
+    logging.info(f"Starting compression of directory: {directory_path}")
+
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for i, file in enumerate(file_paths, 1):
+            # Add file to zip
+            zipf.write(file, os.path.relpath(file, directory_path))
+            # Update progress bar
+            show_progress_bar(i, total_files)
+
+def get_directory_fingerprint(directory_path):
+    """
+    Lists the path, size and modification time of every file in a directory, in archive order.
+    """
+    fingerprint = []
+    for root, directories, files in os.walk(directory_path):
+        for filename in files:
+            stat = os.stat(os.path.join(root, filename))
+            fingerprint.append([os.path.relpath(os.path.join(root, filename), directory_path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+class ChunkUploader:
+    """
+    Uploads the chunks of one file on a thread pool as they are produced.
+
+    Consecutive chunks are grouped into one message of up to ATTACHMENTS_PER_MESSAGE
+    attachments and MESSAGE_SIZE_LIMIT bytes, so small chunks cost one request between
+    them. At most `workers` groups are in flight: submit() blocks until one finishes once
+    the pool is busy, so memory stays bounded by a few messages. Every message is posted to
+    one of the striped channels and paced by that channel's rate-limit bucket. With a
+    checkpoint, chunks it already holds are not sent again and every finished chunk is
+    recorded in it. A transform (see chunk_codec.get_upload_transform) runs on the worker
+    threads, so compressing and encrypting one chunk overlaps with sending others. A
+    submitted chunk the transform splits into several pieces takes up several entries in
+    the list returned by finish(). Submitted chunks are held in the memory budget until
+    their message is sent.
+    """
+
+    def __init__(self, filename, total_chunks=None, workers=UPLOAD_WORKERS, checkpoint=None, transform=None):
+        self.filename = filename
+        self.total_chunks = total_chunks
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.transform = transform
+        self.count = 0
+        self.pieces = {}  # Submitted chunk -> list of (pair, per-chunk fields) of its uploaded pieces
+        self.group = []  # (number, data) of chunks waiting to be sent in the next message
+        self.group_size = 0
+        self.group_releases = []  # Functions giving back the memory of the chunks in the group
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        # Groups that were already being sent finish anyway; recording them keeps a rerun from posting them again
+        try:
+            self._collect(ALL_COMPLETED)
+        except Exception as e:
+            if exc_info[0] is None:
+                raise
+            logging.error(f"Another chunk group failed too: {e}")
+        for release in self.group_releases:
+            release()  # Chunks of a group that was never sent
+        self.group_releases = []
+
+    def submit(self, chunk_data, release=None):
+        """
+        Queues the next chunk of the file for upload.
+
+        :param chunk_data: The chunk, any bytes-like object. It must not change until it is uploaded.
+        :param release: Function called once the chunk is uploaded, when the caller reserved its memory
+            itself, e.g. to reuse its buffer; otherwise the chunk is reserved in the memory budget here.
+        :return: Number of the chunk, for get_pieces().
+        """
+        if self.skip_completed():
+            if release is not None:
+                release()
+            return self.count - 1
+
+        if release is None:
+            # A compressed or encrypted payload is held alongside the chunk until the message is sent
+            size = len(chunk_data) * (2 if self.transform is not None and self.transform.copies else 1)
+            if not memory_budget.try_acquire(size):
+                self.flush()  # The waiting group holds memory too, so it goes out before waiting
+                memory_budget.acquire(size)
+            release = partial(memory_budget.release, size)
+
+        if self.group and (len(self.group) == ATTACHMENTS_PER_MESSAGE
+                           or self.group_size + len(chunk_data) > MESSAGE_SIZE_LIMIT):
+            try:
+                self._send_group()
+            except Exception:
+                release()  # The chunk never joined a group, so nothing else gives its memory back
+                raise
+
+        i = self.count
+        self.count += 1
+        self.group.append((i, chunk_data))
+        self.group_size += len(chunk_data)
+        self.group_releases.append(release)
+        return i
+
+    def flush(self):
+        """
+        Sends the chunks waiting for the next message without waiting for more.
+        """
+        if self.group:
+            self._send_group()
+
+    def skip_completed(self):
+        """
+        Takes the next chunk from the checkpoint if an earlier run already uploaded it.
+
+        :return: The uploaded pieces of the chunk if it was skipped, so its data does not need
+            to be submitted; None otherwise.
+        """
+        if self.checkpoint is None or self.count not in self.checkpoint:
+            return None
+        self.pieces[self.count] = [(tuple(pair), fields) for pair, fields in self.checkpoint.get(self.count)]
+        self.count += 1
+        return self.pieces[self.count - 1]
+
+    def get_pieces(self, i):
+        """
+        :return: List of (pair, per-chunk fields) of the pieces chunk `i` was uploaded as.
+        """
+        return self.pieces[i]
+
+    def finish(self):
+        """
+        Waits for all queued chunks.
+
+        :return: List of (message_id, attachment_id) pairs, in chunk order.
+        """
+        if self.group:
+            self._send_group()
+        self._collect(ALL_COMPLETED)
+        return [pair for i in range(self.count) for pair, fields in self.pieces[i]]
+
+    def get_chunk_fields(self):
+        """
+        Collects the per-chunk index fields produced by the transform, e.g. {"nonces": [...]}.
+        """
+        pieces = [fields for i in range(self.count) for pair, fields in self.pieces[i]]
+        names = {name for fields in pieces for name in fields}
+        return {name: [fields.get(name, CHUNK_FIELD_DEFAULTS.get(name)) for fields in pieces] for name in names}
+
+    def _send_group(self):
+        future = self.executor.submit(upload_chunk_group, self.group, encode(self.filename), self.total_chunks,
+                                      self.transform)
+        # Also runs for a cancelled group, so its memory is never lost
+        future.add_done_callback(lambda future, releases=self.group_releases: [release() for release in releases])
+        self.pending.add(future)
+        self.group = []
+        self.group_size = 0
+        self.group_releases = []
+        if len(self.pending) >= self.workers:
+            self._collect(FIRST_COMPLETED)
+
+    def _collect(self, return_when):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        error = None
+        for future in done:
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue  # The groups that did go through are still recorded first
+            for i, pieces in future.result():
+                self.pieces[i] = pieces
+                if self.checkpoint is not None:
+                    self.checkpoint.record(i, [[pair, fields] for pair, fields in pieces])
+            if self.total_chunks:
+                show_progress_bar(len(self.pieces), self.total_chunks)
+        if error is not None:
+            raise error  # Reraises upload errors to allow caller to handle
+
+class ChunkWriter:
+    """
+    Write-only stream that cuts everything written to it into CHUNK_SIZE chunks for a ChunkUploader.
+    """
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= CHUNK_SIZE:
+            self.uploader.submit(self.buffer[:CHUNK_SIZE])
+            del self.buffer[:CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.uploader.submit(self.buffer)
+            self.buffer = bytearray()
+
+def upload_chunks(file_handle, filename, total_chunks, workers=UPLOAD_WORKERS, checkpoint=None, transform=None,
+                  grow_chunks=False):
     """
     Uploads file in chunks to a specified channel.
 
+    Up to `workers` chunks are sent concurrently. Sends are paced by the channel's
+    rate-limit bucket, and only `workers` chunks are held in memory at a time, within the
+    memory budget. Chunks are read with readinto() into reused buffers and sent from them
+    without further copies. With `grow_chunks`, each chunk takes as much input as is
+    estimated to fit in one attachment once the transform compresses it, up to what the
+    memory budget can hold.
+
     :param file_handle: File handle for the file to be uploaded.
     :param filename: Name of the file to be uploaded.
     :param total_chunks: Total number of chunks to divide the file into.
-    :return: List of tuples containing message_id and attachment_id for each uploaded chunk.
+    :param workers: Number of chunks uploaded concurrently.
+    :param checkpoint: Checkpoint of chunks already uploaded by an interrupted run.
+    :param transform: Function applied to each chunk before upload, see chunk_codec.get_upload_transform.
+    :param grow_chunks: Read more than CHUNK_SIZE per chunk when the data is compressible.
+    :return: Index entry fields: "urls", the list of (message_id, attachment_id) pairs in chunk order,
+        plus the per-chunk fields of the transform.
+    """
+    pool = BufferPool()
+    extra = CHUNK_SIZE if transform is not None and transform.copies else 0  # Room for the transformed payload
+
+    def take_buffer(uploader, size):
+        buffer = pool.try_take(size, extra)
+        if buffer is None:
+            uploader.flush()  # The waiting group holds buffers too, so it goes out before waiting
+            buffer = pool.take(size, extra)
+        return buffer
+
+    def give_back(buffer):
+        pool.give(buffer)
+        pool.release(extra)
+
+    try:
+        with ChunkUploader(filename, total_chunks, workers, checkpoint, transform) as uploader:
+            while True:
+                pieces = uploader.skip_completed()
+                if pieces:
+                    file_handle.seek(sum(fields.get("sizes", CHUNK_SIZE) for pair, fields in pieces), os.SEEK_CUR)
+                    continue
+                buffer = take_buffer(uploader, CHUNK_SIZE)
+                length = read_into(file_handle, memoryview(buffer)[:CHUNK_SIZE])
+                if not length:
+                    give_back(buffer)
+                    break  # Stop if there's no more data to read
+                if grow_chunks and length == CHUNK_SIZE:
+                    size = estimate_input_size(memoryview(buffer)[:length])
+                    if memory_budget.limit:
+                        # A buffer larger than the budget is only granted once every other transfer is done
+                        size = min(size, max(CHUNK_SIZE, memory_budget.limit - extra))
+                    if size > length:
+                        # Holding the first buffer while waiting for the larger one could wait forever,
+                        # so it is given back and the chunk read again
+                        give_back(buffer)
+                        file_handle.seek(-length, os.SEEK_CUR)
+                        buffer = take_buffer(uploader, size)
+                        length = read_into(file_handle, memoryview(buffer)[:size])
+                uploader.submit(memoryview(buffer)[:length], partial(give_back, buffer))
+            return {"urls": uploader.finish(), **uploader.get_chunk_fields()}
+    finally:
+        pool.close()
+
+def read_into(file_handle, view):
+    """
+    Fills a buffer from a file, stopping early only at the end of the file.
+
+    :return: Number of bytes read.
+    """
+    filled = 0
+    while filled < len(view):
+        count = file_handle.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+def upload_chunks_deduplicated(file_handle, filename, file_index, workers=UPLOAD_WORKERS, checkpoint=None,
+                               transform=None, file_fields=None):
+    """
+    Uploads a file split at content-defined boundaries, skipping chunks that are already stored.
+
+    The content hashes recorded with every indexed file form the table of stored chunks.
+    A chunk whose hash is in it, or that appeared earlier in the same file, is referenced
+    instead of being uploaded again. Only chunks stored with the same file-level fields
+    (i.e. the same encryption key and hashing) are reused.
+
+    :param file_handle: File handle for the file to be uploaded.
+    :param filename: Name of the file to be uploaded.
+    :param file_index: The current file index.
+    :param workers: Number of chunks uploaded concurrently.
+    :param checkpoint: Checkpoint of chunks already uploaded by an interrupted run.
+    :param transform: Function applied to each chunk before upload, see chunk_codec.get_upload_transform.
+    :param file_fields: File-level index fields that go with the transform.
+    :return: Index entry fields: "urls", the "hashes" and "sizes" of the chunks, plus the per-chunk fields of the transform.
     """
-    urls = []
-    for i in range(total_chunks):
-        show_progress_bar(i + 1, total_chunks)
-        chunk_data = file_handle.read(CHUNK_SIZE)
-        if not chunk_data:
-            break  # Stop if there's no more data to read
+    file_fields = file_fields or {}
+    hash_key = get_chunk_hash_key(file_fields)
+    stored = {}  # Content hash -> (pair, per-chunk fields) of a chunk that is already uploaded
+    for entry in file_index.values():
+        # Packed files only own a byte range of their attachment, so they cannot be referenced as chunks
+        if (entry.get("key_id") == file_fields.get("key_id") and entry.get("hashing") == file_fields.get("hashing")
+                and "ranges" not in entry):
+            chunk_fields = [name for name in CHUNK_FIELDS + ("channels",) if name in entry]
+            for k, (digest, pair) in enumerate(zip(entry.get("hashes", []), entry["urls"])):
+                stored[digest] = (pair, {name: entry[name][k] for name in chunk_fields})
+    hashes = []
+    sizes = []
+    sources = []  # Per chunk: an existing (pair, fields), or the upload number of a new chunk
+    new_chunks = {}
+    reused_bytes = 0
+
+    with ChunkUploader(filename, workers=workers, checkpoint=checkpoint, transform=transform) as uploader:
+        for chunk in content_defined_chunks(file_handle):
+            digest = hash_chunk(chunk, hash_key)
+            hashes.append(digest)
+            sizes.append(len(chunk))
+            if digest in stored:
+                sources.append(stored[digest])
+                reused_bytes += len(chunk)
+            elif digest in new_chunks:
+                sources.append(new_chunks[digest])
+                reused_bytes += len(chunk)
+            else:
+                new_chunks[digest] = uploader.submit(chunk)
+                sources.append(new_chunks[digest])
+        uploaded = uploader.finish()
+        # Chunks are never larger than an attachment, so each one is uploaded as a single piece
+        sources = [uploader.get_pieces(source)[0] if isinstance(source, int) else source for source in sources]
+
+    urls = [pair for pair, fields in sources]
+    # Chunks stored before compression or striping was enabled are raw and in CHANNEL_ID
+    names = {name for pair, fields in sources for name in fields}
+    chunk_fields = {name: [fields.get(name, CHUNK_FIELD_DEFAULTS.get(name)) for pair, fields in sources] for name in names}
+    logging.info(f"Uploaded {len(uploaded)} of {len(urls)} chunks, {get_size_format(reused_bytes)} already stored")
+    return {"urls": urls, "hashes": hashes, "sizes": sizes, **chunk_fields}
 
-        chunk = io.BytesIO(chunk_data)
-        files = {"file": (encode(filename) + "." + str(i), chunk)}
+@telemetry.timed("upload")
+def upload_chunk_group(chunks, name, total_chunks, transform=None):
+    """
+    Posts a group of chunks as attachments of as few messages as the limits allow, waiting out rate limits.
 
+    Each message goes to the striped channel picked by the stripe set. With more than one
+    channel configured, the channel of every piece is recorded in its "channels" field.
+
+    :param chunks: List of (index, bytes) of the chunks, in file order.
+    :param name: Encoded filename the attachment names are derived from.
+    :param total_chunks: Total number of chunks in the file, for logging.
+    :param transform: Function applied to each chunk before upload, see chunk_codec.get_upload_transform.
+    :return: List of the index of every chunk and a list with the (message_id, attachment_id) pair and
+        the per-chunk index fields of every piece the chunk was uploaded as.
+    """
+    attachments = []  # (chunk index, attachment name, payload, fields) of every piece
+    with telemetry.span("upload", "encode", bytes=sum(len(chunk_data) for i, chunk_data in chunks)):
+        for i, chunk_data in chunks:
+            pieces = transform(chunk_data) if transform is not None else [(chunk_data, {})]
+            for k, (payload, fields) in enumerate(pieces):
+                attachments.append((i, f"{name}.{i}" if k == 0 else f"{name}.{i}.{k}", payload, fields))
+
+    messages = [[]]
+    for attachment in attachments:
+        message = messages[-1]
+        if message and (len(message) == ATTACHMENTS_PER_MESSAGE
+                        or sum(len(payload) for i, n, payload, f in message) + len(attachment[2]) > MESSAGE_SIZE_LIMIT):
+            messages.append([])
+        messages[-1].append(attachment)
+
+    results = {}
+    for message in messages:
+        size = sum(len(payload) for i, n, payload, f in message)
+        with telemetry.span("upload", "wait for channel", bytes=size):
+            channel_id = stripes.acquire(size)
         try:
-            response = requests.post(f"{BASE_URL}{CHANNEL_ID}/messages", headers=headers, files=files)
-            response.raise_for_status()  # Raise an exception for HTTP error responses
+            pairs = post_attachments([(n, payload) for i, n, payload, f in message], get_chunk_label(message, total_chunks),
+                                     channel_id)
+        finally:
+            stripes.release(channel_id, size)
+        for (i, n, payload, fields), pair in zip(message, pairs):
+            if len(stripes) > 1:
+                fields = {**fields, "channels": channel_id}
+            results.setdefault(i, []).append((pair, fields))
+    return list(results.items())
 
-            message = response.json()
-            urls.append((message["id"], message["attachments"][0]["id"]))  # message_id, attachment_id pair
-        except requests.RequestException as e:
-            logging.error(f"Failed to upload chunk {i+1}/{total_chunks}: {e}")
-            raise  # Reraise the exception to allow caller to handle
+def get_chunk_label(attachments, total_chunks):
+    first, last = attachments[0][0] + 1, attachments[-1][0] + 1
+    return f"chunk {first}/{total_chunks or '?'}" if first == last else f"chunks {first}-{last}/{total_chunks or '?'}"
 
-    return urls
+@telemetry.timed("upload")
+def post_attachments(attachments, label, channel_id=CHANNEL_ID):
+    """
+    Posts one message with the given attachments, waiting out rate limits.
+
+    A message rejected as too large (HTTP 413) is split in two and each half posted on its own,
+    so a MESSAGE_SIZE_LIMIT above what the server accepts only costs extra requests.
+
+    :param attachments: List of (attachment name, bytes-like data).
+    :param label: Description of the chunks for logging.
+    :param channel_id: Channel to post the message to.
+    :return: The (message_id, attachment_id) pair of every attachment, in order.
+    """
+    # Streamed from the chunk buffers instead of being copied into one request body
+    body = MultipartBody([(f"files[{n}]", name, data) for n, (name, data) in enumerate(attachments)])
+    try:
+        response = api_request("POST", f"POST /channels/{channel_id}/messages", f"{BASE_URL}{channel_id}/messages",
+                               token=stripes.get_token(channel_id), data=body, headers={"Content-Type": body.content_type})
+    except requests.RequestException as e:
+        logging.error(f"Failed to upload {label}: {e}")
+        raise
+
+    if response.status_code == 413 and len(attachments) > 1:
+        half = len(attachments) // 2
+        return post_attachments(attachments[:half], label, channel_id) + post_attachments(attachments[half:], label, channel_id)
+
+    try:
+        response.raise_for_status()  # Raise an exception for HTTP error responses
+    except requests.RequestException as e:
+        logging.error(f"Failed to upload {label}: {e}")
+        raise
+
+    message = response.json()
+    # Attachments come back in the order they were sent; their filenames may have been sanitized, so are not matched on
+    if len(message["attachments"]) != len(attachments):
+        logging.error(f"Failed to upload {label}: {len(message['attachments'])} of {len(attachments)} attachments stored")
+        raise requests.RequestException(f"message {message['id']} holds {len(message['attachments'])} of "
+                                        f"{len(attachments)} attachments", response=response)
+    return [(message["id"], attachment["id"]) for attachment in message["attachments"]]  # message_id, attachment_id pairs
 
 def download_file(args):
     indices = [int(arg[1:]) if arg[0] == "#" else int(arg) - 1 for arg in args]
+    indices = list(dict.fromkeys(indices))  # The same file requested twice is downloaded once
 
     load_file_index()
     file_index = get_file_index()
-    filelist = list(file_index.items())
+    keys = list(file_index)
 
     for index in indices:
-        if index >= len(filelist):
+        if index >= len(keys):
             logging.error(f"Invalid ID provided: {index}")
             sys.exit()
+    files = {index: file_index[keys[index]] for index in indices}  # Only the requested entries are decoded
 
-        logging.info("Downloading...")
+    logging.info("Downloading...")
+
+    failed = {}
+    checkpoints = {}
+    handles = []
+    jobs = []
+    try:
+        for index in indices:
+            og_name, file = keys[index], files[index]
+            filename = decode(file["filename"])
+            path = f"downloads/{filename}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        og_name, file = filelist[index]
-        filename = decode(file["filename"])
-        os.makedirs(os.path.dirname(f"downloads/{filename}"), exist_ok=True)
+            # Chunks written by an interrupted run of the same download are kept
+            checkpoint = Checkpoint("download", og_name, file["urls"][:1], file.get("size", 0))
+            if checkpoint and os.path.isfile(path) and os.path.getsize(path) == file.get("size", 0):
+                logging.info(f"Resuming {filename}, {len(checkpoint)} chunks already downloaded")
+                f = open(path, "r+b")
+            else:
+                checkpoint.discard()
+                f = open(path, "wb")
+                f.truncate(file.get("size", 0))  # Preallocate so chunks can be written at their offsets
+            handles.append(f)
+            failed[filename] = 0
+            checkpoints[filename] = checkpoint
 
-        with open(f"downloads/{filename}", "wb") as f:
-            for i, values in enumerate(file["urls"]):
-                message_id, _ = values  # Assuming attachment_id is no longer needed
+            try:
+                new_decoder = get_download_decoder(file)
+                hash_key = get_chunk_hash_key(file)
+            except ValueError as e:
+                logging.error(e)
+                failed[filename] = len(file["urls"])
+                continue
 
-                response = fetch_message(message_id)
-                if not response:
-                    continue  # Skip this file or handle error as needed
+            hashes = file.get("hashes", [None] * len(file["urls"]))
+            ranges = file.get("ranges", [None] * len(file["urls"]))
+            channels = get_chunk_channels(file)
+            offsets = get_chunk_offsets(file)
+            ends = offsets[1:] + [file.get("size", 0)]
+            for i, ((message_id, attachment_id), offset) in enumerate(zip(file["urls"], offsets)):
+                if i in checkpoint:
+                    continue
+                jobs.append({"file": f, "offset": offset, "message_id": message_id, "attachment_id": attachment_id,
+                             "channel_id": channels[i], "new_decoder": new_decoder and partial(new_decoder, i),
+                             "size": max(0, ends[i] - offset), "hash": hashes[i], "hash_key": hash_key, "range": ranges[i],
+                             "filename": filename, "chunk": i})
 
-                download_url = response['attachments'][0]['url']
-                if not download_content(download_url, f, i, len(file["urls"])):
-                    continue  # Skip this file or handle error as needed
+        # All chunks of all requested files go through one pipeline, so DOWNLOAD_WORKERS caps the total concurrency
+        for completed, (job, success) in enumerate(DownloadPipeline().run(jobs), 1):
+            show_progress_bar(completed, len(jobs))
+            if success:
+                checkpoints[job["filename"]].record(job["chunk"])
+            else:
+                failed[job["filename"]] += 1
+    finally:
+        for f in handles:
+            f.close()
 
+    for filename, count in failed.items():
+        if count:
+            logging.error(f"{count} chunk(s) of {filename} could not be downloaded. Run the same command again to resume.")
+        else:
+            checkpoints[filename].discard()
     logging.info("Download complete.")
 
-def download_content(download_url, file_handle, current_chunk, total_chunks):
-    MAX_RETRIES = 5
+@telemetry.timed("download")
+def download_chunk(message_id, attachment_id, download_url, file_handle, lock, offset, new_decoder=None, expected_hash=None,
+                   byte_range=None, channel_id=CHANNEL_ID, hash_key=None):
+    """
+    Downloads one chunk and writes it at its offset in the output file.
+
+    :param message_id: ID of the message holding the chunk.
+    :param attachment_id: ID of the chunk's attachment.
+    :param download_url: Pre-resolved CDN URL of the chunk, or None to look it up.
+    :param file_handle: Preallocated output file.
+    :param lock: Lock serializing writes to file_handle.
+    :param offset: Byte offset of the chunk in the file.
+    :param new_decoder: Function returning a fresh chunk_codec.ChunkDecoder for the chunk, or None if it is stored as it is.
+    :param expected_hash: Content hash the chunk must match, or None if the index has none.
+    :param byte_range: (offset, length) of the chunk within the attachment for packed files, or None for the whole attachment.
+    :param channel_id: Channel of the message, to look the chunk up in if download_url fails.
+    :param hash_key: Key expected_hash was computed with, see chunk_codec.get_chunk_hash_key.
+    :return: True if the chunk was written and verified, False otherwise.
+    """
+    if download_url:
+        if download_content(download_url, file_handle, lock, offset, new_decoder and new_decoder(), expected_hash, byte_range,
+                            hash_key):
+            return True
+        # The CDN rejected the cached URL or sent bad data, so fetch the chunk again from a fresh URL
+        evict_attachment_url(message_id, attachment_id)
+
+    download_url = get_attachment_url(message_id, attachment_id, channel_id)
+    if download_url is None:
+        return False
+    return download_content(download_url, file_handle, lock, offset, new_decoder and new_decoder(), expected_hash, byte_range,
+                            hash_key)
+
+def download_content(download_url, file_handle, lock, offset, decoder=None, expected_hash=None, byte_range=None,
+                     hash_key=None):
     RETRY_DELAY = 2  # seconds
-    CHUNK_SIZE = 24 * 1024**3  # Adjust based on server capability
+    CHUNK_SIZE = 1024**2  # Size of the pieces streamed from the CDN
+
+    start = offset
+    digest = new_chunk_hash(hash_key)  # Verified while the data streams through, without reading the file back
+
+    def write(chunk):
+        nonlocal offset
+        digest.update(chunk)
+        retry_count = 0
+        while retry_count < MAX_RETRIES:
+            try:
+                with lock:
+                    file_handle.seek(offset)
+                    file_handle.write(chunk)
+                offset += len(chunk)
+                return True  # Successfully written chunk
+            except Exception as write_error:
+                logging.error(f"Error writing chunk: {write_error}")
+                retry_count += 1
+                time.sleep(RETRY_DELAY)
+        logging.error("Max retries reached for writing chunk.")
+        return False
 
     try:
-        with requests.get(download_url, stream=True) as cdnResponse:
-            cdnResponse.raise_for_status()  # Check for HTTP errors
-
-            for chunk in cdnResponse.iter_content(chunk_size=CHUNK_SIZE):
-                if not chunk:
-                    continue  # Skip keep-alive chunks
-
-                retry_count = 0
-                while retry_count < MAX_RETRIES:
-                    try:
-                        file_handle.write(chunk)
-                        show_progress_bar(current_chunk + 1, total_chunks)
-                        break  # Successfully written chunk
-                    except Exception as write_error:
-                        logging.error(f"Error writing chunk: {write_error}")
-                        retry_count += 1
-                        time.sleep(RETRY_DELAY)
-
-                if retry_count == MAX_RETRIES:
-                    logging.error("Max retries reached for writing chunk.")
-                    return False
-
-        print("Download complete.")
+        if byte_range is None or byte_range[1]:  # An empty packed file has nothing to fetch
+            with cdn_request(download_url, byte_range) as cdnResponse:
+                cdnResponse.raise_for_status()  # Check for HTTP errors
+
+                pieces = cdnResponse.iter_content(chunk_size=CHUNK_SIZE)
+                if byte_range is not None and cdnResponse.status_code != 206:
+                    pieces = slice_stream(pieces, *byte_range)  # The server ignored the Range header
+
+                for chunk in pieces:
+                    if not chunk:
+                        continue  # Skip keep-alive chunks
+                    if decoder is not None:
+                        chunk = decode_piece(decoder.update, chunk, start)
+                        if chunk is None:
+                            return False
+                    if chunk and not write(chunk):
+                        return False
+
+        if decoder is not None:
+            chunk = decode_piece(decoder.finish, None, start)
+            if chunk is None or (chunk and not write(chunk)):
+                return False
+
+        if expected_hash and digest.hexdigest() != expected_hash:
+            logging.error(f"Chunk at offset {start} failed verification")
+            return False
         return True
     except requests.exceptions.RequestException as req_err:
         logging.error(f"Request error: {req_err}")
@@ -246,47 +986,77 @@ def download_content(download_url, file_handle, current_chunk, total_chunks):
     return False
 
 def delete_file(args):
-    index = (int(args[0][1:]) if args[0][0] == "#" else int(args[0])) - 1
+    """
+    Deletes files from the server and removes them from the index in a single update.
+
+    The chunk messages of all files are deleted together: recent ones with bulk deletes,
+    older ones concurrently, and every striped channel side by side. A file stays in the
+    index if any of its messages could not be deleted, so the command can be run again.
+
+    Args:
+        args (list): IDs of the files, as shown by -list.
+    """
+    indices = list(dict.fromkeys((int(arg[1:]) if arg[0] == "#" else int(arg)) - 1 for arg in args))
     index_message_id = load_file_index()
 
     file_index = get_file_index()
-    file_list = list(file_index.values())
-    if index >= len(file_list):
+    keys = list(file_index)
+    if any(not 0 <= index < len(keys) for index in indices):
         print("Invalid ID provided")
         return  # Exit if index is out of range
 
-    file = file_list[index]
-    message_ids = [i[0] for i in file["urls"]]
+    targets = [keys[index] for index in indices]
+    # Deduplicated chunks may also belong to other files; those messages have to stay
+    kept = set(keys).difference(targets)
+    shared = {message_id for key in kept for message_id in file_index.get_message_ids(key)}
     print("Deleting...")
+    deleted = delete_entry_messages([file_index[key] for key in targets], shared)
 
-    # Initialize a flag to track deletion success
-    all_deleted_successfully = True
-
-    for i, message_id in enumerate(message_ids):
-        try:
-            response = requests.delete(
-                f"{BASE_URL}{CHANNEL_ID}/messages/{message_id}", headers=headers
-            )
-            if response.status_code == 204:
-                print(f"Message {message_id} deleted successfully.")
-            else:
-                print(f"Failed to delete message {message_id}: {response.status_code} {response.text}")
-                all_deleted_successfully = False  # Update flag if any deletion fails
-        except Exception as e:
-            print(f"An error occurred while deleting message {message_id}: {e}")
-            all_deleted_successfully = False  # Update flag for exceptions
-
-        show_progress_bar(i + 1, len(message_ids))
-        sleep(1)
-
-    # Proceed with index update only if all deletions were successful
-    if all_deleted_successfully:
-        filename_to_delete = file["filename"].strip()
-        if filename_to_delete in file_index:
-            del file_index[filename_to_delete]
-            update_file_index(index_message_id, file_index)
-            print(f"Deleted {decode(filename_to_delete)}.")
+    # Files are only removed from the index once all of their messages are gone
+    removed = []
+    for key in targets:
+        if all(message_id in deleted or message_id in shared for message_id, attachment_id in file_index[key]["urls"]):
+            removed.append(key)
         else:
-            print(f"File {decode(filename_to_delete)} not found in index.")
-    else:
-        print("Not all messages were deleted successfully. Aborting index update.")
\ No newline at end of file
+            print(f"Not all messages of {decode(key)} were deleted successfully. It stays in the index.")
+    for key in removed:
+        del file_index[key]
+    if removed:
+        update_file_index(index_message_id, file_index, removed)
+        for key in removed:
+            print(f"Deleted {decode(key)}.")
+
+def delete_entry_messages(entries, shared):
+    """
+    Deletes the chunk messages of index entries, with every striped channel cleared side by side.
+
+    Args:
+        entries (list): Index entries of the files whose messages are deleted.
+        shared (set): IDs of messages other files still refer to, which are kept.
+
+    Returns:
+        set: IDs of the messages that are gone.
+    """
+    channels = {}  # Channel ID -> messages of the files to delete in it
+    for file in entries:
+        for (message_id, attachment_id), channel_id in zip(file["urls"], get_chunk_channels(file)):
+            if message_id not in shared:
+                channels.setdefault(channel_id, {})[message_id] = None
+    total = sum(len(message_ids) for message_ids in channels.values())
+
+    deleted = set()
+    handled = 0
+    lock = threading.Lock()
+
+    def progress(count):
+        nonlocal handled
+        with lock:
+            handled += count
+            show_progress_bar(handled, total)
+
+    # Every channel has its own rate limits, so striped channels are cleared side by side
+    if channels:
+        with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+            for gone in executor.map(lambda item: delete_messages(item[0], list(item[1]), progress), channels.items()):
+                deleted |= gone
+    return deleted
\ No newline at end of file
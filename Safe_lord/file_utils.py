@@ -1,3 +1,11 @@
+import string
+from datetime import datetime
+
+# ROT13 of the ASCII letters, applied with str.translate instead of character by character
+_ROT13 = str.maketrans(string.ascii_lowercase + string.ascii_uppercase,
+                       string.ascii_lowercase[13:] + string.ascii_lowercase[:13]
+                       + string.ascii_uppercase[13:] + string.ascii_uppercase[:13])
+
 def get_size_format(size):
     """
     Converts a file size in bytes to a human-readable format.
@@ -19,6 +27,34 @@ def get_size_format(size):
 
     return "{:.2f} {}".format(size, "PB")  # Handle sizes in petabytes
 
+def parse_size(text):
+    """
+    Converts a size like "500", "10KB" or "1.5 GB" to bytes, with the units of get_size_format.
+
+    Parameters:
+    text (str): The size, optionally followed by a unit (B, K, KB, M, MB, G, GB, T, TB).
+
+    Returns:
+    int: The size in bytes. Raises ValueError if the text is not a size.
+    """
+    text = text.strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def parse_date(text):
+    """
+    Converts a local date or date and time in ISO format (e.g. "2024-05-01" or "2024-05-01T12:00") to a Unix time.
+
+    Parameters:
+    text (str): The date.
+
+    Returns:
+    float: The Unix time. Raises ValueError if the text is not a date.
+    """
+    return datetime.fromisoformat(text).timestamp()
+
 def encode(string):
     """
     Encodes a string using the ROT13 cipher.
@@ -29,6 +65,8 @@ def encode(string):
     Returns:
     str: The encoded string.
     """
+    if string.isascii():
+        return string.translate(_ROT13)
     encoded = ""
     for char in string:
         if char.isalpha():  # Check if the character is a letter
@@ -52,6 +90,8 @@ def decode(encoded):
     Returns:
     str: The decoded string.
     """
+    if encoded.isascii():
+        return encoded.translate(_ROT13)  # ROT13 is its own inverse
     decoded = ""
     for char in encoded:
         if char.isalpha():  # Check if the character is a letter
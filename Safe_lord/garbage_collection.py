@@ -0,0 +1,117 @@
+import time
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from index_management import load_file_index, get_file_index, is_index_message
+from checkpoints import get_checkpointed_messages
+from utils import show_progress_bar, delete_messages, get_snowflake_time
+from file_utils import get_size_format
+from transport import api_request
+from stripes import stripes
+from config import BASE_URL, GC_MIN_AGE
+
+PAGE_SIZE = 100  # Most messages one history request returns
+
+
+def collect_garbage(args):
+    """
+    Finds chunk messages that no file in the index refers to and deletes them.
+
+    They are left behind by failed uploads and interrupted deletes. Every channel holding
+    chunks is paged through, 100 messages per request, and checked against the message IDs
+    referenced by the index. Chunks recorded by checkpoints of interrupted uploads, and
+    chunks younger than GC_MIN_AGE that may belong to an upload still running, are kept.
+
+    Args:
+        args (list): "--dry-run" to only report the orphaned messages.
+    """
+    parser = argparse.ArgumentParser(prog="-gc", description="Deletes chunk messages no file in the index refers to.")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+    try:
+        options = parser.parse_args(args)
+    except SystemExit:
+        return
+
+    # Without an index every chunk would look orphaned
+    if load_file_index() is None:
+        print("No index could be loaded, so nothing is collected.")
+        return
+    file_index = get_file_index()
+    referenced = {message_id for key in file_index for message_id in file_index.get_message_ids(key)}
+    referenced |= get_checkpointed_messages()
+    channels = set(stripes.channels)
+    channels.update(channel_id for key in file_index for channel_id in file_index[key].get("channels", []))
+
+    print(f"Scanning {len(channels)} channel(s)...")
+    start = time.perf_counter()
+    newest = time.time() - GC_MIN_AGE
+    with ThreadPoolExecutor(max_workers=len(channels)) as executor:
+        scans = dict(zip(channels, executor.map(lambda channel_id: scan_channel(channel_id, referenced, newest), channels)))
+    elapsed = time.perf_counter() - start
+
+    scanned = sum(scan["messages"] for scan in scans.values())
+    pages = sum(scan["pages"] for scan in scans.values())
+    orphans = sum(len(scan["orphans"]) for scan in scans.values())
+    orphan_bytes = sum(scan["bytes"] for scan in scans.values())
+    print(f"Scanned {scanned} messages in {pages} requests in {elapsed:.1f}s ({scanned / max(elapsed, 1e-9):.0f} messages/s)")
+    print(f"Found {orphans} orphaned chunk message(s) holding {get_size_format(orphan_bytes)}")
+    if any(scan["error"] for scan in scans.values()):
+        print("Some channels could not be scanned completely; run the command again to find the rest.")
+    if options.dry_run or not orphans:
+        return
+
+    print("Deleting...")
+    handled = 0
+    lock = threading.Lock()
+
+    def progress(count):
+        nonlocal handled
+        with lock:
+            handled += count
+            show_progress_bar(handled, orphans)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(scans)) as executor:
+        deleted = sum(len(gone) for gone in executor.map(lambda item: delete_messages(item[0], item[1]["orphans"], progress),
+                                                          scans.items()))
+    elapsed = time.perf_counter() - start
+    print(f"Deleted {deleted} of {orphans} message(s) in {elapsed:.1f}s ({deleted / max(elapsed, 1e-9):.0f} messages/s)")
+
+
+def scan_channel(channel_id, referenced, newest):
+    """
+    Pages through a channel's whole history, newest first, looking for orphaned chunk messages.
+
+    Parameters:
+        channel_id (str): The channel to scan.
+        referenced (set): IDs of the messages that are still in use.
+        newest (float): Unix time after which chunk messages are left alone.
+
+    Returns:
+        dict: "orphans", the IDs of the unreferenced chunk messages, the "bytes" their attachments hold,
+            the number of "messages" and "pages" scanned, and the "error" that stopped the scan early, if any.
+    """
+    scan = {"orphans": [], "bytes": 0, "messages": 0, "pages": 0, "error": None}
+    params = {"limit": PAGE_SIZE}
+    while True:
+        try:
+            response = api_request("GET", f"GET /channels/{channel_id}/messages", f"{BASE_URL}{channel_id}/messages",
+                                   token=stripes.get_token(channel_id), params=params)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Error occurred while scanning channel {channel_id}: {e}")
+            scan["error"] = e
+            return scan
+
+        messages = response.json()
+        scan["pages"] += 1
+        scan["messages"] += len(messages)
+        for message in messages:
+            if (message.get("attachments") and not is_index_message(message) and message["id"] not in referenced
+                    and get_snowflake_time(message["id"]) < newest):
+                scan["orphans"].append(message["id"])
+                scan["bytes"] += sum(attachment.get("size", 0) for attachment in message["attachments"])
+        if len(messages) < PAGE_SIZE:
+            return scan
+        params["before"] = messages[-1]["id"]
@@ -0,0 +1,284 @@
+import sys
+import json
+import struct
+from array import array
+from collections.abc import MutableMapping
+
+MAGIC = b"SLIX"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxxQ")  # Magic, version, number of files
+RECORD_HEADER = struct.Struct("<HQI")  # Mask of the packed fields present, size, length of the JSON extra
+COUNT = struct.Struct("<I")
+HAS_SIZE = 1 << 15
+
+ID_PAIRS, IDS, INTS, INT_PAIRS, HEX = range(5)
+# Index entry fields stored as packed arrays, in record order. Their bit in the record mask is their position here.
+# Other fields, and values that do not fit the packed type, are kept in the record's JSON extra.
+PACKED_FIELDS = (("urls", ID_PAIRS), ("channels", IDS), ("sizes", INTS), ("ranges", INT_PAIRS),
+                 ("hashes", HEX), ("nonces", HEX))
+
+
+def _to_little_endian(numbers):
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+def _read_numbers(data, offset, count):
+    numbers = array("Q")
+    numbers.frombytes(data[offset:offset + 8 * count])
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers
+
+
+def _is_id(value):
+    return isinstance(value, str) and value.isdigit() and value == str(int(value))
+
+
+def pack_field(kind, values):
+    """
+    Packs the values of an index entry field into a counted array.
+
+    Parameters:
+    kind (int): How the values are packed: ID_PAIRS, IDS, INTS, INT_PAIRS or HEX.
+    values (list): The field's values.
+
+    Returns:
+    bytes: The packed field, or None if the values do not all fit the packed type.
+    """
+    try:
+        if kind == HEX:
+            width = len(values[0]) // 2 if values else 0
+            if not all(isinstance(value, str) and len(value) == 2 * width and bytes.fromhex(value).hex() == value
+                       for value in values) or width > 255:
+                return None
+            return COUNT.pack(len(values)) + bytes([width]) + b"".join(bytes.fromhex(value) for value in values)
+
+        if kind in (ID_PAIRS, INT_PAIRS):
+            if not all(len(pair) == 2 for pair in values):
+                return None
+            flat = [value for pair in values for value in pair]
+        else:
+            flat = list(values)
+        if kind in (ID_PAIRS, IDS):
+            if not all(_is_id(value) for value in flat):
+                return None
+            numbers = array("Q", map(int, flat))
+        else:
+            if not all(type(value) is int for value in flat):
+                return None
+            numbers = array("Q", flat)
+    except (TypeError, ValueError, OverflowError):
+        return None  # Not a list, negative or over 64 bits
+    return COUNT.pack(len(values)) + _to_little_endian(numbers)
+
+
+def unpack_field(kind, data, offset):
+    """
+    Reads a field packed by pack_field().
+
+    Returns:
+    tuple: The field's values and the offset after them.
+    """
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    if kind == HEX:
+        width = data[offset]
+        offset += 1
+        values = [bytes(data[start:start + width]).hex() for start in range(offset, offset + width * count, width)]
+        return values, offset + width * count
+
+    pairs = kind in (ID_PAIRS, INT_PAIRS)
+    numbers = _read_numbers(data, offset, 2 * count if pairs else count)
+    values = [str(number) for number in numbers] if kind in (ID_PAIRS, IDS) else numbers.tolist()
+    if pairs:
+        values = [list(pair) for pair in zip(values[0::2], values[1::2])]
+    return values, offset + 8 * len(numbers)
+
+
+def encode_record(key, entry):
+    """
+    Encodes one index entry as a binary record.
+    """
+    mask = HAS_SIZE if type(entry.get("size")) is int and 0 <= entry["size"] < 1 << 64 else 0
+    packed = []
+    for bit, (name, kind) in enumerate(PACKED_FIELDS):
+        data = pack_field(kind, entry[name]) if name in entry else None
+        if data is not None:
+            mask |= 1 << bit
+            packed.append(data)
+
+    extra = {name: value for name, value in entry.items()
+             if not (name == "filename" and value == key) and not (name == "size" and mask & HAS_SIZE)
+             and not any(name == packed_name and mask & 1 << bit for bit, (packed_name, kind) in enumerate(PACKED_FIELDS))}
+    if "filename" not in entry:
+        extra["filename"] = None  # Marks the name as missing rather than equal to the key
+    extra = json.dumps(extra).encode() if extra else b""
+    return RECORD_HEADER.pack(mask, entry["size"] if mask & HAS_SIZE else 0, len(extra)) + extra + b"".join(packed)
+
+
+def decode_record(key, data, offset):
+    """
+    Decodes a binary record written by encode_record().
+
+    Returns:
+    dict: The index entry.
+    """
+    mask, size, extra_length = RECORD_HEADER.unpack_from(data, offset)
+    offset += RECORD_HEADER.size
+    entry = {"filename": key}
+    if mask & HAS_SIZE:
+        entry["size"] = size
+    if extra_length:
+        entry.update(json.loads(bytes(data[offset:offset + extra_length])))
+        if entry["filename"] is None:
+            del entry["filename"]
+        offset += extra_length
+    for bit, (name, kind) in enumerate(PACKED_FIELDS):
+        if mask & 1 << bit:
+            entry[name], offset = unpack_field(kind, data, offset)
+    return entry
+
+
+def encode_index(file_index):
+    """
+    Encodes a file index in the binary index format.
+
+    The format is a header, the names of all files, an offset directory with the start of
+    every record, and the records. Snowflake IDs, sizes and ranges are stored as packed
+    64-bit integers and hex strings as raw bytes. Entries of a LazyIndex that were never
+    accessed are copied over without being decoded.
+
+    Parameters:
+    file_index (dict): Maps each key (the encoded filename) to its index entry; a LazyIndex or a dict.
+
+    Returns:
+    bytes: The encoded index.
+    """
+    names = list(file_index)
+    name_table = "\0".join(names).encode()
+    if any("\0" in name for name in names):
+        raise ValueError("Filenames in the index cannot contain NUL characters")
+
+    records = []
+    for key in names:
+        raw = file_index.get_raw_record(key) if isinstance(file_index, LazyIndex) else None
+        records.append(raw if raw is not None else encode_record(key, file_index[key]))
+
+    start = HEADER.size + COUNT.size + len(name_table) + 8 * (len(names) + 1)
+    offsets = array("Q", [start])
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    return b"".join([HEADER.pack(MAGIC, VERSION, len(names)), COUNT.pack(len(name_table)), name_table,
+                     _to_little_endian(offsets), *records])
+
+
+def parse_index(data):
+    """
+    Reads an index in the binary format, or in the JSON format used before it.
+
+    Parameters:
+    data (bytes): The index file or attachment.
+
+    Returns:
+    LazyIndex: The file index. Raises ValueError if the data is not a valid index.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        file_index = LazyIndex()
+        file_index.update(json.loads(data))
+        return file_index
+    return LazyIndex(data)
+
+
+class LazyIndex(MutableMapping):
+    """
+    File index backed by the binary index format, decoding entries only when they are accessed.
+
+    Opening an index reads its name table and offset directory, so listing, counting and
+    looking up files stays cheap however many chunks they have. An entry is decoded on first
+    access and kept, so changes made to it in place are saved by encode_index(). It behaves
+    like the dict the index used to be loaded as, including keeping files in insertion order.
+    """
+
+    def __init__(self, data=None):
+        self._data = memoryview(data) if data else None
+        self._offsets = array("Q")
+        self._positions = {}  # Key -> number of its record in _data, in index order
+        self._entries = {}  # Key -> decoded or assigned entry
+        if not data:
+            return
+
+        try:
+            magic, version, count = HEADER.unpack_from(data, 0)
+            length, = COUNT.unpack_from(data, HEADER.size)
+        except struct.error as e:
+            raise ValueError(f"Truncated index: {e}")
+        if version != VERSION:
+            raise ValueError(f"Unsupported index format version {version}")
+        offset = HEADER.size + COUNT.size
+        names = bytes(data[offset:offset + length]).decode().split("\0") if count else []
+        offset += length
+        self._offsets = _read_numbers(data, offset, count + 1)
+        if len(names) != count or len(self._offsets) != count + 1 or self._offsets[-1] != len(data):
+            raise ValueError("Truncated or corrupt index")
+        self._positions = dict(zip(names, range(count)))
+
+    def __getitem__(self, key):
+        position = self._positions[key]
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = decode_record(key, self._data, self._offsets[position])
+        return entry
+
+    def __setitem__(self, key, entry):
+        if key not in self._positions:
+            self._positions[key] = None
+        self._entries[key] = entry
+
+    def __delitem__(self, key):
+        del self._positions[key]
+        self._entries.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def get_raw_record(self, key):
+        """
+        Returns the stored record of an entry that has not been accessed, or None if it has to be encoded again.
+        """
+        position = self._positions[key]
+        if position is None or key in self._entries:
+            return None
+        return self._data[self._offsets[position]:self._offsets[position + 1]]
+
+    def get_size(self, key):
+        """
+        Returns the size of a file without decoding its entry.
+        """
+        position = self._positions[key]
+        if position is None or key in self._entries:
+            return self[key].get("size", 0)
+        mask, size, extra_length = RECORD_HEADER.unpack_from(self._data, self._offsets[position])
+        return size if mask & HAS_SIZE else self[key].get("size", 0)
+
+    def get_message_ids(self, key):
+        """
+        Returns the IDs of the messages holding a file's chunks, in chunk order, without decoding the rest of its entry.
+        """
+        position = self._positions[key]
+        if position is None or key in self._entries:
+            return [pair[0] for pair in self[key]["urls"]]
+        offset = self._offsets[position]
+        mask, size, extra_length = RECORD_HEADER.unpack_from(self._data, offset)
+        if not mask & 1:
+            return [pair[0] for pair in self[key]["urls"]]  # Stored in the JSON extra
+        offset += RECORD_HEADER.size + extra_length
+        count, = COUNT.unpack_from(self._data, offset)
+        return [str(number) for number in _read_numbers(self._data, offset + COUNT.size, 2 * count)[0::2]]
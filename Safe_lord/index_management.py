@@ -1,89 +1,352 @@
+import os
+import re
 import json
 import logging
 import requests
 import sys
-from config import BASE_URL, CHANNEL_ID, INDEX_FILE, headers
+from concurrent.futures import ThreadPoolExecutor
+from utils import resolve_attachment_urls
+from transport import api_request, cdn_request
+from telemetry import telemetry
+from index_format import LazyIndex, encode_index, parse_index, MAGIC
+from config import BASE_URL, CHANNEL_ID, INDEX_FILE, INDEX_CACHE_FILE, JOURNAL_FILE, JOURNAL_COMPACT_EVERY
 
+# Remote index messages the local INDEX_FILE was built from:
+# "base" is the snapshot, "records" the journal records applied on top of it and "head" the newest of them.
+# "binary" is set once the snapshot is in the binary index format; a JSON one is replaced on the next update.
+# "lineage" and "generation" number the versions of the local INDEX_FILE, and "log" holds the keys that changed
+# in the latest of them, so the search index can apply just those.
+_index_state = {"head": None, "base": None, "records": []}
+CHANGE_LOG_LENGTH = 100  # Versions of the local index whose changed keys are remembered
+CHANGE_LOG_KEYS = 1000  # Most keys remembered for one version; beyond that a full pass costs about as much
+
+@telemetry.timed("index")
 def load_file_index():
     """
-    Loads the index file from a specified channel and writes it to a local file.
-    
+    Loads the index from a specified channel and writes it to a local file.
+
+    The index is the latest snapshot plus the journal records posted after it. Only the
+    records missing from the local copy are downloaded, and nothing is downloaded when
+    the local copy already matches the latest index message.
+
     Returns:
-        The ID of the last message if successful, None otherwise.
+        The ID of the last index message if successful, None otherwise.
     """
+    global _index_state
+    head_message = find_latest_index_message()
+    if head_message is None:
+        logging.info("No index found in the channel.")
+        _index_state = {"head": None, "base": None, "records": []}
+        write_index_file({})  # Don't let a local copy of some older index stand in for the empty one
+        save_index_state(None)
+        return None
+
+    file = head_message["attachments"][0]
+    head = [head_message["id"], file["id"]]
+
+    cached = read_index_state()
+    if cached and cached["head"] == head and os.path.isfile(INDEX_FILE):
+        logging.info("Index unchanged, using local copy.")
+        _index_state = cached
+        return head_message["id"]
+
     try:
-        response = requests.get(f"{BASE_URL}{CHANNEL_ID}/messages?limit=1", headers=headers)
-        response.raise_for_status()  # Raises an HTTPError if the response was an error
-    except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred while loading index: {e}")
-        sys.exit()
-
-    messages = response.json()
-    if not messages:
-        logging.info("No messages found in the channel.")
+        if file["filename"] != JOURNAL_FILE:
+            data = download_index_attachment(file["url"])
+            file_index = parse_index(data)
+            state = {"head": head, "base": head, "records": [], "binary": data.startswith(MAGIC)}
+        else:
+            head_record = json.loads(download_index_attachment(file["url"]))
+            base = head_record["base"]
+            chain = head_record["records"] + [head]
+
+            if (cached and cached["base"] == base and os.path.isfile(INDEX_FILE)
+                    and chain[:len(cached["records"])] == cached["records"]):
+                file_index = get_file_index()
+                binary = cached.get("binary", False)
+                missing = chain[len(cached["records"]):]
+                extended = True
+            else:
+                data = download_index_pairs([base])[0] if base else b""
+                file_index = parse_index(data) if data else LazyIndex()
+                binary = data.startswith(MAGIC)
+                missing = chain
+                extended = False
+
+            records = [json.loads(content) for content in download_index_pairs(missing[:-1])] + [head_record]
+            for record in records:
+                apply_journal_record(file_index, record)
+            state = {"head": head, "base": base, "records": chain, "binary": binary}
+            if extended:
+                changed = {key for record in records for key in [*record.get("put", {}), *record.get("delete", [])]}
+                state = track_changes(state, cached, changed)
+
+        if "generation" not in state:
+            state = track_changes(state, cached, None)  # Rebuilt from a snapshot, so what changed is unknown
+        write_index_file(file_index)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logging.error(f"Failed to download the index file: {e}")
         return None
 
-    last_message = messages[0]
-    if not last_message.get("attachments"):
-        logging.info("No attachments found in the last message.")
+    _index_state = state
+    save_index_state(state)
+    return head_message["id"]
+
+def find_latest_index_message():
+    """
+    Finds the newest index snapshot or journal message in the channel, skipping chunk messages.
+
+    Returns:
+        dict: The message, or None if the channel holds no index.
+    """
+    before = None
+    limit = 1  # The newest message is almost always the index, so try it on its own first
+    while True:
+        params = {"limit": limit}
+        if before:
+            params["before"] = before
+        try:
+            response = api_request("GET", f"GET /channels/{CHANNEL_ID}/messages",
+                                            f"{BASE_URL}{CHANNEL_ID}/messages", params=params)
+            response.raise_for_status()  # Raises an HTTPError if the response was an error
+        except requests.exceptions.RequestException as e:
+            logging.error(f"An error occurred while loading index: {e}")
+            sys.exit()
+
+        messages = response.json()
+        for message in messages:
+            if is_index_message(message):
+                return message
+        if len(messages) < limit:
+            return None
+        before = messages[-1]["id"]
+        limit = 100
+
+def is_index_message(message):
+    """
+    Checks whether a message holds an index snapshot or journal record rather than a file chunk.
+
+    Chunk attachments are named "<encoded filename>.<chunk number>"; anything else with an
+    attachment is an index message (older versions posted snapshots without a filename).
+    """
+    attachments = message.get("attachments")
+    if not attachments:
+        return False
+    return not re.search(r"\.\d+$", attachments[0]["filename"])
+
+@telemetry.timed("index")
+def download_index_attachment(url):
+    with cdn_request(url, stream=False) as response:
+        response.raise_for_status()
+        return response.content
+
+def download_index_pairs(pairs):
+    """
+    Downloads several index attachments concurrently.
+
+    Args:
+        pairs (list): (message_id, attachment_id) pairs of the attachments.
+
+    Returns:
+        list: The content of each attachment, in the order of pairs.
+    """
+    if not pairs:
+        return []
+    urls = resolve_attachment_urls(pairs)
+    missing = [pair for pair in pairs if (str(pair[0]), str(pair[1])) not in urls]
+    if missing:
+        raise KeyError(f"index messages not found in the channel: {[pair[0] for pair in missing]}")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(download_index_attachment, [urls[(str(m), str(a))] for m, a in pairs]))
+
+def track_changes(state, previous, keys):
+    """
+    Numbers a new version of the local index and remembers which keys changed in it.
+
+    Args:
+        state (dict): The index state of the new version.
+        previous (dict): The index state of the version it was made from, or None.
+        keys (iterable): Keys added, changed or removed in the new version, or None if unknown.
+
+    Returns:
+        dict: The state, with the "lineage", "generation" and "log" of the new version.
+    """
+    previous = previous or {}
+    lineage = previous.get("lineage")
+    generation = previous.get("generation", 0) + 1 if lineage else 1
+    keys = sorted(keys) if keys is not None and len(keys) <= CHANGE_LOG_KEYS else None
+    log = (previous.get("log", []) if lineage else []) + [[generation, keys]]
+    return {**state, "lineage": lineage or os.urandom(8).hex(), "generation": generation, "log": log[-CHANGE_LOG_LENGTH:]}
+
+def get_index_position(state):
+    """
+    Returns the [lineage, generation] of the local index version a state describes, or None if it is not numbered.
+    """
+    if not state or "generation" not in state:
         return None
+    return [state["lineage"], state["generation"]]
 
-    file = last_message["attachments"][0]
-    filename = file["filename"]
-    url = file["url"]
+def get_changed_keys(state, position):
+    """
+    Collects the keys that changed in the local index since an earlier version of it.
+
+    Args:
+        state (dict): The current index state, as returned by read_index_state.
+        position (list): The [lineage, generation] of the earlier version, from get_index_position.
+
+    Returns:
+        set: The keys added, changed or removed since then, or None if they are not all known.
+    """
+    current = get_index_position(state)
+    if current is None or position is None or current[0] != position[0] or current[1] <= position[1]:
+        return None
+    versions = [keys for generation, keys in state["log"] if generation > position[1]]
+    if len(versions) != current[1] - position[1] or any(keys is None for keys in versions):
+        return None  # Older than the log reaches back, or a version replaced the whole index
+    return {key for keys in versions for key in keys}
 
+def apply_journal_record(file_index, record):
+    """
+    Applies the changes of one journal record to the file index in place.
+    """
+    file_index.update(record.get("put", {}))
+    for key in record.get("delete", []):
+        file_index.pop(key, None)
+
+def read_index_state():
+    """
+    Reads which remote index messages the local index file was built from.
+
+    Returns:
+        dict: The saved index state, or None if there is none.
+    """
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        with open(filename, "w") as f:  # Use the actual filename from the attachment
-            f.write(response.text)
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to download the index file: {e}")
+        with open(INDEX_CACHE_FILE, "r") as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
         return None
+    if not isinstance(state, dict) or "head" not in state:
+        return None  # Written by an older version; rebuild it
+    return state
 
-    return last_message["id"]
+def save_index_state(state):
+    """
+    Records which remote index messages the local index file was built from.
+    Passing None forgets it, so the next load downloads the index again.
+    """
+    try:
+        if state is None:
+            if os.path.exists(INDEX_CACHE_FILE):
+                os.remove(INDEX_CACHE_FILE)
+            return
+        with open(INDEX_CACHE_FILE, "w") as f:
+            json.dump(state, f)
+    except OSError as e:
+        logging.warning(f"Could not save index cache: {e}")
 
 def get_file_index():
     """
-    Reads the index file and returns its content as a dictionary.
+    Reads the index file and returns its content as a mapping of keys to index entries.
 
     Returns:
-        dict: The content of the index file if it exists and is valid JSON, otherwise an empty dictionary.
+        LazyIndex: The file index, decoding entries as they are accessed. Empty if the index
+            file does not exist or is not a valid index.
     """
     try:
-        with open(INDEX_FILE, "r") as f:
-            data = f.read()
-            return json.loads(data)
+        with open(INDEX_FILE, "rb") as f:
+            return parse_index(f.read())
     except FileNotFoundError as e:
         logging.warning(f"File not found: {e}")
-        return {}
-    except json.JSONDecodeError as e:
-        logging.warning(f"JSON decode error: {e}")
-    return {}
-    
-def update_file_index(index_id, file_index):
+    except ValueError as e:
+        logging.warning(f"Index decode error: {e}")
+    return LazyIndex()
+
+def write_index_file(file_index):
+    """
+    Saves the file index locally in the binary index format.
+    """
+    with open(INDEX_FILE, "wb") as f:
+        f.write(encode_index(file_index))
+
+def post_index_message(filename, data):
+    """
+    Posts an index snapshot or journal record as a message attachment.
+
+    Returns:
+        list: The [message_id, attachment_id] pair of the new message, or None on failure.
+    """
+    response = api_request("POST", f"POST /channels/{CHANNEL_ID}/messages",
+                                    f"{BASE_URL}{CHANNEL_ID}/messages", files={"file": (filename, data)})
+    if response.status_code != 200:
+        logging.error(f"An error occurred while updating index: {response.text}")
+        return None
+    message = response.json()
+    return [message["id"], message["attachments"][0]["id"]]
+
+@telemetry.timed("index")
+def update_file_index(index_id, file_index, changes=None):
+    """
+    Saves the file index locally and publishes the update to the channel.
+
+    With `changes`, only those entries are appended to the journal as a small record;
+    a key that is no longer in file_index is recorded as deleted. Without it, or once
+    the journal holds JOURNAL_COMPACT_EVERY records, a full snapshot is posted and the
+    snapshot and records it replaces are deleted afterwards, so a failure never leaves
+    the channel without an index.
+
+    Args:
+        index_id (str): ID of the last index message, as returned by load_file_index.
+        file_index (dict): The updated file index.
+        changes (list): Keys of file_index that were added, changed or removed.
+
+    Returns:
+        bool: Whether the update reached the channel.
+    """
+    global _index_state
     try:
-        # Using context manager for file operations
-        with open(INDEX_FILE, "w") as f:
-            json.dump(file_index, f)
-
-        # Ensure the file is closed after its content is read
-        with open(INDEX_FILE, "rb") as file_content:
-            files = {"": ("", file_content)}
-
-            # Deleting existing index file on the channel
-            if index_id:
-                logging.info("Deleting old index file")
-                response = requests.delete(f"{BASE_URL}{CHANNEL_ID}/messages/{index_id}", headers=headers)
-                if response.status_code != 204:
-                    logging.error(f"An error occurred while deleting old index file: {response.status_code} {response.text}")
-
-            # Uploading new updated index file
+        write_index_file(file_index)
+
+        state = _index_state
+        # A snapshot still in JSON is replaced by a binary one instead of being journaled on
+        if (changes is not None and state["head"] and state.get("binary")
+                and len(state["records"]) < JOURNAL_COMPACT_EVERY):
+            logging.info("Appending index update to journal")
+            record = {
+                "base": state["base"],
+                "records": state["records"],
+                "put": {key: file_index[key] for key in changes if key in file_index},
+                "delete": [key for key in changes if key not in file_index],
+            }
+            pair = post_index_message(JOURNAL_FILE, json.dumps(record).encode())
+            new_state = pair and {"head": pair, "base": state["base"], "records": state["records"] + [pair], "binary": True}
+            replaced = []
+        else:
             logging.info("Uploading new updated index file")
-            response = requests.post(f"{BASE_URL}{CHANNEL_ID}/messages", headers=headers, files=files)
-            if response.status_code != 200:
-                logging.error(f"An error occurred while updating index: {response.text}")
+            with open(INDEX_FILE, "rb") as file_content:
+                pair = post_index_message(INDEX_FILE, file_content.read())
+            new_state = pair and {"head": pair, "base": pair, "records": [], "binary": True}
+            replaced = [m for m, a in ([state["base"]] if state["base"] else []) + state["records"]]
+            if index_id and not replaced:
+                replaced = [index_id]
+
+        if new_state:
+            new_state = track_changes(new_state, state, changes)
+        else:
+            replaced = []  # Nothing was posted in their place, so they are still the index
+        # The local file only matches the channel if the post went through
+        _index_state = new_state or {"head": None, "base": None, "records": []}
+        save_index_state(new_state)
+
+        for message_id in replaced:
+            logging.info("Deleting old index file")
+            response = api_request("DELETE", f"DELETE /channels/{CHANNEL_ID}/messages",
+                                            f"{BASE_URL}{CHANNEL_ID}/messages/{message_id}")
+            if response.status_code != 204:
+                logging.error(f"An error occurred while deleting old index file: {response.status_code} {response.text}")
 
-            logging.info("Done.")
+        logging.info("Done.")
+        return bool(new_state)
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
\ No newline at end of file
+        save_index_state(None)
+        logging.error(f"An error occurred: {e}")
+        return False
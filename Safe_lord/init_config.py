@@ -1,6 +1,10 @@
 import os
 import sys
-from file_operations import list_files, upload_file, download_file, delete_file, find_file
+from file_operations import list_files, upload_file, pack_files, download_file, delete_file, find_file
+from garbage_collection import collect_garbage
+from directory_sync import sync_directory
+from telemetry import telemetry
+from utils import save_url_cache
 
 def init():
     commands = [
@@ -18,6 +22,13 @@ def init():
             "syntax": "-u path/to/file",
             "desc": "Uploads a file to the server. The full file directory is taken in for the argument.",
         },
+        {
+            "alias": ["-p", "-pack"],
+            "function": pack_files,
+            "minArgs": 1,
+            "syntax": "-p path/to/files ...",
+            "desc": "Uploads many small files packed together into shared chunks. Files and directories are taken in as arguments.",
+        },
         {
             "alias": ["-d", "-download"],
             "function": download_file,
@@ -30,14 +41,28 @@ def init():
             "function": delete_file,
             "minArgs": 1,
             "syntax": "-del #ID",
-            "desc": "Deletes a file from the server. An #ID is taken in as the file identifier",
+            "desc": "Deletes a file from the server. An #ID is taken in as the file identifier. Provide multiple ids separated by space to delete multiple files",
         },
         {
             "alias": ["-f", "-find"],
             "function": find_file,
             "minArgs": 1,
-            "syntax": "-f text_to_search",
-            "desc": "Finds files with matching text",
+            "syntax": "-f text_to_search [--glob PATTERN] [--regex PATTERN] [--min-size SIZE] [--max-size SIZE] [--after DATE] [--before DATE]",
+            "desc": "Finds files with matching text. Filenames can also be matched with a glob or regex, and files filtered by size (e.g. 10MB) and upload date (e.g. 2024-05-01)",
+        },
+        {
+            "alias": ["-gc", "-collect"],
+            "function": collect_garbage,
+            "minArgs": 0,
+            "syntax": "-gc [--dry-run]",
+            "desc": "Deletes chunk messages left behind by failed uploads and deletes. With --dry-run they are only reported.",
+        },
+        {
+            "alias": ["-sync"],
+            "function": sync_directory,
+            "minArgs": 1,
+            "syntax": "-sync path_to_directory [--dry-run]",
+            "desc": "Uploads the files of a directory that are new or changed since its last sync, each as its own file, and removes deleted ones. Unchanged files are recognised from their size and modification time.",
         },
     ]
 
@@ -77,7 +102,11 @@ def init():
                 print("Syntax: python", sys.argv[0], cmd["syntax"])
                 sys.exit()
             else:
-                cmd["function"](args[2:])
+                try:
+                    cmd["function"](args[2:])
+                finally:
+                    telemetry.save()  # Also for a command that failed or was interrupted
+                    save_url_cache()
             break
 
 
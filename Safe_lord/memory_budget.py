@@ -0,0 +1,133 @@
+import threading
+from config import MEMORY_LIMIT
+
+POLL_INTERVAL = 0.1  # Seconds a BufferPool waits before making room again
+
+
+class MemoryBudget:
+    """
+    Caps the bytes of chunk data that transfers hold in memory at once.
+
+    Uploads and downloads reserve the memory a chunk needs before they read or fetch it,
+    and wait while the rest of the process already holds the limit. A single reservation
+    larger than the whole limit is still granted once nothing else is held, so a chunk
+    never waits forever. All transfers of the process share one budget.
+    """
+
+    def __init__(self, limit=MEMORY_LIMIT):
+        """
+        :param limit: Bytes that may be reserved at once, or 0 for no limit.
+        """
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self, size):
+        """
+        Reserves `size` bytes if they fit right now.
+
+        :return: True if the bytes were reserved.
+        """
+        with self.condition:
+            if self.limit and self.used and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def acquire(self, size):
+        """
+        Reserves `size` bytes, waiting until enough of the budget is released.
+        """
+        with self.condition:
+            while self.limit and self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        """
+        Returns `size` bytes reserved with acquire() or try_acquire().
+        """
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        Waits until some of the budget is released, or at most `timeout` seconds.
+        """
+        with self.condition:
+            self.condition.wait(timeout)
+
+
+class BufferPool:
+    """
+    Hands out preallocated bytearrays for chunk payloads and takes them back for reuse.
+
+    Every buffer the pool allocated, in use or free, stays reserved in the memory budget.
+    A request that does not fit drops the free buffers to make room before it waits.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget or memory_budget
+        self.free = []
+        self.lock = threading.Lock()
+
+    def take(self, size, extra=0):
+        """
+        Returns a buffer of at least `size` bytes, also reserving `extra` bytes for the caller in the same step.
+
+        Reserving everything a chunk needs at once keeps a worker from holding part of the
+        budget while it waits for the rest.
+
+        :param size: Bytes the buffer must hold.
+        :param extra: Further bytes to reserve, given back with release() once they are no longer needed.
+        :return: A bytearray, possibly longer than `size`.
+        """
+        while True:
+            buffer = self.try_take(size, extra)
+            if buffer is not None:
+                return buffer
+            with self.lock:
+                dropped = sum(len(buffer) for buffer in self.free)
+                self.free = []
+            self.budget.release(dropped)
+            self.budget.wait(POLL_INTERVAL)
+
+    def try_take(self, size, extra=0):
+        """
+        Like take(), but returns None instead of waiting when the budget is used up.
+        """
+        with self.lock:
+            fitting = [buffer for buffer in self.free if len(buffer) >= size]
+            buffer = min(fitting, key=len) if fitting else None
+            if not self.budget.try_acquire(extra if buffer is not None else size + extra):
+                return None
+            if buffer is None:
+                return bytearray(size)
+            self.free.remove(buffer)
+            return buffer
+
+    def give(self, buffer):
+        """
+        Takes back a buffer returned by take() once its data is no longer needed.
+        """
+        with self.lock:
+            self.free.append(buffer)
+
+    def release(self, size):
+        """
+        Gives back the extra bytes reserved by take().
+        """
+        self.budget.release(size)
+
+    def close(self):
+        """
+        Frees the pool's free buffers and their reservations.
+        """
+        with self.lock:
+            dropped = sum(len(buffer) for buffer in self.free)
+            self.free = []
+        self.budget.release(dropped)
+
+
+memory_budget = MemoryBudget()
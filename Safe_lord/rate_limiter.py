@@ -0,0 +1,106 @@
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    Schedules requests against Discord's per-route rate-limit buckets.
+
+    Budgets are read from the X-RateLimit-* headers of earlier responses, so
+    concurrent workers wait for a bucket to reset instead of running into 429s.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._global_reset = 0.0
+
+    def _bucket(self, route):
+        if route not in self._buckets:
+            self._buckets[route] = {"limit": None, "remaining": None, "reset_at": 0.0, "inflight": 0}
+        return self._buckets[route]
+
+    def acquire(self, route):
+        """
+        Blocks until a request on the given route may be sent.
+
+        Args:
+            route (str): Key identifying the rate-limit bucket, e.g. "POST /channels/123/messages".
+        """
+        with self._cond:
+            while True:
+                bucket = self._bucket(route)
+                now = time.monotonic()
+                wait = self._global_reset - now
+                if wait <= 0:
+                    if bucket["limit"] is None:
+                        # Unknown bucket: send one probe request and learn the limits from its headers
+                        if bucket["inflight"] == 0:
+                            break
+                        wait = None
+                    else:
+                        if bucket["reset_at"] <= now:
+                            bucket["remaining"] = bucket["limit"]
+                        if bucket["remaining"] > 0:
+                            break
+                        wait = bucket["reset_at"] - now
+                self._cond.wait(wait)
+
+            bucket["inflight"] += 1
+            if bucket["remaining"] is not None:
+                bucket["remaining"] -= 1
+
+    def release(self, route):
+        """
+        Releases a slot taken by acquire() when the request never got a response.
+        """
+        with self._cond:
+            self._bucket(route)["inflight"] -= 1
+            self._cond.notify_all()
+
+    def update(self, route, response):
+        """
+        Records the rate-limit headers of a response and releases its slot.
+
+        Args:
+            route (str): The route passed to acquire().
+            response (requests.Response): The response received for the request.
+
+        Returns:
+            float: Seconds to wait before retrying if the request was rate limited (429), otherwise None.
+        """
+        retry_after = None
+        with self._cond:
+            bucket = self._bucket(route)
+            bucket["inflight"] -= 1
+            now = time.monotonic()
+            headers = response.headers
+
+            if "X-RateLimit-Limit" in headers:
+                bucket["limit"] = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                # Requests still in flight have not been counted by the server yet
+                bucket["remaining"] = max(0, int(headers["X-RateLimit-Remaining"]) - bucket["inflight"])
+            if "X-RateLimit-Reset-After" in headers:
+                bucket["reset_at"] = now + float(headers["X-RateLimit-Reset-After"])
+            if bucket["limit"] is None:
+                # The route did not report a bucket, so it is not limited per route
+                bucket["limit"] = bucket["remaining"] = float("inf")
+
+            if response.status_code == 429:
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                retry_after = float(body.get("retry_after", headers.get("Retry-After", 1)))
+                if body.get("global") or headers.get("X-RateLimit-Global"):
+                    self._global_reset = now + retry_after
+                else:
+                    bucket["remaining"] = 0
+                    bucket["reset_at"] = now + retry_after
+
+            self._cond.notify_all()
+        return retry_after
+
+
+limiter = RateLimiter()
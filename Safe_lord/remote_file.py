@@ -0,0 +1,243 @@
+import io
+import os
+import json
+import bisect
+import hashlib
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from index_management import load_file_index, get_file_index
+from utils import get_chunk_offsets, get_chunk_channels, resolve_attachment_urls
+from chunk_codec import get_download_decoder, get_chunk_hash_key
+from file_operations import download_chunk
+from file_utils import encode, decode
+from config import CHUNK_CACHE_DIR, CHUNK_CACHE_SIZE, READ_AHEAD, DOWNLOAD_WORKERS
+
+
+class ChunkCache:
+    """
+    Size-bounded on-disk cache of decoded chunks.
+
+    Every chunk is one file in CHUNK_CACHE_DIR. A file's modification time is its last use,
+    and the least recently used files are removed once the cache grows past `limit` bytes.
+    """
+
+    def __init__(self, directory=CHUNK_CACHE_DIR, limit=CHUNK_CACHE_SIZE):
+        self.directory = directory
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Returns the path of a cached chunk and marks it as used, or None if it is not cached.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, temporary_path, key):
+        """
+        Moves a downloaded chunk into the cache and evicts the least recently used chunks.
+
+        :return: The path of the cached chunk.
+        """
+        path = self.path(key)
+        os.replace(temporary_path, path)
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".part"):
+                    continue  # Still being downloaded
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for mtime, size, name in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.limit:
+                    break
+                if name == key:
+                    continue  # Needed right now, even if it alone is over the limit
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+        return path
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Seekable, read-only file object over a stored file.
+
+    Reads are mapped to the chunks that hold the requested bytes, and only those chunks are
+    downloaded. Downloaded chunks are kept in a ChunkCache, so reading the same region again,
+    or from another RemoteFile, does not fetch it again. While the file is read sequentially
+    the next READ_AHEAD chunks are fetched in the background.
+    """
+
+    def __init__(self, file_entry, cache=None, read_ahead=READ_AHEAD, workers=DOWNLOAD_WORKERS):
+        super().__init__()
+        self.entry = file_entry
+        self.name = decode(file_entry["filename"])
+        self.size = file_entry.get("size", 0)
+        self.offsets = get_chunk_offsets(file_entry)
+        self.cache = cache or ChunkCache()
+        self.read_ahead = read_ahead
+        self.new_decoder = get_download_decoder(file_entry)  # Raises ValueError if the file's key is missing
+        self.hash_key = get_chunk_hash_key(file_entry)
+        self.position = 0
+        self.current = None  # (chunk index, data) of the chunk last read
+        self.last_chunk = None
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(self.cache.directory, exist_ok=True)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        """
+        Fills `buffer` from the current position, downloading the chunks it spans.
+
+        :return: Number of bytes read; fewer than len(buffer) only at the end of the file.
+        """
+        view = memoryview(buffer).cast("B")
+        count = 0
+        while count < len(view) and self.position < self.size:
+            i = bisect.bisect_right(self.offsets, self.position) - 1
+            data = self._get_chunk(i)
+            start = self.position - self.offsets[i]
+            n = min(len(view) - count, len(data) - start)
+            if n <= 0:
+                raise OSError(f"Chunk {i + 1} of {self.name} is shorter than the index says")
+            view[count:count + n] = data[start:start + n]
+            count += n
+            self.position += n
+        return count
+
+    def close(self):
+        if not self.closed:
+            for future in self.futures.values():
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.current = None
+        super().close()
+
+    def _get_chunk(self, i):
+        if self.current is not None and self.current[0] == i:
+            return self.current[1]
+
+        future = self._fetch(i)
+        # Read ahead only while the file is read front to back, not for scattered seeks
+        if i == 0 or (self.last_chunk is not None and i == self.last_chunk + 1):
+            for k in range(i + 1, min(i + 1 + self.read_ahead, len(self.offsets))):
+                self._fetch(k)
+        self.last_chunk = i
+
+        self.current = (i, future.result())  # A failed chunk is fetched again on the next read
+        return self.current[1]
+
+    def _fetch(self, i):
+        with self.lock:
+            future = self.futures.get(i)
+            if future is not None:
+                return future
+            future = self.futures[i] = self.executor.submit(self._download, i)
+        # Finished chunks are found in the cache, so a seek away from read-ahead chunks does not keep them in memory.
+        # Added outside the lock, as it runs right away if the download already finished.
+        future.add_done_callback(partial(self._forget, i))
+        return future
+
+    def _forget(self, i, future):
+        with self.lock:
+            if self.futures.get(i) is future:
+                del self.futures[i]
+
+    def _chunk_key(self, i):
+        if "hashes" in self.entry:
+            return self.entry["hashes"][i]  # Identical chunks of different files share a cache entry
+        ranges = self.entry.get("ranges")
+        pair = self.entry["urls"][i]
+        return hashlib.sha1(json.dumps([str(pair[0]), str(pair[1]), ranges[i] if ranges else None]).encode()).hexdigest()
+
+    def _download(self, i):
+        key = self._chunk_key(i)
+        path = self.cache.get(key)
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass  # Evicted in the meantime
+
+        message_id, attachment_id = self.entry["urls"][i]
+        channel_id = get_chunk_channels(self.entry)[i]
+        download_url = resolve_attachment_urls([(message_id, attachment_id)], [channel_id]).get((str(message_id), str(attachment_id)))
+        temporary_path = f"{self.cache.path(key)}.{threading.get_ident()}.part"
+        with open(temporary_path, "w+b") as f:
+            downloaded = download_chunk(message_id, attachment_id, download_url, f, threading.Lock(), 0,
+                                        self.new_decoder and (lambda: self.new_decoder(i)),
+                                        self.entry.get("hashes", [None] * (i + 1))[i],
+                                        self.entry["ranges"][i] if "ranges" in self.entry else None, channel_id,
+                                        self.hash_key)
+            f.seek(0)
+            data = f.read() if downloaded else None
+        if not downloaded:
+            os.remove(temporary_path)
+            raise OSError(f"Chunk {i + 1} of {self.name} could not be downloaded")
+        # A read-ahead chunk evicted before it is read is downloaded again
+        self.cache.add(temporary_path, key)
+        return data
+
+
+def open_remote(file_id, cache=None):
+    """
+    Opens a stored file for random-access reading without downloading all of it.
+
+    Parameters:
+    file_id (int or str): Number of the file as shown by -list, or its name.
+    cache (ChunkCache): Cache of downloaded chunks; a cache in CHUNK_CACHE_DIR by default.
+
+    Returns:
+    RemoteFile: A seekable, read-only binary file object. Raises KeyError if there is no such file.
+    """
+    load_file_index()
+    file_index = get_file_index()
+    if isinstance(file_id, int):
+        keys = list(file_index)
+        if not 1 <= file_id <= len(keys):
+            raise KeyError(f"Invalid ID provided: {file_id}")
+        entry = file_index[keys[file_id - 1]]
+    else:
+        entry = file_index[encode(file_id)]
+    return RemoteFile(entry, cache)
@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import base64
+import bisect
+import fnmatch
+import logging
+from array import array
+from index_management import get_file_index, read_index_state, get_index_position, get_changed_keys
+from utils import get_snowflake_time
+from file_utils import decode
+from config import INDEX_FILE, SEARCH_INDEX_FILE
+
+SEARCH_INDEX_VERSION = 1
+REGEX_SPECIAL = ".^$*+?{}[]()|\\"
+# An escape with all its arguments: hex, Unicode and named characters, octal escapes, backreferences, or one character
+REGEX_ESCAPE = re.compile(r"\\(?:x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}?|0[0-7]{0,2}|[1-7][0-7]{2}|\d{1,2}|.)",
+                          re.DOTALL)
+VERIFY_DIRECTLY = 64  # Candidates few enough to check by name instead of narrowing them down further
+
+
+def get_upload_time(message_ids):
+    """
+    Returns the Unix time a file was uploaded, read from the snowflake ID of its first chunk message,
+    or None if it has no chunks.
+    """
+    if not message_ids:
+        return None
+    return get_snowflake_time(message_ids[0])
+
+
+def get_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_glob_literals(pattern):
+    """
+    Returns the runs of literal text every name matching a glob pattern contains.
+    """
+    return [run for run in re.split(r"\*|\?|\[[^\]]*\]?", pattern) if run]
+
+
+def get_regex_literals(pattern):
+    """
+    Returns runs of literal text every match of a regular expression contains.
+
+    Only plain characters and escaped punctuation count. Any other escape, such as \\d, \\x41
+    or a backreference, ends a run, and a character followed by a quantifier that allows zero
+    repetitions is dropped. Patterns with groups or alternation are not analysed and give no
+    runs, so they are checked against every name.
+    """
+    if "|" in pattern or "(" in pattern:
+        return []
+    runs = [""]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            escape = REGEX_ESCAPE.match(pattern, i).group()
+            i += len(escape)
+            if len(escape) == 2 and not escape[1].isalnum():
+                runs[-1] += escape[1]
+            else:
+                runs.append("")  # A class such as \d, an assertion such as \b, or a character given by its code
+        elif char == "[":
+            end = pattern.find("]", i + 2)
+            i = end + 1 if end != -1 else len(pattern)
+            runs.append("")
+        elif char in "*?{":
+            runs[-1] = runs[-1][:-1]  # The repeated character may not be there at all
+            runs.append("")
+            i += 1
+            if char == "{":
+                i = pattern.find("}", i) + 1 or len(pattern)
+        elif char in REGEX_SPECIAL:
+            runs.append("")
+            i += 1
+        else:
+            runs[-1] += char
+            i += 1
+    return [run for run in runs if run]
+
+
+class SearchIndex:
+    """
+    Trigram index over the decoded names of the stored files, kept in SEARCH_INDEX_FILE.
+
+    Every file has a record [key, name, size, upload time, number] in a slot that never moves;
+    removed files leave an empty slot behind. Every trigram of a lowercase name maps to the
+    sorted slots of the names containing it, so a query only checks the few names that hold
+    all trigrams of its literal text. Slots are also kept sorted by size and by upload time
+    for queries that only filter on those.
+
+    refresh() brings the index up to date with INDEX_FILE. It skips reading INDEX_FILE at all
+    when it has not changed, and otherwise only looks at the keys changed since the index was
+    last built, as recorded with the local index's version. Only when those are not known
+    does it pass over every file, and even then it decodes just the files added.
+    """
+
+    def __init__(self, path=SEARCH_INDEX_FILE):
+        self.path = path
+        self.clear()
+
+    def clear(self):
+        self.source = None  # [size, mtime_ns] of the INDEX_FILE the records were built from
+        self.position = None  # [lineage, generation] of that version of the local index
+        self.records = []
+        self.slots = {}  # Key -> slot, built from the records when they are refreshed
+        self.trigrams = {}  # Trigram -> array of slots, or the packed array until a query needs it
+        self.by_size = array("I")
+        self.by_time = array("I")  # Slots of files with an upload time
+
+    @classmethod
+    def load(cls, path=SEARCH_INDEX_FILE):
+        """
+        Reads a saved search index. An unreadable or outdated one is replaced by an empty index, which refresh() rebuilds.
+        """
+        index = cls(path)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != SEARCH_INDEX_VERSION:
+                return index
+            index.source = data["source"]
+            index.position = data.get("position")
+            index.records = data["records"]
+            index.slots = None
+            index.trigrams = data["trigrams"]
+            index.by_size = unpack_slots(data["by_size"])
+            index.by_time = unpack_slots(data["by_time"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Rebuilding unreadable search index: {e}")
+            index = cls(path)
+        return index
+
+    def save(self):
+        data = {
+            "version": SEARCH_INDEX_VERSION,
+            "source": self.source,
+            "position": self.position,
+            "records": self.records,
+            "trigrams": {trigram: slots if isinstance(slots, str) else pack_slots(slots)
+                         for trigram, slots in self.trigrams.items()},
+            "by_size": pack_slots(self.by_size),
+            "by_time": pack_slots(self.by_time),
+        }
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                f.write(json.dumps(data))  # json.dump() would encode in pure Python
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.warning(f"Could not save search index: {e}")
+
+    def refresh(self):
+        """
+        Updates the index to match INDEX_FILE and saves it if anything changed.
+        """
+        try:
+            stat = os.stat(INDEX_FILE)
+            source = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            source = None
+        if source == self.source and source is not None:
+            return
+
+        state = read_index_state()
+        changed = get_changed_keys(state, self.position) if self.records else None
+        file_index = get_file_index()
+        if self.slots is None:
+            self.slots = {record[0]: slot for slot, record in enumerate(self.records) if record is not None}
+        if changed is not None and len(self.records) - len(self.slots) <= len(file_index):
+            removed, added = self._apply_changes(file_index, changed)
+            if len(self.slots) != len(file_index):
+                logging.warning("Rebuilding search index that is out of step with the index")
+                self.clear()
+                removed, added = self._compare(file_index)
+        else:
+            removed, added = self._compare(file_index)
+
+        if added or removed:
+            # Re-sorting after all changes is linear for the few new slots appended to an already sorted order
+            self.by_size = array("I", sorted([slot for slot in self.by_size if slot not in removed] + added,
+                                             key=lambda slot: self.records[slot][2]))
+            self.by_time = array("I", sorted([slot for slot in self.by_time if slot not in removed]
+                                             + [slot for slot in added if self.records[slot][3] is not None],
+                                             key=lambda slot: self.records[slot][3]))
+        self.source = source
+        self.position = get_index_position(state)
+        self.save()
+
+    def _compare(self, file_index):
+        """
+        Brings the records up to date by comparing every file of the index with them.
+
+        :return: The slots removed and the slots added.
+        """
+        removed = [key for key in self.slots if key not in file_index]
+        if len(self.records) - len(self.slots) + len(removed) > len(file_index):
+            self.clear()  # Mostly empty slots, so start over
+            removed = []
+        removed = {self._remove(key) for key in removed}
+        added = []
+
+        # Sizes and message IDs are read without decoding the entries
+        for number, key in enumerate(file_index, 1):
+            size = file_index.get_size(key)
+            uploaded = get_upload_time(file_index.get_message_ids(key))
+            slot = self.slots.get(key)
+            if slot is not None:
+                record = self.records[slot]
+                if record[2] == size and record[3] == uploaded:
+                    record[4] = number  # Numbers shift when files before it are deleted
+                    continue
+                removed.add(self._remove(key))  # Replaced by another upload under the same name
+            added.append(self._add(key, size, uploaded, number))
+        return removed, added
+
+    def _apply_changes(self, file_index, changed):
+        """
+        Brings the records up to date with the keys added, changed or removed since they were built.
+
+        :return: The slots removed and the slots added.
+        """
+        removed = set()
+        added = []
+        renumber = False
+        for key in changed:
+            number = None
+            if key in self.slots:
+                number = self.records[self.slots[key]][4]
+                removed.add(self._remove(key))
+            if key in file_index:
+                added.append(self._add(key, file_index.get_size(key), get_upload_time(file_index.get_message_ids(key)), number))
+            renumber = renumber or number is None or key not in file_index
+        if renumber:
+            # Added files go to the end and removed ones shift the files after them, so only the numbers are read
+            for number, key in enumerate(file_index, 1):
+                slot = self.slots.get(key)
+                if slot is not None:
+                    self.records[slot][4] = number
+        return removed, added
+
+    def _count_postings(self, trigram):
+        slots = self.trigrams.get(trigram, ())
+        return len(slots) * 3 // 16 if isinstance(slots, str) else len(slots)  # Base64 of 4-byte slots
+
+    def _get_postings(self, trigram):
+        slots = self.trigrams.get(trigram)
+        if isinstance(slots, str):
+            slots = self.trigrams[trigram] = unpack_slots(slots)
+        return slots
+
+    def _add(self, key, size, uploaded, number):
+        slot = len(self.records)
+        name = decode(key)
+        self.records.append([key, name, size, uploaded, number])
+        self.slots[key] = slot
+        for trigram in get_trigrams(name.lower()):
+            if self._get_postings(trigram) is None:
+                self.trigrams[trigram] = array("I")
+            self.trigrams[trigram].append(slot)  # New slots are the largest, so this stays sorted
+        return slot
+
+    def _remove(self, key):
+        slot = self.slots.pop(key)
+        for trigram in get_trigrams(self.records[slot][1].lower()):
+            slots = self._get_postings(trigram)
+            slots.remove(slot)
+            if not slots:
+                del self.trigrams[trigram]
+        self.records[slot] = None
+        return slot
+
+    def search(self, text=None, glob=None, regex=None, min_size=None, max_size=None, after=None, before=None):
+        """
+        Finds the files matching all of the given conditions.
+
+        Parameters:
+        text (str): Case-insensitive substring of the filename.
+        glob (str): Case-insensitive glob pattern the whole filename matches, e.g. "*.zip".
+        regex (str): Case-insensitive regular expression found in the filename.
+        min_size, max_size (int): Bounds on the file size in bytes, inclusive.
+        after, before (float): Bounds on the upload time as a Unix time; files without one never match.
+
+        Returns:
+        list: The (number, name, size) of every match, in index order. Raises re.error for an invalid regex.
+        """
+        conditions = []
+        literals = []
+        if text:
+            text = text.lower()
+            conditions.append(lambda name: text in name)
+            literals.append(text)
+        if glob:
+            glob = glob.lower()
+            conditions.append(lambda name: fnmatch.fnmatchcase(name, glob))
+            literals += get_glob_literals(glob)
+        if regex:
+            compiled = re.compile(regex, re.IGNORECASE)
+            conditions.append(lambda name: compiled.search(name) is not None)
+            literals += [run.lower() for run in get_regex_literals(regex)]
+
+        records = [self.records[slot] for slot in self._get_candidates(literals, min_size, max_size, after, before)]
+        records = [record for record in records if record is not None]
+        for condition in conditions:
+            records = [record for record in records if condition(record[1].lower())]
+        if min_size is not None or max_size is not None:
+            records = [record for record in records if (min_size is None or record[2] >= min_size)
+                       and (max_size is None or record[2] <= max_size)]
+        if after is not None or before is not None:
+            records = [record for record in records if record[3] is not None and (after is None or record[3] >= after)
+                       and (before is None or record[3] < before)]
+        return sorted((number, name, size) for key, name, size, uploaded, number in records)
+
+    def _get_candidates(self, literals, min_size, max_size, after, before):
+        """
+        Narrows the query down to the slots that can match, using the most selective structure available.
+        """
+        trigrams = {trigram for literal in literals for trigram in get_trigrams(literal)}
+        if trigrams:
+            # Rarest trigrams first; their packed length gives the order without unpacking them
+            trigrams = sorted(trigrams, key=self._count_postings)
+            candidates = set(self._get_postings(trigrams[0]) or ())
+            for trigram in trigrams[1:]:
+                if len(candidates) <= VERIFY_DIRECTLY:
+                    break  # Checking these names is cheaper than intersecting with a common trigram
+                candidates.intersection_update(self._get_postings(trigram))
+            return candidates
+        if min_size is not None or max_size is not None:
+            size = lambda slot: self.records[slot][2]
+            start = bisect.bisect_left(self.by_size, min_size, key=size) if min_size is not None else 0
+            end = bisect.bisect_right(self.by_size, max_size, key=size) if max_size is not None else len(self.by_size)
+            return self.by_size[start:end]
+        if after is not None or before is not None:
+            uploaded = lambda slot: self.records[slot][3]
+            start = bisect.bisect_left(self.by_time, after, key=uploaded) if after is not None else 0
+            end = bisect.bisect_left(self.by_time, before, key=uploaded) if before is not None else len(self.by_time)
+            return self.by_time[start:end]
+        return range(len(self.records))
+
+
+def pack_slots(slots):
+    return base64.b64encode(array("I", slots).tobytes()).decode()
+
+
+def unpack_slots(text):
+    slots = array("I")
+    slots.frombytes(base64.b64decode(text))
+    return slots
+
+
+def load_search_index():
+    """
+    Returns the search index, updated to match the local INDEX_FILE.
+    """
+    index = SearchIndex.load()
+    index.refresh()
+    return index
@@ -0,0 +1,51 @@
+import itertools
+import threading
+from config import TOKEN, STRIPES, STRIPE_POLICY
+
+
+class StripeSet:
+    """
+    Spreads uploaded messages across the configured (token, channel) pairs.
+
+    Every channel has its own rate-limit buckets, so messages posted to several channels are
+    sent side by side instead of queueing behind one channel's budget. With the "load" policy
+    each message goes to the channel with the fewest bytes in flight, with "round-robin" the
+    channels take turns.
+    """
+
+    def __init__(self, stripes=STRIPES, policy=STRIPE_POLICY):
+        self.channels = list(dict.fromkeys(str(channel_id) for token, channel_id in stripes))
+        self.tokens = {str(channel_id): token for token, channel_id in stripes}
+        self.policy = policy
+        self.load = dict.fromkeys(self.channels, 0)  # Channel ID -> bytes being posted to it
+        self.turns = itertools.cycle(range(len(self.channels)))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.channels)
+
+    def acquire(self, size):
+        """
+        Picks the channel to post a message of `size` bytes to. Call release() once it is posted.
+
+        :return: The channel ID.
+        """
+        with self.lock:
+            start = next(self.turns)
+            order = self.channels[start:] + self.channels[:start]  # Ties go to the channel whose turn it is
+            channel_id = order[0] if self.policy == "round-robin" else min(order, key=self.load.get)
+            self.load[channel_id] += size
+            return channel_id
+
+    def release(self, channel_id, size):
+        with self.lock:
+            self.load[channel_id] -= size
+
+    def get_token(self, channel_id):
+        """
+        Returns the bot token for requests in a channel. Channels that are not configured are accessed with TOKEN.
+        """
+        return self.tokens.get(str(channel_id), TOKEN)
+
+
+stripes = StripeSet()
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from file_utils import get_size_format
+from config import TELEMETRY_FILE, TRACE_FILE
+
+PERCENTILES = (50, 95, 99)  # Request latency percentiles in the summary
+
+
+class Telemetry:
+    """
+    Records how long every request and transfer step takes, and how much it moves.
+
+    Each API and CDN request is recorded with its latency, the bytes sent and received, its
+    retries and the time spent waiting out 429 responses. Steps of the upload, download,
+    index and delete paths are recorded as spans, and requests made inside a span are
+    counted towards its category. Totals are always kept, so progress displays can report
+    throughput; the events themselves are only kept when TELEMETRY_FILE or TRACE_FILE asks
+    for them to be written.
+    """
+
+    def __init__(self, keep_events=bool(TELEMETRY_FILE or TRACE_FILE)):
+        """
+        :param keep_events: Keep every event for save(), not just the totals.
+        """
+        self.keep_events = keep_events
+        self.events = []
+        self.totals = {}  # Category -> counters of its requests and spans
+        self.transferred = 0  # Bytes sent and received by all requests
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.started = time.time()
+
+    def get_category(self):
+        """
+        :return: Category of the innermost span running on this thread, or None outside of spans.
+        """
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def record_request(self, kind, name, start, sent=0, received=0, retries=0, rate_limited=0, rate_limit_wait=0.0,
+                       status=None, error=None):
+        """
+        Records a finished request.
+
+        :param kind: "api" or "cdn".
+        :param name: What was requested, e.g. the rate-limit route.
+        :param start: time.perf_counter() when the request was started.
+        :param sent: Bytes of the request body.
+        :param received: Bytes of the response body.
+        :param retries: Attempts made after the first.
+        :param rate_limited: Number of 429 responses received.
+        :param rate_limit_wait: Seconds spent waiting for the rate limits to reset after them.
+        :param status: HTTP status of the last response, or None if there was none.
+        :param error: The exception the request failed with, if any.
+        """
+        duration = time.perf_counter() - start
+        category = self.get_category() or kind
+        with self.lock:
+            totals = self._get_totals(category)
+            totals["requests"] += 1
+            totals["request_time"] += duration
+            totals["sent"] += sent
+            totals["received"] += received
+            totals["retries"] += retries
+            totals["rate_limited"] += rate_limited
+            totals["rate_limit_wait"] += rate_limit_wait
+            totals["errors"] += error is not None or (status or 0) >= 400
+            self.transferred += sent + received
+            if self.keep_events:
+                self.events.append({"type": "request", "kind": kind, "category": category, "name": name,
+                                    "start": start - self.origin, "duration": duration, "thread": threading.current_thread().name,
+                                    "sent": sent, "received": received, "retries": retries, "rate_limited": rate_limited,
+                                    "rate_limit_wait": rate_limit_wait, "status": status,
+                                    "error": repr(error) if error is not None else None})
+
+    @contextmanager
+    def span(self, category, name, **args):
+        """
+        Records how long the body of a with statement takes as one step of a transfer.
+
+        :param category: The path the step belongs to: "upload", "download", "index" or "delete".
+        :param name: What the step does, e.g. "post message".
+        :param args: Details stored with the span, e.g. bytes=...; the body may add more to the yielded dict.
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(category)
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                totals = self._get_totals(category)
+                totals["spans"] += 1
+                totals["span_time"] += duration
+                if self.keep_events:
+                    self.events.append({"type": "span", "category": category, "name": name, "start": start - self.origin,
+                                        "duration": duration, "thread": threading.current_thread().name, **args})
+
+    def timed(self, category, name=None):
+        """
+        Decorator recording every call of a function as a span.
+
+        :param category: The path the function belongs to, as for span().
+        :param name: Name of the span, or None for the function's name.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(category, name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _get_totals(self, category):
+        if category not in self.totals:
+            self.totals[category] = {"requests": 0, "request_time": 0.0, "sent": 0, "received": 0, "retries": 0,
+                                     "rate_limited": 0, "rate_limit_wait": 0.0, "errors": 0, "spans": 0, "span_time": 0.0}
+        return self.totals[category]
+
+    def summarize(self):
+        """
+        Sums up the recorded requests of every category.
+
+        :return: Category -> its totals, plus the request latency percentiles in seconds ("p50", "p95", ...)
+            when the events were kept.
+        """
+        with self.lock:
+            summary = {category: dict(totals) for category, totals in self.totals.items()}
+            latencies = {}
+            for event in self.events:
+                if event["type"] == "request":
+                    latencies.setdefault(event["category"], []).append(event["duration"])
+        for category, durations in latencies.items():
+            durations.sort()
+            for percentile in PERCENTILES:
+                summary[category][f"p{percentile}"] = durations[min(len(durations) - 1, len(durations) * percentile // 100)]
+        return summary
+
+    def save(self, events_path=TELEMETRY_FILE, trace_path=TRACE_FILE):
+        """
+        Writes the recorded events and prints a summary of the requests.
+
+        :param events_path: File the events are written to as JSON lines, or None.
+        :param trace_path: File the events are written to in the Chrome trace format, for chrome://tracing
+            or Perfetto, or None.
+        """
+        if not self.keep_events or not (events_path or trace_path):
+            return
+        with self.lock:
+            events = list(self.events)
+        try:
+            if events_path:
+                with open(events_path, "w") as f:
+                    for event in events:
+                        f.write(json.dumps({**event, "start": self.started + event["start"]}) + "\n")
+            if trace_path:
+                with open(trace_path, "w") as f:
+                    json.dump(get_trace(events), f)
+        except OSError as e:
+            logging.error(f"Could not write telemetry: {e}")
+            return
+
+        for category, totals in sorted(self.summarize().items()):
+            if not totals["requests"]:
+                continue
+            latency = ", ".join(f"p{percentile} {totals[f'p{percentile}'] * 1000:.0f}ms" for percentile in PERCENTILES
+                                if f"p{percentile}" in totals)
+            print(f"{category}: {totals['requests']} requests ({latency}), {get_size_format(totals['sent'] + totals['received'])}, "
+                  f"{totals['retries']} retries, {totals['rate_limited']} rate limited ({totals['rate_limit_wait']:.1f}s waiting)")
+
+
+def get_trace(events):
+    """
+    Converts recorded events to the Chrome trace event format.
+
+    Every thread gets its own track, with requests nested in the spans they were made in.
+
+    :param events: Events as recorded by Telemetry.
+    :return: The trace, as a JSON-serializable dict.
+    """
+    threads = {}
+    trace = []
+    for event in events:
+        tid = threads.setdefault(event["thread"], len(threads) + 1)
+        args = {key: value for key, value in event.items() if key not in ("type", "category", "name", "start", "duration", "thread")}
+        trace.append({"name": event["name"], "cat": event["category"], "ph": "X", "ts": event["start"] * 1e6,
+                      "dur": event["duration"] * 1e6, "pid": os.getpid(), "tid": tid, "args": args})
+    for name, tid in threads.items():
+        trace.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+telemetry = Telemetry()
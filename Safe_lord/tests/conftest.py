@@ -0,0 +1,61 @@
+import os
+import sys
+import logging
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_discord import FakeDiscord
+
+# config reads the environment once on import, so the fake server has to be up before any module under test is imported
+fake_discord = FakeDiscord()
+os.environ.update(TOKEN="test-token", CHANNEL_ID="1", DISCORD_API_BASE=fake_discord.start())
+for name in ("STRIPES", "ENCRYPTION_KEY", "COMPRESSION", "MEMORY_LIMIT", "CONTENT_DEFINED_CHUNKING", "TELEMETRY_FILE",
+             "TRACE_FILE"):
+    os.environ.pop(name, None)
+
+import config
+
+config.CHUNK_SIZE = 64 * 1000  # Files of a few hundred KB already take several chunks
+
+import index_management
+import utils
+from memory_budget import memory_budget
+
+logging.disable(logging.INFO)
+
+
+@pytest.fixture(autouse=True)
+def workspace(tmp_path, monkeypatch):
+    """
+    Runs every test in an empty directory against an empty channel.
+    """
+    monkeypatch.chdir(tmp_path)
+    with fake_discord.lock:
+        fake_discord.messages.clear()
+        fake_discord.attachments.clear()
+        fake_discord.buckets.clear()
+    monkeypatch.setattr(index_management, "_index_state", {"head": None, "base": None, "records": []})
+    monkeypatch.setattr(utils, "_url_cache", None)
+    monkeypatch.setattr(utils, "_url_cache_changed", False)
+    yield tmp_path
+    assert memory_budget.used == 0, "a transfer did not give back its memory"
+
+
+@pytest.fixture
+def fake():
+    return fake_discord
+
+
+@pytest.fixture
+def make_file():
+    """
+    Returns a function that writes `size` random bytes to a path, creating its directory, and returns them.
+    """
+    def make(path, size):
+        data = os.urandom(size)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return data
+    return make
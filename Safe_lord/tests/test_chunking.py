@@ -0,0 +1,42 @@
+import io
+import os
+from chunking import content_defined_chunks, find_boundary, hash_chunk, new_chunk_hash
+
+MIN_SIZE, AVG_SIZE, MAX_SIZE = 1000, 4000, 16000
+
+
+def chunk(data):
+    return list(content_defined_chunks(io.BytesIO(data), MIN_SIZE, AVG_SIZE, MAX_SIZE))
+
+
+def test_chunks_cover_the_file_within_bounds():
+    data = os.urandom(300000)
+    chunks = chunk(data)
+    assert b"".join(chunks) == data
+    assert all(MIN_SIZE <= len(c) <= MAX_SIZE for c in chunks[:-1]) and 0 < len(chunks[-1]) <= MAX_SIZE
+    assert MIN_SIZE < len(data) / len(chunks) < MAX_SIZE
+
+
+def test_boundaries_move_with_inserted_data():
+    data = os.urandom(300000)
+    before = chunk(data)
+    after = chunk(data[:1000] + b"inserted" + data[1000:])
+    # Only the chunks around the edit change
+    assert len(set(before) - set(after)) <= 2
+
+
+def test_data_without_boundaries_is_cut_at_max_size():
+    assert [len(c) for c in chunk(bytes(2 * MAX_SIZE + 5))] == [MAX_SIZE, MAX_SIZE, 5]
+    assert find_boundary(b"\x9e" * 10, 20, 100, 0) == 10
+
+
+def test_empty_file_has_no_chunks():
+    assert chunk(b"") == []
+
+
+def test_incremental_hash_matches():
+    data = os.urandom(5000)
+    incremental = new_chunk_hash()
+    incremental.update(data[:1234])
+    incremental.update(data[1234:])
+    assert incremental.hexdigest() == hash_chunk(data) == hash_chunk(memoryview(data))
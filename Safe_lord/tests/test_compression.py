@@ -0,0 +1,75 @@
+import os
+import pytest
+import chunk_codec
+import file_operations
+import index_management
+from compression import pack_chunk, compress, new_decompressor, estimate_input_size
+from file_utils import encode
+from config import CHUNK_SIZE, COMPRESSION_MAX_INPUT
+
+TEXT = b"".join(b"line %d of a log file\n" % n for n in range(20000))
+
+
+def unpack(pieces):
+    data = b""
+    for piece, payload, codec in pieces:
+        if codec == "raw":
+            data += bytes(payload)
+        else:
+            decompressor = new_decompressor(codec)
+            data += decompressor.decompress(payload) + decompressor.flush()
+    return data
+
+
+@pytest.mark.parametrize("codec, level", [("zlib", 6), ("lzma", 1)])
+def test_compressible_data_is_compressed(codec, level):
+    pieces = pack_chunk(TEXT, codec, level, limit=len(TEXT))
+    assert [piece_codec for piece, payload, piece_codec in pieces] == [codec]
+    assert len(pieces[0][1]) < len(TEXT) / 4
+    assert unpack(pieces) == TEXT
+
+
+def test_incompressible_data_is_stored_raw():
+    data = os.urandom(100000)
+    pieces = pack_chunk(data, "zlib", 6, limit=len(data))
+    assert [piece_codec for piece, payload, piece_codec in pieces] == ["raw"]
+    assert isinstance(pieces[0][1], memoryview) and pieces[0][1] == data  # A view of the input, not a copy
+
+
+def test_output_larger_than_the_limit_is_split():
+    data = os.urandom(50000).hex().encode()  # Compresses to about half
+    pieces = pack_chunk(data, "zlib", 6, limit=20000)
+    assert len(pieces) > 1 and all(len(payload) <= 20000 for piece, payload, codec in pieces)
+    assert unpack(pieces) == data
+
+
+def test_input_size_grows_with_compressibility():
+    assert estimate_input_size(os.urandom(CHUNK_SIZE)) == CHUNK_SIZE
+    assert CHUNK_SIZE < estimate_input_size(TEXT[:CHUNK_SIZE]) <= COMPRESSION_MAX_INPUT
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        compress(TEXT, "brotli", 6)
+    with pytest.raises(ValueError):
+        new_decompressor("brotli")
+    with pytest.raises(ValueError):
+        pack_chunk(TEXT, "brotli", 6)
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_mixed_file_round_trip(codec, monkeypatch):
+    monkeypatch.setattr(file_operations, "COMPRESSION", codec)
+    monkeypatch.setattr(chunk_codec, "COMPRESSION", codec)
+    data = os.urandom(2 * CHUNK_SIZE) + TEXT
+    with open("mixed.bin", "wb") as f:
+        f.write(data)
+    file_operations.upload_file(["mixed.bin"])
+    entry = index_management.get_file_index()[encode("mixed.bin")]
+    # Each chunk is compressed or stored on its own, depending on how well it compresses
+    assert {"raw", codec} <= set(entry["codecs"])
+    assert entry["size"] == len(data)
+
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "mixed.bin"), "rb") as f:
+        assert f.read() == data
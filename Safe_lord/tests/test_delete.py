@@ -0,0 +1,74 @@
+import pytest
+import requests
+import utils
+import file_operations
+import index_management
+from file_utils import encode
+from config import CHANNEL_ID, CHUNK_SIZE, BULK_DELETE_MAX_AGE
+
+
+def post_messages(fake, count):
+    host = f"127.0.0.1:{fake.server.server_port}"
+    return [fake.post_message(CHANNEL_ID, host, "", [(f"x.{n}", b"x")])["id"] for n in range(count)]
+
+
+@pytest.fixture
+def stats(fake):
+    """
+    Returns a function giving the number of each delete request made since the test started.
+    """
+    start = dict(fake.stats)
+    return lambda name: fake.stats[name] - start.get(name, 0)
+
+
+def age(monkeypatch, message_ids):
+    old = set(message_ids)
+    get_snowflake_time = utils.get_snowflake_time
+    monkeypatch.setattr(utils, "get_snowflake_time",
+                        lambda snowflake: get_snowflake_time(snowflake) - (BULK_DELETE_MAX_AGE + 60 if snowflake in old else 0))
+
+
+def test_recent_messages_are_deleted_in_batches(fake, stats):
+    message_ids = post_messages(fake, 250)
+    handled = []
+    assert utils.delete_messages(CHANNEL_ID, message_ids, handled.append) == set(message_ids)
+    assert stats("POST bulk_delete") == 3 and stats("DELETE delete_message") == 0
+    assert sum(handled) == 250 and not fake.messages[CHANNEL_ID]
+
+
+def test_old_messages_are_deleted_one_by_one(fake, stats, monkeypatch):
+    message_ids = post_messages(fake, 105)
+    age(monkeypatch, message_ids[:4])
+    assert utils.delete_messages(CHANNEL_ID, message_ids) == set(message_ids)
+    # A batch of one is not allowed either, so the last recent message goes on its own too
+    assert stats("POST bulk_delete") == 1 and stats("DELETE delete_message") == 5
+    assert not fake.messages[CHANNEL_ID]
+
+
+def test_missing_message_counts_as_deleted(fake, stats, monkeypatch):
+    message_ids = post_messages(fake, 2)
+    fake.delete_messages(CHANNEL_ID, message_ids[:1])
+    age(monkeypatch, message_ids)
+    assert utils.delete_messages(CHANNEL_ID, message_ids) == set(message_ids)
+    assert stats("DELETE delete_message") == 2
+
+
+def test_file_with_a_failed_delete_stays_in_the_index(make_file, fake, monkeypatch):
+    for name in ("a.bin", "b.bin", "c.bin"):
+        make_file(name, 2 * CHUNK_SIZE)
+        file_operations.upload_file([name])
+    file_index = index_management.get_file_index()
+    stuck = file_index.get_message_ids(encode("b.bin"))[0]
+    api_request = utils.api_request
+
+    def failing_request(method, route, url, **kwargs):
+        if stuck in url or stuck in kwargs.get("json", {}).get("messages", []):
+            raise requests.ConnectionError("connection reset")
+        return api_request(method, route, url, **kwargs)
+
+    monkeypatch.setattr(utils, "api_request", failing_request)
+    file_operations.delete_file(["1", "2", "3"])
+    assert list(index_management.get_file_index()) == [encode("b.bin")]
+    remaining = [message_id for message_id in fake.messages[CHANNEL_ID]
+                 if not index_management.is_index_message(fake.messages[CHANNEL_ID][message_id])]
+    assert remaining == [stuck]  # The messages of a.bin and c.bin are gone
@@ -0,0 +1,108 @@
+import os
+import pytest
+import directory_sync
+import file_operations
+import index_management
+from file_utils import encode
+from config import CHANNEL_ID, CHUNK_SIZE
+
+CHANGES = ("POST create_message", "DELETE delete_message", "POST bulk_delete")
+
+
+@pytest.fixture
+def synced(make_file, monkeypatch):
+    """
+    A directory "d" with two small files, packed together, and a large one, synced once.
+    """
+    monkeypatch.setattr(directory_sync, "PACK_FILE_LIMIT", 1000)
+    files = {"a.txt": make_file("d/a.txt", 100), "b.txt": make_file("d/b.txt", 200),
+             "big.bin": make_file("d/big.bin", 3 * CHUNK_SIZE)}
+    directory_sync.sync_directory(["d"])
+    assert sorted(index_management.get_file_index()) == sorted(encode(f"d/{name}") for name in files)
+    return files
+
+
+def changes(fake):
+    return sum(fake.stats[name] for name in CHANGES)
+
+
+def get_messages(name):
+    return set(index_management.get_file_index().get_message_ids(encode(name)))
+
+
+def download(name):
+    keys = list(index_management.get_file_index())
+    file_operations.download_file([str(keys.index(encode(name)) + 1)])
+    with open(os.path.join("downloads", name), "rb") as f:
+        return f.read()
+
+
+def touch(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_touched_file_is_not_uploaded(synced, fake):
+    touch("d/big.bin")
+    before = changes(fake)
+    directory_sync.sync_directory(["d"])
+    assert changes(fake) == before
+
+
+def test_modified_file_replaces_its_chunks_after_the_index_update(synced, make_file, fake, monkeypatch):
+    old = get_messages("d/big.bin")
+    update_file_index = directory_sync.update_file_index
+    still_stored = []
+
+    def checked_update(*args):
+        still_stored.append(old <= set(fake.messages[CHANNEL_ID]))
+        return update_file_index(*args)
+
+    monkeypatch.setattr(directory_sync, "update_file_index", checked_update)
+    data = make_file("d/big.bin", 3 * CHUNK_SIZE)
+    touch("d/big.bin")
+    directory_sync.sync_directory(["d"])
+    assert still_stored == [True]
+    assert not old & set(fake.messages[CHANNEL_ID])
+    assert download("d/big.bin") == data
+
+
+def test_shared_pack_is_kept_until_no_file_uses_it(synced, make_file, fake):
+    pack = get_messages("d/b.txt")
+    assert pack == get_messages("d/a.txt")
+    data = make_file("d/a.txt", 150)
+    directory_sync.sync_directory(["d"])
+    # The old version of a.txt shared its pack with b.txt, which is unchanged
+    assert pack <= set(fake.messages[CHANNEL_ID])
+    assert download("d/a.txt") == data and download("d/b.txt") == synced["b.txt"]
+
+    os.remove("d/b.txt")
+    directory_sync.sync_directory(["d"])
+    assert encode("d/b.txt") not in index_management.get_file_index()
+    assert not pack & set(fake.messages[CHANNEL_ID])
+    assert download("d/a.txt") == data
+
+
+def test_locally_deleted_file_is_removed(synced, fake):
+    old = get_messages("d/big.bin")
+    os.remove("d/big.bin")
+    directory_sync.sync_directory(["d"])
+    assert encode("d/big.bin") not in index_management.get_file_index()
+    assert not old & set(fake.messages[CHANNEL_ID])
+    assert download("d/a.txt") == synced["a.txt"]
+
+
+def test_dry_run_changes_nothing(synced, make_file, fake, capsys):
+    make_file("d/new.txt", 10)
+    make_file("d/a.txt", 150)
+    os.remove("d/big.bin")
+    messages = dict(fake.messages[CHANNEL_ID])
+    before = changes(fake)
+    capsys.readouterr()
+    directory_sync.sync_directory(["d", "--dry-run"])
+    assert changes(fake) == before and fake.messages[CHANNEL_ID] == messages
+    assert "1 new, 1 changed, 1 deleted" in capsys.readouterr().out
+
+    # The real run still finds every change
+    directory_sync.sync_directory(["d"])
+    assert sorted(index_management.get_file_index()) == sorted(encode(f"d/{name}") for name in ("a.txt", "b.txt", "new.txt"))
@@ -0,0 +1,107 @@
+import os
+import hmac
+import hashlib
+import pytest
+import chunk_codec
+import file_operations
+import index_management
+from chunking import hash_chunk
+from encryption import get_hash_key
+from file_utils import encode
+from utils import get_chunk_offsets
+from config import CHUNK_SIZE
+
+KEY = bytes(range(32))
+
+
+@pytest.fixture
+def key(monkeypatch):
+    monkeypatch.setattr(chunk_codec, "load_key", lambda: KEY)
+    return KEY
+
+
+def get_entry(name):
+    return index_management.get_file_index()[encode(name)]
+
+
+def read_download(name):
+    with open(os.path.join("downloads", name), "rb") as f:
+        return f.read()
+
+
+def count_chunk_messages(fake):
+    return sum(not index_management.is_index_message(m) for m in fake.messages["1"].values())
+
+
+def chunks_of(entry, data):
+    offsets = get_chunk_offsets(entry) + [len(data)]
+    return [data[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def test_encrypted_round_trip(key, make_file, fake):
+    data = make_file("data.bin", 3 * CHUNK_SIZE + 5)
+    file_operations.upload_file(["data.bin"])
+    entry = get_entry("data.bin")
+    assert len(entry["nonces"]) == len(entry["urls"]) and entry["hashing"] == chunk_codec.KEYED_HASHING
+    assert not any(data[:64] in stored for stored in fake.attachments.values())
+
+    # The hashes are keyed, so they cannot be matched against the SHA-256 of known content
+    chunks = chunks_of(entry, data)
+    assert entry["hashes"] == [hmac.new(get_hash_key(key), chunk, hashlib.sha256).hexdigest() for chunk in chunks]
+    assert not set(entry["hashes"]) & {hashlib.sha256(chunk).hexdigest() for chunk in chunks}
+
+    file_operations.download_file(["1"])
+    assert read_download("data.bin") == data
+
+
+def test_tampered_chunk_is_rejected(key, make_file, fake):
+    data = make_file("data.bin", 3 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    entry = get_entry("data.bin")
+    attachment_id = entry["urls"][1][1]
+    stored = bytearray(fake.attachments[attachment_id])
+    stored[100] ^= 1
+    fake.attachments[attachment_id] = bytes(stored)
+
+    file_operations.download_file(["1"])
+    offsets = get_chunk_offsets(entry)
+    written = read_download("data.bin")
+    assert written[:offsets[1]] == data[:offsets[1]] and written[offsets[2]:] == data[offsets[2]:]
+    assert written[offsets[1]:offsets[2]] != data[offsets[1]:offsets[2]]
+
+
+def test_wrong_key_downloads_nothing(key, make_file, monkeypatch):
+    make_file("data.bin", CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    monkeypatch.setattr(chunk_codec, "load_key", lambda: bytes(32))
+    file_operations.download_file(["1"])
+    assert read_download("data.bin") == bytes(CHUNK_SIZE)  # Only the preallocated file
+
+
+def test_keyed_hashes_deduplicate(key, make_file, fake, monkeypatch):
+    monkeypatch.setattr(file_operations, "CONTENT_DEFINED_CHUNKING", True)
+    data = make_file("a.bin", 3 * CHUNK_SIZE)
+    make_file("b.bin", 0)
+    with open("b.bin", "wb") as f:
+        f.write(data)
+    file_operations.upload_file(["a.bin"])
+    messages = count_chunk_messages(fake)
+    file_operations.upload_file(["b.bin"])
+    assert count_chunk_messages(fake) == messages
+    assert get_entry("b.bin")["hashes"] == get_entry("a.bin")["hashes"]
+    file_operations.download_file(["2"])
+    assert read_download("b.bin") == data
+
+
+def test_plain_hashes_of_older_encrypted_files_still_verify(key, make_file):
+    # Encrypted files uploaded before hashes were keyed record the SHA-256 of their chunks
+    data = make_file("data.bin", 2 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    file_index = index_management.get_file_index()
+    entry = file_index[encode("data.bin")]
+    del entry["hashing"]
+    entry["hashes"] = [hash_chunk(chunk) for chunk in chunks_of(entry, data)]
+    index_management.write_index_file(file_index)
+
+    file_operations.download_file(["1"])
+    assert read_download("data.bin") == data
@@ -0,0 +1,56 @@
+import os
+import garbage_collection
+import file_operations
+from checkpoints import Checkpoint
+from utils import get_snowflake_time
+from config import CHANNEL_ID, CHUNK_SIZE, GC_MIN_AGE
+
+
+def post(fake, content="", files=()):
+    return fake.post_message(CHANNEL_ID, f"127.0.0.1:{fake.server.server_port}", content, list(files))["id"]
+
+
+def age(monkeypatch, message_ids):
+    """
+    Makes the given messages older than GC_MIN_AGE.
+    """
+    old = set(message_ids)
+    monkeypatch.setattr(garbage_collection, "get_snowflake_time",
+                        lambda snowflake: get_snowflake_time(snowflake) - (2 * GC_MIN_AGE if str(snowflake) in old else 0))
+
+
+def test_only_old_orphans_are_deleted(make_file, fake, monkeypatch):
+    data = make_file("data.bin", 3 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    indexed = set(fake.messages[CHANNEL_ID])
+    orphan = post(fake, files=[("lost.bin.0", b"x" * 10)])
+    recent = post(fake, files=[("running.bin.0", b"x" * 10)])
+    checkpointed = post(fake, files=[("resumable.bin.0", b"x" * 10)])
+    attachment_id = fake.messages[CHANNEL_ID][checkpointed]["attachments"][0]["id"]
+    Checkpoint("upload", "resumable.bin").record(0, [[[checkpointed, attachment_id], {}]])
+    chat = post(fake, content="hello")
+    age(monkeypatch, indexed | {orphan, checkpointed, chat})
+
+    garbage_collection.collect_garbage(["--dry-run"])
+    assert orphan in fake.messages[CHANNEL_ID]
+
+    garbage_collection.collect_garbage([])
+    assert set(fake.messages[CHANNEL_ID]) == indexed | {recent, checkpointed, chat}
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "data.bin"), "rb") as f:
+        assert f.read() == data
+
+
+def test_nothing_is_collected_without_an_index(make_file, fake, monkeypatch, capsys):
+    orphan = post(fake, files=[("lost.bin.0", b"x" * 10)])
+    age(monkeypatch, [orphan])
+    garbage_collection.collect_garbage([])
+    assert orphan in fake.messages[CHANNEL_ID]
+    assert "No index" in capsys.readouterr().out
+
+    # Nor when the index cannot be read
+    make_file("data.bin", 10)
+    file_operations.upload_file(["data.bin"])
+    monkeypatch.setattr(garbage_collection, "load_file_index", lambda: None)
+    garbage_collection.collect_garbage([])
+    assert orphan in fake.messages[CHANNEL_ID]
@@ -0,0 +1,109 @@
+import os
+import json
+import pytest
+import index_management
+from index_format import encode_index, parse_index, encode_record, decode_record, LazyIndex, MAGIC
+from file_utils import encode
+from config import CHANNEL_ID, INDEX_FILE
+
+ENTRIES = {
+    "plain": {"filename": "plain", "size": 300, "urls": [["1234567890123456789", "1234567890123456790"]]},
+    "extras": {"filename": "extras", "size": 10, "urls": [["11", "12"], ["13", "14"]], "key_id": "ab12",
+               "compression": "zlib", "codecs": ["zlib", "raw"], "nonces": ["00ff" * 6, "11ee" * 6],
+               "hashes": ["ab" * 32, "cd" * 32], "sizes": [6, 4], "channels": ["1", "2"]},
+    "packed": {"filename": "d/packed.txt", "size": 5, "urls": [["21", "22"]], "ranges": [[1000, 5]]},
+    "no name": {"size": 1, "urls": [["31", "32"]]},
+    "empty": {"filename": "empty", "size": 0, "urls": []},
+}
+
+# Values the packed types cannot hold, which have to survive in the JSON extra instead
+OVERFLOWING = {
+    "huge size": {"filename": "huge size", "size": 1 << 64, "urls": [["41", "42"]]},
+    "negative": {"filename": "negative", "size": -1, "urls": [["43", "44"]], "ranges": [[-5, 1]]},
+    "wide ids": {"filename": "wide ids", "size": 1, "urls": [[str(1 << 64), "45"]], "channels": ["0123"]},
+    "odd hashes": {"filename": "odd hashes", "size": 1, "urls": [["46", "47"]], "hashes": ["abc", "ABCD"]},
+    "mixed": {"filename": "mixed", "size": "1", "urls": [["48", 49]], "sizes": [1.5], "ranges": [[1, 2, 3]]},
+}
+
+
+def test_round_trip():
+    index = {**ENTRIES, **OVERFLOWING}
+    data = encode_index(index)
+    assert data.startswith(MAGIC)
+    parsed = parse_index(data)
+    assert list(parsed) == list(index)
+    assert {key: parsed[key] for key in parsed} == index
+
+
+@pytest.mark.parametrize("key", list(ENTRIES) + list(OVERFLOWING))
+def test_record_round_trip(key):
+    entry = {**ENTRIES, **OVERFLOWING}[key]
+    assert decode_record(key, encode_record(key, entry), 0) == entry
+
+
+def test_lazy_access_without_decoding():
+    parsed = parse_index(encode_index({**ENTRIES, **OVERFLOWING}))
+    assert parsed.get_size("plain") == 300
+    assert parsed.get_size("huge size") == 1 << 64
+    assert parsed.get_message_ids("extras") == ["11", "13"]
+    assert parsed.get_message_ids("mixed") == ["48"]
+    assert parsed.get_message_ids("empty") == []
+    # Only entries whose values overflowed into the JSON extra had to be decoded
+    assert set(parsed._entries) == {"huge size", "mixed"}
+
+
+def test_untouched_records_are_copied():
+    data = encode_index(ENTRIES)
+    parsed = parse_index(data)
+    assert encode_index(parsed) == data
+    parsed["packed"]["size"] = 6
+    parsed["new"] = {"filename": "new", "size": 2, "urls": [["51", "52"]]}
+    del parsed["no name"]
+    reparsed = parse_index(encode_index(parsed))
+    assert list(reparsed) == ["plain", "extras", "packed", "empty", "new"]
+    assert reparsed["packed"]["size"] == 6
+    assert reparsed["new"] == parsed["new"]
+
+
+def test_json_index_is_read():
+    parsed = parse_index(json.dumps(ENTRIES).encode())
+    assert isinstance(parsed, LazyIndex)
+    assert dict(parsed) == ENTRIES
+    assert parsed.get_size("plain") == 300
+
+
+@pytest.mark.parametrize("data", [MAGIC + b"\1", encode_index(ENTRIES)[:-1], b"{not json"])
+def test_corrupt_index_is_rejected(data):
+    with pytest.raises(ValueError):
+        parse_index(data)
+
+
+def test_json_snapshot_migrates_to_binary(fake):
+    # An index posted by a version before the binary format
+    key = encode("old.txt")
+    old = {key: {"filename": key, "size": 3, "urls": [["61", "62"]]}}
+    message = fake.post_message(CHANNEL_ID, f"127.0.0.1:{fake.server.server_port}", "", [("index.json", json.dumps(old).encode())])
+
+    head = index_management.load_file_index()
+    assert head == message["id"]
+    file_index = index_management.get_file_index()
+    assert dict(file_index) == old
+
+    added = encode("new.txt")
+    file_index[added] = {"filename": added, "size": 1, "urls": [["63", "64"]]}
+    assert index_management.update_file_index(head, file_index, [added])
+
+    # Instead of a journal record on top of the JSON snapshot, a binary snapshot replaces it
+    messages = list(fake.messages[CHANNEL_ID].values())
+    assert message["id"] not in fake.messages[CHANNEL_ID]
+    snapshot = fake.attachments[messages[-1]["attachments"][0]["id"]]
+    assert snapshot.startswith(MAGIC)
+    assert dict(parse_index(snapshot)) == {**old, added: file_index[added]}
+
+    # A later update is journaled on top of the binary snapshot
+    del file_index[key]
+    assert index_management.update_file_index(messages[-1]["id"], file_index, [key])
+    assert messages[-1]["id"] in fake.messages[CHANNEL_ID]
+    os.remove(INDEX_FILE)
+    index_management.load_file_index()
+    assert dict(index_management.get_file_index()) == {added: file_index[added]}
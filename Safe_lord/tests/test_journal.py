@@ -0,0 +1,97 @@
+import os
+import shutil
+import index_management
+from file_utils import encode
+from config import CHANNEL_ID, INDEX_FILE, INDEX_CACHE_FILE, JOURNAL_FILE
+
+
+def add_file(name):
+    """
+    Adds an entry to the index the way an upload does, and returns the new head message.
+    """
+    head = index_management.load_file_index()
+    file_index = index_management.get_file_index()
+    key = encode(name)
+    file_index[key] = {"filename": key, "size": len(name), "urls": [[str(100 + len(file_index)), "1"]]}
+    assert index_management.update_file_index(head, file_index, [key])
+    return expected_index(file_index)
+
+
+def expected_index(file_index):
+    return {key: file_index[key] for key in file_index}
+
+
+def index_messages(fake):
+    return {message_id: message["attachments"][0]["filename"] for message_id, message in fake.messages[CHANNEL_ID].items()
+            if index_management.is_index_message(message)}
+
+
+def forget_local_index(monkeypatch):
+    for path in (INDEX_FILE, INDEX_CACHE_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    monkeypatch.setattr(index_management, "_index_state", {"head": None, "base": None, "records": []})
+
+
+def test_journal_is_replayed_from_a_cold_cache(fake, monkeypatch):
+    for name in ("a.txt", "b.txt", "c.txt", "d.txt"):
+        expected = add_file(name)
+    # One snapshot, then a journal record per update
+    assert sorted(index_messages(fake).values()) == [INDEX_FILE] + [JOURNAL_FILE] * 3
+
+    forget_local_index(monkeypatch)
+    index_management.load_file_index()
+    assert expected_index(index_management.get_file_index()) == expected
+
+
+def test_cached_chain_is_extended_with_the_missing_records(fake, monkeypatch):
+    add_file("a.txt")
+    add_file("b.txt")
+    shutil.copy(INDEX_FILE, "index.old")
+    shutil.copy(INDEX_CACHE_FILE, "cache.old")
+    for name in ("c.txt", "d.txt", "e.txt"):
+        expected = add_file(name)
+
+    # This copy is three records behind the channel
+    shutil.copy("index.old", INDEX_FILE)
+    shutil.copy("cache.old", INDEX_CACHE_FILE)
+    downloads = fake.stats["cdn_requests"]
+    index_management.load_file_index()
+    assert fake.stats["cdn_requests"] - downloads == 3  # The missing records only, not the snapshot
+    assert expected_index(index_management.get_file_index()) == expected
+
+
+def test_journal_is_compacted_into_a_snapshot(fake, monkeypatch):
+    monkeypatch.setattr(index_management, "JOURNAL_COMPACT_EVERY", 2)
+    for name in ("a.txt", "b.txt", "c.txt"):
+        add_file(name)
+    replaced = index_messages(fake)
+    assert sorted(replaced.values()) == [INDEX_FILE, JOURNAL_FILE, JOURNAL_FILE]
+
+    expected = add_file("d.txt")
+    messages = index_messages(fake)
+    assert list(messages.values()) == [INDEX_FILE] and not set(messages) & set(replaced)
+    forget_local_index(monkeypatch)
+    index_management.load_file_index()
+    assert expected_index(index_management.get_file_index()) == expected
+
+
+def test_failed_compaction_deletes_nothing(fake, monkeypatch):
+    monkeypatch.setattr(index_management, "JOURNAL_COMPACT_EVERY", 2)
+    for name in ("a.txt", "b.txt", "c.txt"):
+        expected = add_file(name)
+    replaced = index_messages(fake)
+
+    post_index_message = index_management.post_index_message
+    monkeypatch.setattr(index_management, "post_index_message", lambda filename, data: None)
+    head = index_management.load_file_index()
+    file_index = index_management.get_file_index()
+    file_index[encode("d.txt")] = {"filename": encode("d.txt"), "size": 1, "urls": [["200", "1"]]}
+    assert not index_management.update_file_index(head, file_index, [encode("d.txt")])
+    assert index_messages(fake) == replaced
+
+    # The channel still holds the index from before the update
+    monkeypatch.setattr(index_management, "post_index_message", post_index_message)
+    forget_local_index(monkeypatch)
+    index_management.load_file_index()
+    assert expected_index(index_management.get_file_index()) == expected
@@ -0,0 +1,74 @@
+import threading
+import chunk_codec
+from memory_budget import MemoryBudget, BufferPool
+
+
+def test_only_copying_transforms_reserve_room_for_their_payload(monkeypatch):
+    # Hashing alone still builds a transform, but its payload is the chunk itself
+    transform, fields = chunk_codec.get_upload_transform()
+    assert transform is not None and not transform.copies
+    monkeypatch.setattr(chunk_codec, "COMPRESSION", "zlib")
+    transform, fields = chunk_codec.get_upload_transform()
+    assert transform.copies
+
+
+def test_budget_caps_reservations():
+    budget = MemoryBudget(100)
+    assert budget.try_acquire(60)
+    assert not budget.try_acquire(50)
+    assert budget.try_acquire(40)
+    budget.release(100)
+    assert budget.used == 0
+
+
+def test_reservation_larger_than_the_limit_is_granted_alone():
+    budget = MemoryBudget(100)
+    assert budget.try_acquire(500)
+    assert not budget.try_acquire(1)
+    budget.release(500)
+    budget.acquire(500)
+    assert budget.used == 500
+
+
+def test_no_limit():
+    budget = MemoryBudget(0)
+    assert budget.try_acquire(1 << 40) and budget.try_acquire(1 << 40)
+
+
+def test_acquire_waits_for_release():
+    budget = MemoryBudget(100)
+    budget.acquire(80)
+    thread = threading.Thread(target=budget.acquire, args=(50,))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    budget.release(80)
+    thread.join(5)
+    assert not thread.is_alive() and budget.used == 50
+
+
+def test_pool_reuses_buffers():
+    budget = MemoryBudget(100)
+    pool = BufferPool(budget)
+    buffer = pool.take(30, extra=20)
+    assert len(buffer) == 30 and budget.used == 50
+    pool.give(buffer)
+    pool.release(20)
+    # A free buffer stays reserved and is handed out again; a smaller request takes the smallest that fits
+    assert pool.take(10, extra=5) is buffer and budget.used == 35
+    pool.give(buffer)
+    pool.release(5)
+    pool.close()
+    assert budget.used == 0
+
+
+def test_pool_drops_free_buffers_to_make_room():
+    budget = MemoryBudget(100)
+    pool = BufferPool(budget)
+    pool.give(pool.take(60))
+    assert pool.try_take(80) is None  # The free buffer is too small and still reserved
+    buffer = pool.take(80)
+    assert len(buffer) == 80 and budget.used == 80 and not pool.free
+    pool.give(buffer)
+    pool.close()
+    assert budget.used == 0
@@ -0,0 +1,33 @@
+import io
+import time
+import file_operations
+from remote_file import open_remote
+from config import CHUNK_SIZE
+
+
+def test_random_access(make_file):
+    data = make_file("data.bin", 6 * CHUNK_SIZE + 10)
+    file_operations.upload_file(["data.bin"])
+    with open_remote(1) as remote:
+        assert remote.read(100) == data[:100]
+        remote.seek(4 * CHUNK_SIZE - 5)
+        assert remote.read(10) == data[4 * CHUNK_SIZE - 5:4 * CHUNK_SIZE + 5]
+        remote.seek(-3, io.SEEK_END)
+        assert remote.read() == data[-3:]
+    with open_remote("data.bin") as remote:
+        assert remote.read() == data
+
+
+def test_read_ahead_is_not_kept_after_a_seek(make_file):
+    data = make_file("data.bin", 8 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    with open_remote(1) as remote:
+        assert remote.read(2 * CHUNK_SIZE) == data[:2 * CHUNK_SIZE]  # Reads chunks 0-1 and fetches the next ones ahead
+        remote.seek(6 * CHUNK_SIZE)
+        assert remote.read(10) == data[6 * CHUNK_SIZE:6 * CHUNK_SIZE + 10]
+        deadline = time.monotonic() + 5
+        while remote.futures and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not remote.futures  # Finished read-ahead chunks are left to the cache
+        remote.seek(2 * CHUNK_SIZE)
+        assert remote.read(CHUNK_SIZE) == data[2 * CHUNK_SIZE:3 * CHUNK_SIZE]
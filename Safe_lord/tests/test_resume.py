@@ -0,0 +1,59 @@
+import os
+import requests
+import download_pipeline
+import file_operations
+from config import CHUNK_SIZE
+
+
+def chunk_names(fake):
+    return [a["filename"] for m in fake.messages.get("1", {}).values() for a in m["attachments"]
+            if not a["filename"].startswith("index")]
+
+
+def test_interrupted_upload_posts_only_missing_chunks(make_file, fake, monkeypatch):
+    monkeypatch.setattr(file_operations, "ATTACHMENTS_PER_MESSAGE", 1)
+    data = make_file("data.bin", 13 * CHUNK_SIZE)
+    post_attachments = file_operations.post_attachments
+
+    def failing_post(attachments, label, *args, **kwargs):
+        if label == "chunk 3/13":
+            raise requests.ConnectionError("connection reset")
+        return post_attachments(attachments, label, *args, **kwargs)
+
+    monkeypatch.setattr(file_operations, "post_attachments", failing_post)
+    file_operations.upload_file(["data.bin"])
+    first_run = chunk_names(fake)
+    assert first_run and len(first_run) < 13 and os.listdir(".checkpoints")
+
+    monkeypatch.setattr(file_operations, "post_attachments", post_attachments)
+    file_operations.upload_file(["data.bin"])
+    names = chunk_names(fake)
+    # Every chunk is posted exactly once over both runs, including those still in flight when the first run failed
+    assert sorted(names) == sorted(set(names)) and len(names) == 13
+    assert not os.listdir(".checkpoints")
+
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "data.bin"), "rb") as f:
+        assert f.read() == data
+
+
+def test_interrupted_download_fetches_only_missing_chunks(make_file, monkeypatch):
+    data = make_file("data.bin", 6 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    fetch_job = download_pipeline.fetch_job
+    fetched = []
+
+    def failing_fetch(job, *args):
+        fetched.append(job["chunk"])
+        return (None, True) if job["chunk"] in (1, 4) else fetch_job(job, *args)
+
+    monkeypatch.setattr(download_pipeline, "fetch_job", failing_fetch)
+    file_operations.download_file(["1"])
+    assert sorted(fetched) == list(range(6))
+
+    fetched.clear()
+    monkeypatch.setattr(download_pipeline, "fetch_job", lambda job, *args: fetched.append(job["chunk"]) or fetch_job(job, *args))
+    file_operations.download_file(["1"])
+    assert sorted(fetched) == [1, 4]
+    with open(os.path.join("downloads", "data.bin"), "rb") as f:
+        assert f.read() == data
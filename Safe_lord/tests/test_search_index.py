@@ -0,0 +1,84 @@
+import shutil
+import pytest
+import index_management
+from search_index import SearchIndex, get_regex_literals, load_search_index
+from file_utils import encode
+from config import INDEX_FILE, INDEX_CACHE_FILE
+
+
+@pytest.mark.parametrize("pattern, literals", [
+    (r"report\d+\.pdf", ["report", ".pdf"]),
+    (r"a\.b\-c", ["a.b-c"]),
+    (r"\x41bc", ["bc"]),
+    (r"\u0041bcd", ["bcd"]),
+    (r"\N{LATIN SMALL LETTER A}bcd", ["bcd"]),
+    (r"\101xyz", ["xyz"]),
+    (r"\0xyz", ["xyz"]),
+    (r"ab\bcd", ["ab", "cd"]),
+    (r"abcd?e", ["abc", "e"]),
+    (r"(ab)\1cde", []),
+])
+def test_regex_literals(pattern, literals):
+    assert get_regex_literals(pattern) == literals
+
+
+def add_files(names, message_id=1000):
+    head = index_management.load_file_index()
+    file_index = index_management.get_file_index()
+    for n, name in enumerate(names):
+        key = encode(name)
+        file_index[key] = {"filename": key, "size": len(name), "urls": [[str(message_id + n), str(message_id + n)]]}
+    assert index_management.update_file_index(head, file_index, [encode(name) for name in names])
+
+
+def remove_files(names):
+    head = index_management.load_file_index()
+    file_index = index_management.get_file_index()
+    for name in names:
+        del file_index[encode(name)]
+    assert index_management.update_file_index(head, file_index, [encode(name) for name in names])
+
+
+def names(results):
+    return [(number, name) for number, name, size in results]
+
+
+def test_escaped_characters_match():
+    add_files(["Abc.txt", "abd.txt", "x\n.txt"])
+    index = load_search_index()
+    assert names(index.search(regex=r"\x41bc")) == [(1, "Abc.txt")]
+    assert names(index.search(regex=r"ab[cd]\.txt")) == [(1, "Abc.txt"), (2, "abd.txt")]
+    assert names(index.search(regex=r"\101b\x64")) == [(2, "abd.txt")]
+
+
+def test_refresh_applies_only_the_changed_keys(monkeypatch):
+    add_files([f"file{n}.txt" for n in range(20)])
+    load_search_index()
+
+    def compare(self, file_index):
+        raise AssertionError("passed over every file")
+    monkeypatch.setattr(SearchIndex, "_compare", compare)
+
+    add_files(["new.bin"], message_id=2000)
+    remove_files(["file3.txt", "file4.txt"])
+    index = load_search_index()
+    assert names(index.search("new")) == [(19, "new.bin")]
+    assert names(index.search("file5")) == [(4, "file5.txt")]  # Moved up by the removed files
+    assert index.search("file3") == []
+
+    # A client that was behind downloads the journal records it missed, and knows their keys as well
+    shutil.copy(INDEX_FILE, "index.old")
+    shutil.copy(INDEX_CACHE_FILE, "state.old")
+    add_files(["later.bin"], message_id=3000)
+    shutil.copy("index.old", INDEX_FILE)
+    shutil.copy("state.old", INDEX_CACHE_FILE)
+    index_management.load_file_index()
+    assert names(load_search_index().search("later")) == [(20, "later.bin")]
+
+
+def test_unknown_changes_are_found_by_comparing():
+    add_files(["a.txt", "b.txt"])
+    load_search_index()
+    add_files(["c.txt"])
+    index_management.save_index_state(None)  # E.g. an update that could not be posted
+    assert names(load_search_index().search(".txt")) == [(1, "a.txt"), (2, "b.txt"), (3, "c.txt")]
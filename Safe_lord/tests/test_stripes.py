@@ -0,0 +1,46 @@
+import os
+import file_operations
+import utils
+import index_management
+from stripes import StripeSet
+from file_utils import encode
+from config import CHUNK_SIZE
+
+
+def test_round_robin_takes_turns():
+    stripes = StripeSet([("a", "1"), ("b", "2"), ("c", "3")], "round-robin")
+    assert [stripes.acquire(10) for n in range(4)] == ["1", "2", "3", "1"]
+
+
+def test_load_picks_the_least_busy_channel():
+    stripes = StripeSet([("a", "1"), ("b", "2")], "load")
+    first = stripes.acquire(100)
+    second = stripes.acquire(10)
+    assert {first, second} == {"1", "2"}
+    assert stripes.acquire(10) == second  # Fewer bytes in flight than the first, whatever the turn
+    stripes.release(first, 100)
+    assert stripes.acquire(10) == first
+
+
+def test_tokens_and_duplicate_channels():
+    stripes = StripeSet([("a", 1), ("b", "2"), ("c", "2")])
+    assert len(stripes) == 2
+    assert stripes.get_token("1") == "a" and stripes.get_token(2) == "c"
+    assert stripes.get_token("9") == "test-token"  # Not configured, so the default TOKEN
+
+
+def test_upload_is_striped_across_channels(make_file, fake, monkeypatch):
+    stripes = StripeSet([("test-token", "1"), ("second-token", "2")], "round-robin")
+    monkeypatch.setattr(file_operations, "stripes", stripes)
+    monkeypatch.setattr(utils, "stripes", stripes)
+    data = make_file("data.bin", 20 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+
+    entry = index_management.get_file_index()[encode("data.bin")]
+    assert set(entry["channels"]) == {"1", "2"}
+    chunk_messages = [m for m in fake.messages["2"].values() if m["attachments"]]
+    assert chunk_messages and all(m["id"] in [pair[0] for pair in entry["urls"]] for m in chunk_messages)
+
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "data.bin"), "rb") as f:
+        assert f.read() == data
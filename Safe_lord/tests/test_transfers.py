@@ -0,0 +1,90 @@
+import os
+import threading
+import pytest
+import chunk_codec
+import file_operations
+import index_management
+from file_utils import decode, encode
+from memory_budget import memory_budget
+from utils import get_chunk_offsets
+from config import CHUNK_SIZE, PACK_FILE_LIMIT
+
+
+def test_round_trip(make_file):
+    data = make_file("data.bin", 5 * CHUNK_SIZE + 123)
+    file_operations.upload_file(["data.bin"])
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "data.bin"), "rb") as f:
+        assert f.read() == data
+
+
+def test_sanitized_attachment_names(make_file, fake):
+    # Discord rewrites spaces and strips characters from attachment filenames, so chunks are matched by position
+    data = make_file("my file (1).bin", 3 * CHUNK_SIZE)
+    file_operations.upload_file(["my file (1).bin"])
+    names = [a["filename"] for m in fake.messages["1"].values() for a in m["attachments"]]
+    assert names and not any(" " in name or "(" in name for name in names)
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "my file (1).bin"), "rb") as f:
+        assert f.read() == data
+
+
+def test_pack_keeps_relative_names(make_file, fake):
+    small = make_file(os.path.join("d", "a.txt"), 100)
+    large = make_file(os.path.join("d", "sub", "c.bin"), PACK_FILE_LIMIT + 1)
+    file_operations.pack_files(["d"])
+    names = [decode(key) for key in index_management.get_file_index()]
+    assert sorted(names) == ["d/a.txt", "d/sub/c.bin"]
+
+    # Nothing is uploaded again on a second run
+    messages = len(fake.messages["1"])
+    file_operations.pack_files(["d"])
+    assert len(fake.messages["1"]) == messages
+
+    file_operations.download_file(["1", "2"])
+    for name, data in (("d/a.txt", small), ("d/sub/c.bin", large)):
+        with open(os.path.join("downloads", name), "rb") as f:
+            assert f.read() == data
+
+
+@pytest.mark.parametrize("limit", [2 * CHUNK_SIZE, 6 * CHUNK_SIZE])
+def test_compressed_upload_within_small_memory_limit(make_file, monkeypatch, limit):
+    # Compressible data grows chunks past CHUNK_SIZE, which has to fit a budget of only a few chunks
+    monkeypatch.setattr(file_operations, "COMPRESSION", "zlib")
+    monkeypatch.setattr(chunk_codec, "COMPRESSION", "zlib")
+    monkeypatch.setattr(memory_budget, "limit", limit)
+    data = b"compressible " * (CHUNK_SIZE // 2)
+    with open("data.txt", "wb") as f:
+        f.write(data)
+
+    thread = threading.Thread(target=file_operations.upload_file, args=(["data.txt"],), daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "the upload is waiting for memory it holds itself"
+
+    file_operations.download_file(["1"])
+    with open(os.path.join("downloads", "data.txt"), "rb") as f:
+        assert f.read() == data
+
+
+def test_chunk_that_cannot_be_decoded_fails_only_itself(monkeypatch):
+    monkeypatch.setattr(file_operations, "COMPRESSION", "zlib")
+    monkeypatch.setattr(chunk_codec, "COMPRESSION", "zlib")
+    data = os.urandom(3 * CHUNK_SIZE).hex().encode()  # Compresses to about half, so still takes several chunks
+    with open("data.txt", "wb") as f:
+        f.write(data)
+    file_operations.upload_file(["data.txt"])
+    file_index = index_management.get_file_index()
+    entry = file_index[encode("data.txt")]
+    assert len(entry["codecs"]) > 1
+    entry["codecs"][1] = "unknown"  # E.g. written by a newer version
+    index_management.write_index_file(file_index)
+
+    thread = threading.Thread(target=file_operations.download_file, args=(["1"],), daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "the download is waiting for a chunk that failed"
+    offsets = get_chunk_offsets(entry) + [len(data)]
+    with open(os.path.join("downloads", "data.txt"), "rb") as f:
+        written = f.read()
+    assert written[:offsets[1]] == data[:offsets[1]] and written[offsets[2]:] == data[offsets[2]:]
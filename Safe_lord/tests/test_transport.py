@@ -0,0 +1,20 @@
+import threading
+import pytest
+import requests
+from transport import api_request
+from config import BASE_URL
+
+
+def test_failed_request_releases_its_rate_limit_slot():
+    route = "GET /channels/test-release/messages"
+    # Not retried, and fails before any response could report the route's limits
+    with pytest.raises(requests.exceptions.InvalidURL):
+        api_request("GET", route, "http://[invalid/messages")
+
+    # The route's limits are still unknown, so a leaked slot would block this request forever
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(response=api_request("GET", route, f"{BASE_URL}1/messages")),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert result["response"].status_code == 200
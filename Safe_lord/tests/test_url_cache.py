@@ -0,0 +1,54 @@
+import os
+import threading
+import utils
+import file_operations
+import index_management
+from config import CHUNK_SIZE, URL_CACHE_FILE
+
+
+def get_pairs():
+    file_index = index_management.get_file_index()
+    return [tuple(pair) for key in file_index for pair in file_index[key]["urls"]]
+
+
+def test_lookups_do_not_hold_the_cache_lock(make_file, monkeypatch):
+    make_file("data.bin", 2 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    pairs = get_pairs()
+    list_channel_messages = utils.list_channel_messages
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_lookup(*args):
+        started.set()
+        release.wait(10)
+        return list_channel_messages(*args)
+
+    monkeypatch.setattr(utils, "list_channel_messages", slow_lookup)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(utils.resolve_attachment_urls(pairs)))
+    thread.start()
+    assert started.wait(10)
+    # Other callers get at the cache while the lookup pages through history
+    evicted = threading.Thread(target=utils.evict_attachment_url, args=pairs[0])
+    evicted.start()
+    evicted.join(5)
+    alive = evicted.is_alive()
+    release.set()
+    thread.join(10)
+    assert not alive
+    assert set(results[0]) == {(str(m), str(a)) for m, a in pairs}
+
+
+def test_cache_is_saved_once_per_command(make_file, fake, monkeypatch):
+    make_file("data.bin", 2 * CHUNK_SIZE)
+    file_operations.upload_file(["data.bin"])
+    pairs = get_pairs()
+    urls = utils.resolve_attachment_urls(pairs)
+    assert len(urls) == len(pairs) and not os.path.exists(URL_CACHE_FILE)
+
+    utils.save_url_cache()
+    monkeypatch.setattr(utils, "_url_cache", None)
+    requests = fake.stats["requests"]
+    assert utils.resolve_attachment_urls(pairs) == urls
+    assert fake.stats["requests"] == requests  # Found in the saved cache
@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import limiter
+from telemetry import telemetry
+from config import headers, MAX_RETRIES, UPLOAD_WORKERS, DOWNLOAD_WORKERS, REQUEST_TIMEOUT, BACKOFF_BASE, BACKOFF_CAP
+
+# One keep-alive connection pool for the whole process, big enough for every transfer worker
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS + DOWNLOAD_WORKERS + 4)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+
+def get_backoff(attempt):
+    """
+    Returns the delay before retry number `attempt` (from 0): exponential, capped at
+    BACKOFF_CAP, with full jitter so failed workers do not retry in lockstep.
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def api_request(method, route, url, token=None, **kwargs):
+    """
+    Sends a Discord API request over the shared session.
+
+    Sends are paced by the route's rate-limit bucket and 429s are waited out by the limiter.
+    Connection errors, timeouts and 5xx responses are retried with exponential backoff.
+    Every call is recorded in the telemetry with its retries and the time its 429s cost.
+
+    Parameters:
+        method (str): HTTP method.
+        route (str): Rate-limit bucket key for the request, e.g. "POST /channels/123/messages".
+        url (str): Request URL.
+        token (str): Bot token to authorize the request with, or None for TOKEN.
+        **kwargs: Extra arguments passed to requests; "headers" are added to the default ones.
+            Bodies must be re-sendable (bytes or a MultipartBody, not streams).
+
+    Returns:
+        requests.Response: The last response received. Raises requests.RequestException if the
+            last attempt failed without a response.
+    """
+    request_headers = headers if token is None else {**headers, "Authorization": f"Bot {token}"}
+    if "headers" in kwargs:
+        request_headers = {**request_headers, **kwargs.pop("headers")}
+    response = None
+    error = None
+    start = time.perf_counter()
+    attempt = rate_limited = 0
+    rate_limit_wait = 0.0
+    try:
+        for attempt in range(MAX_RETRIES):
+            waiting = time.perf_counter()
+            limiter.acquire(route)
+            if rate_limited:
+                rate_limit_wait += time.perf_counter() - waiting
+            try:
+                response = session.request(method, url, headers=request_headers, timeout=REQUEST_TIMEOUT, **kwargs)
+            except Exception as e:
+                # Whatever went wrong, the slot is given back, or the route would block once its limits are unknown
+                limiter.release(route)
+                if not isinstance(e, (requests.ConnectionError, requests.Timeout)) or attempt == MAX_RETRIES - 1:
+                    raise
+                delay = get_backoff(attempt)
+                logging.warning(f"{route} failed: {e}. Retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+
+            if limiter.update(route, response) is not None:
+                rate_limited += 1
+                continue  # Rate limited; the limiter holds the next attempt until the bucket resets
+            if response.status_code >= 500 and attempt < MAX_RETRIES - 1:
+                delay = get_backoff(attempt)
+                logging.warning(f"{route} failed with {response.status_code}. Retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            return response
+        return response
+    except requests.RequestException as e:
+        error = e
+        raise
+    finally:
+        body = kwargs.get("data")
+        telemetry.record_request("api", route, start, sent=len(body) if isinstance(body, (bytes, bytearray, MultipartBody)) else 0,
+                                 received=len(response.content) if response is not None and not kwargs.get("stream") else 0,
+                                 retries=attempt, rate_limited=rate_limited, rate_limit_wait=rate_limit_wait,
+                                 status=response.status_code if response is not None else None, error=error)
+
+
+def cdn_request(url, byte_range=None, stream=True):
+    """
+    Fetches an attachment from the CDN over the shared session, without the bot token.
+
+    Connection errors, timeouts and 5xx responses are retried with exponential backoff.
+    The request is recorded in the telemetry once the response headers arrive, with the
+    length of the body still to be read.
+
+    Parameters:
+        url (str): Signed attachment URL.
+        byte_range (tuple): (offset, length) to request with a Range header, or None for the whole attachment.
+        stream (bool): Leave the body to be read from the response as it arrives.
+
+    Returns:
+        requests.Response: The response; the caller checks its status and closes it.
+    """
+    request_headers = {}
+    if byte_range is not None:
+        request_headers["Range"] = f"bytes={byte_range[0]}-{byte_range[0] + byte_range[1] - 1}"
+
+    name = "GET attachment" if byte_range is None else "GET attachment range"
+    start = time.perf_counter()
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = session.get(url, headers=request_headers, stream=stream, timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES - 1:
+                telemetry.record_request("cdn", name, start, retries=attempt, error=e)
+                raise
+            delay = get_backoff(attempt)
+            logging.warning(f"Attachment download failed: {e}. Retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+
+        if response.status_code >= 500 and attempt < MAX_RETRIES - 1:
+            response.close()
+            delay = get_backoff(attempt)
+            logging.warning(f"Attachment download failed with {response.status_code}. Retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        telemetry.record_request("cdn", name, start, received=int(response.headers.get("Content-Length", 0)),
+                                 retries=attempt, status=response.status_code)
+        return response
+
+
+class MultipartBody:
+    """
+    A multipart/form-data request body that sends its files straight from their buffers.
+
+    requests copies every file of a `files=` upload into one bytes object before sending
+    it. Passed as `data=` with its content_type header instead, the parts are handed to the
+    socket one by one, so bytes, bytearrays and memoryviews (e.g. slices of a memory-mapped
+    file) are sent without being copied. The body can be iterated again when a request is
+    retried.
+    """
+
+    def __init__(self, files):
+        """
+        :param files: List of (field name, filename, bytes-like data) of the parts.
+        """
+        boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.parts = []
+        for field, filename, data in files:
+            # Quotes and line breaks are percent-encoded in the header, as browsers and urllib3 do
+            filename = filename.translate({10: "%0A", 13: "%0D", 34: "%22"})
+            self.parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                              f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+            self.parts.append(memoryview(data).cast("B"))
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{boundary}--\r\n".encode())
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
@@ -1,13 +1,31 @@
-import os
+import sys
+import json
+import shutil
+import time
 import logging
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 from math import ceil
 from file_utils import get_size_format
-from config import BASE_URL, CHANNEL_ID, headers, CHUNK_SIZE
-from config import MAX_TERMINAL_WIDTH, PADDING, SIZE_COLUMN_WIDTH, ID_COLUMN_WIDTH
+from transport import api_request
+from stripes import stripes
+from telemetry import telemetry
+from config import BASE_URL, CHANNEL_ID, CHUNK_SIZE, URL_CACHE_FILE, URL_EXPIRY_MARGIN, DELETE_WORKERS, BULK_DELETE_MAX_AGE
+from config import MAX_TERMINAL_WIDTH, PADDING, SIZE_COLUMN_WIDTH, ID_COLUMN_WIDTH, PROGRESS_INTERVAL, PROGRESS_LOG_INTERVAL
 
 logging.basicConfig(level=logging.INFO)
 
+_url_cache = None  # (message_id, attachment_id) -> (url, expiry), loaded from URL_CACHE_FILE on first use
+_url_cache_changed = False  # Whether _url_cache holds URLs that save_url_cache has not written yet
+_url_cache_lock = threading.Lock()
+
+DISCORD_EPOCH = 1420070400000  # Snowflake IDs count milliseconds from the start of 2015
+BULK_DELETE_LIMIT = 100  # Most messages one bulk-delete request takes
+
+_progress = {"total": None, "iteration": 0, "finished": True}  # State of the progress bar being shown
+_progress_lock = threading.Lock()
 
 
 
@@ -21,7 +39,7 @@ def print_table_header():
     """
     # Constants for configuration
 
-    terminal_width = os.get_terminal_size().columns
+    terminal_width = shutil.get_terminal_size().columns
     max_width = min(MAX_TERMINAL_WIDTH, terminal_width) - PADDING
     filename_column_width = max_width - SIZE_COLUMN_WIDTH - ID_COLUMN_WIDTH - 6  # Adjust for spacing
 
@@ -53,7 +71,7 @@ def print_summary_line(max_width):
     Args:
         max_width (int): The maximum width for the summary line.
     """
-    terminal_size = os.get_terminal_size()
+    terminal_size = shutil.get_terminal_size()
     adjusted_width = min(max_width, terminal_size[0])
     print("-" * adjusted_width)
 
@@ -69,28 +87,96 @@ def get_total_chunks(size):
     """
     return ceil(size / CHUNK_SIZE)
 
+def get_chunk_offsets(file_entry):
+    """
+    Calculates where each chunk of an indexed file starts.
+
+    Args:
+        file_entry (dict): The file's index entry.
+
+    Returns:
+        list: The byte offset of every chunk, in chunk order.
+    """
+    if "sizes" not in file_entry:
+        return [i * CHUNK_SIZE for i in range(len(file_entry["urls"]))]
+    offsets = []
+    offset = 0
+    for size in file_entry["sizes"]:
+        offsets.append(offset)
+        offset += size
+    return offsets
+
 def show_progress_bar(iteration, total):
-    decimals = 2
-    length = min(120, os.get_terminal_size()[0]) - 40
-    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filled_length = int(length * (iteration) // total)
-    bar = f"{'#' * filled_length}{'-' * (length-filled_length - 1)}"
-    print(f"\rProgress: {bar} {iteration}/{total} ({percent}%) Complete", end="")
-    if iteration == total:
-        print()
+    """
+    Shows how far a transfer has come, with its throughput and the time left.
+
+    The rate covers the bytes of every request since the bar started, so it sums up all
+    concurrent workers, and the time left is estimated from the rate items complete at.
+    The bar is redrawn at most every PROGRESS_INTERVAL seconds, and may be called from any
+    thread. When the output is not a terminal, e.g. under cron or systemd, a plain line is
+    printed every PROGRESS_LOG_INTERVAL seconds instead.
+
+    Parameters:
+        iteration (int): Items done so far; a count below the last one starts a new bar.
+        total (int): Items in the transfer.
+    """
+    now = time.perf_counter()
+    with _progress_lock:
+        state = _progress
+        if state["finished"] or total != state["total"] or iteration < state["iteration"]:
+            state.update(total=total, first=iteration, start=now, transferred=telemetry.transferred, shown=None)
+        state["iteration"] = iteration
+        state["finished"] = iteration >= total
+        interactive = sys.stdout.isatty()
+        interval = PROGRESS_INTERVAL if interactive else PROGRESS_LOG_INTERVAL
+        if not state["finished"] and state["shown"] is not None and now - state["shown"] < interval:
+            return
+        state["shown"] = now
+
+        elapsed = now - state["start"]
+        rate = (telemetry.transferred - state["transferred"]) / elapsed if elapsed > 0 else 0
+        done = iteration - state["first"]
+        if state["finished"]:
+            left = f"took {format_duration(elapsed)}"
+        else:
+            left = f"{format_duration(elapsed / done * (total - iteration))} left" if done and elapsed > 0 else "-- left"
+        percent = 100 * iteration / total if total else 100
+        status = f"{iteration}/{total} ({percent:.2f}%) {get_size_format(rate)}/s, {left}"
+        if not interactive:
+            print(f"Progress: {status}")
+            return
+        width = min(MAX_TERMINAL_WIDTH, shutil.get_terminal_size()[0]) - 1
+        length = max(10, width - len(status) - 11)
+        filled_length = int(length * iteration // total) if total else length
+        bar = f"{'#' * filled_length}{'-' * (length - filled_length)}"
+        # Padded to the full width, so a shorter status does not leave the end of the last one behind
+        print(f"\r{f'Progress: {bar} {status}':<{width}}", end="\n" if state["finished"] else "", flush=True)
+
+def format_duration(seconds):
+    """
+    Formats a number of seconds as e.g. "42s", "3m05s" or "2h10m".
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
 
-def fetch_message(message_id):
+def fetch_message(message_id, channel_id=CHANNEL_ID):
     """
     Fetches a message by its ID from a specified channel.
 
     Parameters:
         message_id (str): The ID of the message to fetch.
+        channel_id (str): The channel the message was posted in.
 
     Returns:
         dict: The message data as a dictionary if successful, None otherwise.
     """
     try:
-        response = requests.get(f"{BASE_URL}{CHANNEL_ID}/messages/{message_id}", headers=headers)
+        response = api_request("GET", f"GET /channels/{channel_id}/messages",
+                               f"{BASE_URL}{channel_id}/messages/{message_id}", token=stripes.get_token(channel_id))
         response.raise_for_status()  # This will raise an exception for 4XX/5XX responses
         return response.json()
     except requests.exceptions.HTTPError as http_err:
@@ -99,22 +185,204 @@ def fetch_message(message_id):
         logging.error(f"Request error occurred while loading message {message_id}: {req_err}")
     return None
 
-def download_content(download_url, file_handle, current_chunk, total_chunks):
-    try:
-        with requests.get(download_url, stream=True) as cdnResponse:
-            cdnResponse.raise_for_status()  # Automatically handles bad responses
-
-            for chunk in cdnResponse.iter_content(chunk_size=26214400): 
-                if chunk:  # filter out keep-alive new chunks
-                    file_handle.write(chunk)
-                    show_progress_bar(current_chunk + 1, total_chunks)
-                    
-        print("Download complete.")
-        return True
-    except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred while downloading the file: {http_err}")
-    except requests.exceptions.RequestException as req_err:
-        logging.error(f"Request error occurred while downloading the file: {req_err}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-    return False
\ No newline at end of file
+def get_url_expiry(url):
+    """
+    Reads the expiry time of a signed CDN URL from its `ex` parameter.
+
+    Parameters:
+        url (str): The attachment URL.
+
+    Returns:
+        int: Unix timestamp after which the URL stops working, or None if the URL does not expire.
+    """
+    expiry = parse_qs(urlparse(url).query).get("ex")
+    return int(expiry[0], 16) if expiry else None
+
+def _get_url_cache():
+    global _url_cache
+    if _url_cache is None:
+        _url_cache = {}
+        try:
+            with open(URL_CACHE_FILE, "r") as f:
+                for key, value in json.load(f).items():
+                    _url_cache[tuple(key.split(":"))] = tuple(value)
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable URL cache: {e}")
+    return _url_cache
+
+def save_url_cache():
+    """
+    Writes the attachment URLs that have not expired to URL_CACHE_FILE, if any were resolved since the last save.
+
+    Called once a command is done rather than after every lookup.
+    """
+    global _url_cache_changed
+    with _url_cache_lock:
+        if _url_cache is None or not _url_cache_changed:
+            return
+        now = time.time()
+        data = {
+            ":".join(key): [url, expiry]
+            for key, (url, expiry) in _url_cache.items()
+            if expiry is None or expiry > now
+        }
+        try:
+            with open(URL_CACHE_FILE, "w") as f:
+                json.dump(data, f)
+            _url_cache_changed = False
+        except OSError as e:
+            logging.warning(f"Could not save URL cache: {e}")
+
+def evict_attachment_url(message_id, attachment_id):
+    """
+    Drops a cached attachment URL, e.g. after the CDN rejected it.
+    """
+    with _url_cache_lock:
+        _get_url_cache().pop((str(message_id), str(attachment_id)), None)
+
+def resolve_attachment_urls(pairs, channels=None):
+    """
+    Resolves fresh CDN URLs for many chunk attachments at once.
+
+    Cached URLs are reused until shortly before their signed expiry. The rest are
+    looked up by paging through channel history in windows of 100 messages around
+    the requested IDs, instead of fetching every message on its own. Striped
+    channels are paged through concurrently. The cache is only locked to read and
+    update it, so lookups of several callers run side by side.
+
+    Parameters:
+        pairs (list): (message_id, attachment_id) pairs to resolve.
+        channels (list): Channel ID of every pair, or None if they are all in CHANNEL_ID.
+
+    Returns:
+        dict: Maps each resolvable (message_id, attachment_id) tuple of strings to its URL.
+            Pairs whose message could not be found are left out.
+    """
+    keys = [(str(message_id), str(attachment_id)) for message_id, attachment_id in pairs]
+    channels = channels or [CHANNEL_ID] * len(keys)
+    now = time.time()
+
+    global _url_cache_changed
+    with _url_cache_lock:
+        cache = _get_url_cache()
+        found = {key: cache[key] for key in keys if key in cache}
+    wanted = {}  # Channel ID -> IDs of the messages to look up in it
+    for key, channel_id in zip(keys, channels):
+        if key not in found or (found[key][1] is not None and found[key][1] - URL_EXPIRY_MARGIN <= now):
+            wanted.setdefault(str(channel_id), set()).add(int(key[0]))
+    if not wanted:
+        return {key: found[key][0] for key in found}
+
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=len(wanted)) as executor:
+        for messages in executor.map(lambda item: list_channel_messages(*item), wanted.items()):
+            for message in messages:
+                for attachment in message.get("attachments", []):
+                    resolved[(message["id"], attachment["id"])] = (attachment["url"], get_url_expiry(attachment["url"]))
+    with _url_cache_lock:
+        cache = _get_url_cache()
+        cache.update(resolved)
+        _url_cache_changed = True
+        return {key: cache[key][0] for key in keys if key in cache}
+
+def list_channel_messages(channel_id, message_ids):
+    """
+    Pages through a channel's history from the oldest of the given messages until all of them are covered.
+
+    Returns:
+        list: The messages found. Stops early, logging the error, if a page cannot be loaded.
+    """
+    found = []
+    pending = sorted(message_ids)
+    while pending:
+        try:
+            response = api_request("GET", f"GET /channels/{channel_id}/messages", f"{BASE_URL}{channel_id}/messages",
+                                   token=stripes.get_token(channel_id), params={"limit": 100, "after": pending[0] - 1})
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error occurred while resolving attachment URLs: {e}")
+            break
+
+        messages = response.json()
+        found += messages
+        # A short page means the history after the window start is exhausted
+        covered = max(int(message["id"]) for message in messages) if len(messages) == 100 else float("inf")
+        pending = [message_id for message_id in pending if message_id > covered]
+    return found
+
+def get_chunk_channels(file_entry):
+    """
+    Returns the channel ID of every chunk of an index entry. Entries without "channels" are stored in CHANNEL_ID.
+    """
+    return file_entry.get("channels") or [CHANNEL_ID] * len(file_entry["urls"])
+
+def get_snowflake_time(snowflake):
+    """
+    Returns the Unix time a Discord ID (e.g. of a message) was created at.
+    """
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+
+@telemetry.timed("delete")
+def delete_messages(channel_id, message_ids, progress=None):
+    """
+    Deletes messages from a channel with as few requests as possible.
+
+    Messages younger than BULK_DELETE_MAX_AGE are removed in bulk-delete requests of up to
+    100 each. Older ones, which Discord only deletes one by one, are deleted on DELETE_WORKERS
+    threads, paced by the channel's rate limiter. A message that no longer exists counts as deleted.
+
+    Parameters:
+        channel_id (str): The channel the messages are in.
+        message_ids (list): IDs of the messages to delete.
+        progress (function): Called with the number of messages handled after every request, from any thread.
+
+    Returns:
+        set: The IDs of the messages that are gone.
+    """
+    token = stripes.get_token(channel_id)
+    newest_bulk = time.time() - BULK_DELETE_MAX_AGE
+    recent = [message_id for message_id in message_ids if get_snowflake_time(message_id) > newest_bulk]
+    single = [message_id for message_id in message_ids if get_snowflake_time(message_id) <= newest_bulk]
+    deleted = set()
+
+    for start in range(0, len(recent), BULK_DELETE_LIMIT):
+        batch = recent[start:start + BULK_DELETE_LIMIT]
+        if len(batch) < 2:
+            single += batch  # Bulk delete takes at least two messages
+            continue
+        try:
+            response = api_request("POST", f"POST /channels/{channel_id}/messages/bulk-delete",
+                                   f"{BASE_URL}{channel_id}/messages/bulk-delete", token=token, json={"messages": batch})
+        except requests.exceptions.RequestException as e:
+            response = None
+            logging.error(f"Bulk delete of {len(batch)} messages failed: {e}")
+        if response is not None and response.status_code == 204:
+            deleted.update(batch)
+            if progress:
+                progress(len(batch))
+        else:
+            if response is not None:
+                logging.warning(f"Bulk delete failed: {response.status_code} {response.text}. Deleting one by one")
+            single += batch
+
+    @telemetry.timed("delete")
+    def delete_message(message_id):
+        try:
+            response = api_request("DELETE", f"DELETE /channels/{channel_id}/messages",
+                                   f"{BASE_URL}{channel_id}/messages/{message_id}", token=token)
+            gone = response.status_code in (204, 404)
+            if not gone:
+                logging.error(f"Failed to delete message {message_id}: {response.status_code} {response.text}")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"An error occurred while deleting message {message_id}: {e}")
+            gone = False
+        if progress:
+            progress(1)
+        return gone
+
+    if single:
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+            deleted.update(message_id for message_id, gone in zip(single, executor.map(delete_message, single)) if gone)
+    return deleted